@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+
+import ujson as json
+from starlette.exceptions import HTTPException
+
+from app.geometry import Bounds, TooManyVertices, extract_geometries, hash_geometries
+
+# length of properties summary included into the prompt
+MAX_PROPERTIES_LENGTH = 2000
+
+
+@dataclass(frozen=True)
+class Area:
+    '''
+    GeoJSON of an area checked and summarized once per request,
+    later stages use these fields instead of walking the document again
+    '''
+    geojson: dict
+    # geometry_hash of the area
+    hash: str
+    bbox: tuple[float, float, float, float] | None
+    vertices: int
+    # deduplicated and truncated properties of features for the prompt
+    properties: str
+
+
+async def read_json(request: 'Request', max_bytes: int) -> dict:
+    '''request body parsed as JSON object, 413 if it's larger than max_bytes'''
+    content_length = request.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f'request is larger than {max_bytes} bytes')
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            raise HTTPException(status_code=413, detail=f'request is larger than {max_bytes} bytes')
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='malformed request')
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail='malformed request')
+    return data
+
+
+def summarize_properties(properties: list) -> str:
+    '''
+    concatenate distinct non-empty properties in document order, truncated to MAX_PROPERTIES_LENGTH.
+    properties past the limit are not formatted at all
+    '''
+    seen = set()
+    parts, length = [], 0
+    for prop in properties:
+        if not prop:
+            continue
+        prop_str = str(prop)
+        if prop_str in seen:
+            continue
+        seen.add(prop_str)
+        parts.append(prop_str)
+        length += len(prop_str) + 2
+        if length > MAX_PROPERTIES_LENGTH + 2:
+            break
+    props_str = ', '.join(parts) or 'not available'
+    if len(props_str) > MAX_PROPERTIES_LENGTH:
+        props_str = props_str[:MAX_PROPERTIES_LENGTH] + '...'
+    return f'(input GeoJSON properties: {props_str})'
+
+
+def ingest_area(geojson: dict, max_vertices: int = None) -> Area:
+    '''
+    check GeoJSON of the area and summarize it in one walk:
+    geometries are hashed, bbox and vertices are counted while coordinates are rounded for the hash.
+    raises 400 for non-object GeoJSON and 413 when the area has more than max_vertices
+    '''
+    if not isinstance(geojson, dict):
+        raise HTTPException(status_code=400, detail='GeoJSON must be an object')
+    if geojson.get('type') == 'FeatureCollection':
+        features = geojson.get('features') or []
+    else:
+        features = [geojson]
+    geometries, properties = [], []
+    for feature in features:
+        if not isinstance(feature, dict):
+            raise HTTPException(status_code=400, detail='GeoJSON features must be objects')
+        properties.append(feature.get('properties'))
+        geometries += extract_geometries(feature)
+
+    bounds = Bounds(max_vertices)
+    try:
+        area_hash = hash_geometries(geometries, bounds)
+    except TooManyVertices:
+        raise HTTPException(status_code=413, detail=f'area has more than {max_vertices} vertices')
+    return Area(
+        geojson=geojson,
+        hash=area_hash,
+        bbox=bounds.bbox,
+        vertices=bounds.vertices,
+        properties=summarize_properties(properties),
+    )
@@ -0,0 +1,138 @@
+'''
+In-memory caches of a worker.
+'''
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from app import metrics
+from app.logger import LOGGER
+
+
+class LRUCache:
+    '''
+    LRU cache bounded by total size of values in bytes.
+    entries older than ttl seconds are dropped on access.
+    '''
+
+    def __init__(self, name: str, max_bytes: int, ttl: float, sizeof: Callable[[Any], int] = sys.getsizeof):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        # key -> (expires_at, size, value), most recently used is the last one
+        self._data: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+        metrics.register_gauge(f'cache.{name}.bytes', lambda: self.size)
+        metrics.register_gauge(f'cache.{name}.entries', lambda: len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, size, value = entry
+        if expires_at <= time.monotonic():
+            self.pop(key)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value, ttl: float = None):
+        size = self.sizeof(value)
+        self.pop(key)
+        if size > self.max_bytes:
+            # would evict everything else
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self.size -= evicted_size
+            metrics.inc(f'cache.{self.name}.evictions')
+
+    def pop(self, key: Hashable):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[2]
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+
+class RefreshingValue:
+    '''
+    single value produced by async loader.
+    only the first load is awaited by callers: when the value gets older than ttl,
+    callers get the stale one while it's refreshed in background.
+    failed refresh keeps the stale value and is retried after retry_interval
+    '''
+
+    def __init__(self, name: str, loader: Callable[[], Awaitable[Any]], ttl: float, retry_interval: float = 30.0):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._value = None
+        self._loaded = False
+        self._refresh_at = 0.0
+        self._task: asyncio.Task | None = None
+        # loads started before invalidate() don't update the value
+        self._generation = 0
+
+    async def _load(self, generation: int):
+        try:
+            value = await self.loader()
+        except Exception:
+            if generation == self._generation:
+                self._refresh_at = time.monotonic() + self.retry_interval
+            raise
+        if generation == self._generation:
+            self._value = value
+            self._loaded = True
+            self._refresh_at = time.monotonic() + self.ttl
+            metrics.inc(f'cache.{self.name}.loads')
+        return value
+
+    def _start_load(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._load(self._generation))
+            self._task.add_done_callback(self._on_load_done)
+        return self._task
+
+    def _on_load_done(self, task: asyncio.Task):
+        if not task.cancelled() and (e := task.exception()):
+            LOGGER.error('failed to load %s: %s', self.name, e)
+
+    @property
+    def value(self):
+        '''current value without triggering a load, None if it's not loaded'''
+        return self._value
+
+    async def get(self):
+        if not self._loaded:
+            return await asyncio.shield(self._start_load())
+        if time.monotonic() >= self._refresh_at:
+            metrics.inc(f'cache.{self.name}.stale')
+            self._start_load()
+        return self._value
+
+    def invalidate(self):
+        '''drop the value, the next caller waits for a fresh one'''
+        self._generation += 1
+        self._value = None
+        self._loaded = False
+        self._refresh_at = 0.0
+        self._task = None
+
+    def prefetch(self):
+        '''start loading in background if the value isn't loaded yet, errors are logged'''
+        if not self._loaded:
+            self._start_load()
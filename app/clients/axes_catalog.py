@@ -0,0 +1,45 @@
+import hashlib
+from types import MappingProxyType
+from typing import Any, Callable, Mapping
+
+import ujson as json
+
+
+class AxesCatalog:
+    '''
+    Snapshot of insights-api getAxes response with lookups prebuilt from it.
+
+    A catalog is never modified after it's built, requests share it without copying.
+    `version` is a hash of the axes content, a refresh that brings the same
+    content keeps the previous catalog together with everything derived from it.
+    '''
+
+    def __init__(self, axes_response: dict):
+        axes = axes_response['data']['getAxes']['axis']
+        self.axes: tuple[dict, ...] = tuple(axes)
+        self.version = hashlib.md5(json.dumps(axes, sort_keys=True).encode('utf-8')).hexdigest()
+
+        metadata = {}
+        for axis in axes:
+            num, den = axis['quotients']
+            if num['name'] not in metadata:
+                metadata[num['name']] = {
+                    'unit': num['unit']['longName'],
+                    'emoji': num['emoji'],
+                    'label': num['label'],
+                    'description': num['description'],
+                }
+        # numerator -> indicator metadata
+        self.metadata: Mapping[str, dict] = MappingProxyType(metadata)
+        self._derived: dict[str, Any] = {}
+
+    def derive(self, name: str, builder: Callable[['AxesCatalog'], Any]):
+        '''
+        value built by builder(catalog) once per catalog version.
+        consumers keep their own lookups here, e.g. MCDA labelled axes
+        '''
+        try:
+            return self._derived[name]
+        except KeyError:
+            value = self._derived[name] = builder(self)
+            return value
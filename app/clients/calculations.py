@@ -0,0 +1,80 @@
+from typing import Mapping
+
+AXIS_FIELDS = ('numerator', 'denominator', 'numeratorLabel', 'denominatorLabel', 'emoji', 'numeratorUnit', 'denominatorUnit')
+CALCULATION_FIELDS = ('calculation', 'value', 'quality', 'world_sigma', 'reference_area_sigma')
+
+
+class AxisLabels:
+    '''labels and units of an axis, one object is shared by all calculations of the axis'''
+    __slots__ = AXIS_FIELDS
+
+    def __init__(self, item: dict, metadata: Mapping[str, dict]):
+        self.numerator = item['numerator']
+        self.denominator = item['denominator']
+        self.numeratorLabel = item['numeratorLabel']
+        self.denominatorLabel = item['denominatorLabel']
+        self.emoji = metadata[self.numerator]['emoji']
+        self.numeratorUnit = metadata[self.numerator]['unit']
+        self.denominatorUnit = metadata[self.denominator]['unit']
+
+
+class Interned:
+    '''
+    axis labels and (calculation, numerator, denominator) keys shared by analytics
+    of the world and all areas while an axes catalog is current.
+    keys are numbered in order of appearance, tables find their rows by these numbers
+    '''
+    __slots__ = ('axes', 'ids', 'keys')
+
+    def __init__(self):
+        self.axes: dict[tuple, AxisLabels] = {}
+        self.ids: dict[tuple, int] = {}
+        self.keys: list[tuple] = []
+
+    def axis(self, item: dict, metadata: Mapping[str, dict]) -> AxisLabels:
+        '''AxisLabels of advancedAnalytics item, reused while labels are the same'''
+        key = item['numerator'], item['denominator'], item['numeratorLabel'], item['denominatorLabel']
+        axis = self.axes.get(key)
+        if axis is None:
+            axis = self.axes[key] = AxisLabels(item, metadata)
+        return axis
+
+    def key_id(self, key: tuple) -> int:
+        key_id = self.ids.get(key)
+        if key_id is None:
+            key_id = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return key_id
+
+
+class Calculation:
+    '''
+    value of a calculation of an axis, axis fields are read from the shared AxisLabels.
+    as_dict() gives the dict with the keys of flatten_analytics entries
+    '''
+    __slots__ = ('axis',) + CALCULATION_FIELDS
+
+    def __init__(self, axis: AxisLabels, calculation: str, value: float, quality: float):
+        self.axis = axis
+        self.calculation = calculation
+        self.value = value
+        self.quality = quality
+        self.world_sigma = 0
+        self.reference_area_sigma = 0
+
+    @property
+    def numerator(self) -> str:
+        return self.axis.numerator
+
+    @property
+    def denominator(self) -> str:
+        return self.axis.denominator
+
+    def as_dict(self) -> dict:
+        return {
+            **{name: getattr(self.axis, name) for name in AXIS_FIELDS},
+            **{name: getattr(self, name) for name in CALCULATION_FIELDS},
+        }
+
+    def __repr__(self):
+        return f'Calculation({self.as_dict()})'
@@ -0,0 +1,118 @@
+'''
+aiohttp session shared by upstream clients of a worker.
+
+Keeps keep-alive connections, DNS cache and TLS sessions between requests.
+Connector usage is reported through request tracing.
+'''
+import time
+
+import ujson as json
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+from app import metrics
+from app.settings import Settings
+
+settings = Settings()
+
+INSIGHTS_API_TIMEOUT = ClientTimeout(total=settings.INSIGHTS_API_TIMEOUT)
+USER_PROFILE_API_TIMEOUT = ClientTimeout(total=settings.USER_PROFILE_API_TIMEOUT)
+NOMINATIM_TIMEOUT = ClientTimeout(total=settings.NOMINATIM_TIMEOUT)
+
+_session: ClientSession | None = None
+_stats = {'in_flight': 0, 'queued': 0, 'active': 0}
+
+
+async def _on_request_start(session, ctx, params):
+    _stats['in_flight'] += 1
+
+
+async def _on_request_done(session, ctx, params):
+    _stats['in_flight'] -= 1
+    # queued_end isn't sent when the wait for a connection is cancelled or timed out
+    _leave_queue(ctx)
+    if getattr(ctx, 'connected', False):
+        _stats['active'] -= 1
+        ctx.connected = False
+
+
+def _leave_queue(ctx):
+    if getattr(ctx, 'queued_at', None) is not None:
+        _stats['queued'] -= 1
+        metrics.observe('http.connection_queue_wait', time.monotonic() - ctx.queued_at)
+        ctx.queued_at = None
+
+
+async def _on_connection_queued_start(session, ctx, params):
+    # all connections allowed by the limits are busy
+    ctx.queued_at = time.monotonic()
+    _stats['queued'] += 1
+
+
+async def _on_connection_queued_end(session, ctx, params):
+    _leave_queue(ctx)
+
+
+def _take_connection(ctx):
+    # redirects of the request take a new connection after releasing the previous one
+    if not getattr(ctx, 'connected', False):
+        _stats['active'] += 1
+        ctx.connected = True
+
+
+async def _on_connection_create_end(session, ctx, params):
+    metrics.inc('http.connections_created')
+    _take_connection(ctx)
+
+
+async def _on_connection_reuseconn(session, ctx, params):
+    metrics.inc('http.connections_reused')
+    _take_connection(ctx)
+
+
+def _trace_config() -> TraceConfig:
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_done)
+    trace_config.on_request_exception.append(_on_request_done)
+    trace_config.on_connection_queued_start.append(_on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(_on_connection_queued_end)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    return trace_config
+
+
+def create_http_session() -> ClientSession:
+    global _session
+    connector = TCPConnector(
+        limit=settings.HTTP_POOL_LIMIT,
+        limit_per_host=settings.HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    _session = ClientSession(
+        connector=connector,
+        headers={'User-Agent': settings.USER_AGENT},
+        json_serialize=json.dumps,
+        trace_configs=[_trace_config()],
+    )
+    return _session
+
+
+async def close_http_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def get_http_session() -> ClientSession:
+    '''session is created in app lifespan, or on first use outside of the app'''
+    if _session is None or _session.closed:
+        return create_http_session()
+    return _session
+
+
+metrics.register_gauge('http.requests_in_flight', lambda: _stats['in_flight'])
+metrics.register_gauge('http.connections_queued', lambda: _stats['queued'])
+# connections taken by requests waiting for response headers, up to HTTP_POOL_LIMIT
+metrics.register_gauge('http.connections_active', lambda: _stats['active'])
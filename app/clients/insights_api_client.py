@@ -1,19 +1,28 @@
 from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import Mapping
 
 import asyncio
+import heapq
 import ujson as json
 from starlette.exceptions import HTTPException
 from aiohttp import ClientSession
 
+from app import metrics
+from app.cache import LRUCache, RefreshingValue
+from app.clients.axes_catalog import AxesCatalog
+from app.clients.calculations import Calculation, Interned
+from app.clients.http import get_http_session, INSIGHTS_API_TIMEOUT
+from app.db import get_db_conn
+from app.area import Area
+from app.geometry import simplify_area
 from app.settings import Settings
 from app.logger import LOGGER
+from app.singleflight import SingleFlight
 
 settings = Settings()
 
-advanced_analytics_graphql = """
-{
-  polygonStatistic (polygonStatisticRequest: {polygon: "%s"})
-  {
+advanced_analytics_fields = """
     analytics {
         advancedAnalytics {
             numerator,
@@ -28,10 +37,25 @@ advanced_analytics_graphql = """
             }
         }
     }
-  }
-}
 """
 
+# polygon of world analytics
+EMPTY_POLYGON = '{"type":"FeatureCollection","features":[]}'
+
+
+def polygon_statistic_graphql(aliases: list[str]) -> str:
+    '''
+    GraphQL document with polygonStatistic field for every alias,
+    polygons are passed as variables named after aliases
+    '''
+    variables = ', '.join(f'${alias}: String' for alias in aliases)
+    fields = ''.join(
+        f'{alias}: polygonStatistic(polygonStatisticRequest: {{polygon: ${alias}}}) {{{advanced_analytics_fields}}}\n'
+        for alias in aliases
+    )
+    return f'query PolygonStatistic({variables}) {{\n{fields}}}'
+
+
 axis_graphql = """
 {
     getAxes {
@@ -75,14 +99,163 @@ axis_graphql = """
 """
 
 
-async def get_axes() -> str:
-    headers = {
-        'User-Agent': settings.USER_AGENT,
-    }
-    async with ClientSession(headers=headers) as session:
-        axes = await query_insights_api(session, axis_graphql)
-        LOGGER.debug('got axes')
-        return axes
+async def load_world_analytics() -> dict:
+    analytics_world, = await query_polygon_statistic(get_http_session(), [None])
+    LOGGER.debug('got world analytics')
+    return analytics_world
+
+
+# world analytics are the same for every request, insights-api recomputes them on every query
+world_analytics = RefreshingValue('world_analytics', load_world_analytics, ttl=settings.WORLD_ANALYTICS_TTL)
+# (analytics_world, axes version, calculations_world) of the latest flatten_analytics call
+_world_calculations = (None, None, None)
+
+
+def invalidate_world_analytics():
+    '''drop cached world analytics, e.g. after indicators were updated in insights-api'''
+    global _world_calculations
+    world_analytics.invalidate()
+    _world_calculations = (None, None, None)
+
+
+async def get_world_calculations(catalog: AxesCatalog) -> dict[tuple, Calculation]:
+    '''flattened world analytics, recomputed only when analytics or axes change'''
+    global _world_calculations
+    analytics_world = await world_analytics.get()
+    cached_analytics, cached_version, calculations_world = _world_calculations
+    if cached_analytics is analytics_world and cached_version == catalog.version:
+        return calculations_world
+    calculations_world = get_world_calculations_from(analytics_world, catalog)
+    _world_calculations = (analytics_world, catalog.version, calculations_world)
+    return calculations_world
+
+
+def get_interned(catalog: AxesCatalog) -> Interned:
+    return catalog.derive('interned_calculations', lambda _: Interned())
+
+
+def get_world_calculations_from(analytics_world: dict, catalog: AxesCatalog) -> dict[tuple, Calculation]:
+    return flatten_analytics(analytics_world, catalog.metadata, get_interned(catalog))
+
+
+async def load_axes_catalog() -> AxesCatalog:
+    catalog = AxesCatalog(await query_insights_api(get_http_session(), axis_graphql))
+    LOGGER.debug('got axes, version %s', catalog.version)
+    previous = axes_catalog.value
+    if previous is not None and previous.version == catalog.version:
+        # keep lookups derived from the previous catalog
+        return previous
+    return catalog
+
+
+axes_catalog = RefreshingValue('axes', load_axes_catalog, ttl=settings.AXES_TTL)
+
+
+async def get_axes() -> AxesCatalog:
+    return await axes_catalog.get()
+
+
+# (geometry_hash, axes version) -> polygonStatistic response, in front of insights_cache table
+_area_analytics = LRUCache(
+    'insights',
+    max_bytes=settings.INSIGHTS_CACHE_MAX_BYTES,
+    ttl=settings.INSIGHTS_CACHE_TTL,
+    sizeof=lambda analytics: len(json.dumps(analytics)),
+)
+area_analytics_flight = SingleFlight('insights')
+
+
+async def get_areas_analytics(areas: list[Area]) -> list[dict]:
+    '''
+    polygonStatistic analytics for every area, cached by hash of its geometry.
+    cached analytics are dropped when axes change.
+    areas requested by concurrent calls are awaited, the rest are requested in one query
+    '''
+    catalog = await get_axes()
+    keys = [(area.hash, catalog.version) for area in areas]
+    results = [_area_analytics.get(key) for key in keys]
+    missing = {key: area for key, area, analytics in zip(keys, areas, results) if analytics is None}
+    metrics.inc('insights_cache.l1_hit', len(areas) - len(missing))
+    if missing:
+        async def fetch(batch: list[tuple]) -> dict[tuple, dict]:
+            fetched = await _get_areas_analytics({area_hash: missing[area_hash, _] for area_hash, _ in batch}, catalog.version)
+            return {(area_hash, catalog.version): analytics for area_hash, analytics in fetched.items()}
+
+        fetched = await area_analytics_flight.do_batch(list(missing), fetch)
+        results = [fetched[key] if analytics is None else analytics for key, analytics in zip(keys, results)]
+    return results
+
+
+async def _get_areas_analytics(areas: dict[str, Area], axes_version: str) -> dict[str, dict]:
+    '''
+    accepts geometry_hash -> area, returns geometry_hash -> analytics.
+    analytics are cached under axes_version, unless axes were refreshed to other version
+    while insights-api was queried: it's unknown which axes the analytics are of then
+    '''
+    results = await _get_stored_analytics(list(areas), axes_version)
+    if missing := [area_hash for area_hash in areas if area_hash not in results]:
+        metrics.inc('insights_cache.miss', len(missing))
+        # areas are hashed before simplification, so cache keys don't depend on simplification settings.
+        # large boundaries take a while to simplify, the thread keeps event loop responsive
+        simplified = await asyncio.gather(*(asyncio.to_thread(simplify_for_analytics, areas[h]) for h in missing))
+        fetched = dict(zip(missing, await query_polygon_statistic(get_http_session(), simplified)))
+        results.update(fetched)
+        if (latest := axes_catalog.value) is not None and latest.version != axes_version:
+            LOGGER.debug('axes changed from %s to %s during the query, analytics are not cached', axes_version, latest.version)
+            metrics.inc('insights_cache.axes_changed')
+            return results
+        async with get_db_conn() as conn:
+            await conn.executemany('''
+                insert into insights_cache (geometry_hash, axes_version, response) values ($1, $2, $3)
+                on conflict (geometry_hash, axes_version) do update set response = excluded.response, created_at = now()''',
+                [(area_hash, axes_version, analytics) for area_hash, analytics in fetched.items()])
+        for area_hash, analytics in fetched.items():
+            _area_analytics.set((area_hash, axes_version), analytics)
+        LOGGER.debug('saved analytics for geometry_hash = %s', missing)
+    return results
+
+
+async def _get_stored_analytics(area_hashes: list[str], axes_version: str) -> dict[str, dict]:
+    '''geometry_hash -> analytics saved in insights_cache table, they're put into the in-memory cache'''
+    async with get_db_conn() as conn:
+        rows = await conn.fetch('''
+            select geometry_hash, response from insights_cache
+            where geometry_hash = any($1::text[]) and axes_version = $2
+                and created_at > now() - make_interval(secs => $3)''',
+            area_hashes, axes_version, settings.INSIGHTS_CACHE_TTL)
+    results = {row['geometry_hash']: row['response'] for row in rows}
+    metrics.inc('insights_cache.l2_hit', len(results))
+    for area_hash, analytics in results.items():
+        _area_analytics.set((area_hash, axes_version), analytics)
+    return results
+
+
+def simplify_for_analytics(area: Area) -> dict:
+    '''drop area details finer than analytics resolution, insights-api gets less to parse and intersect'''
+    if not settings.GEOMETRY_SIMPLIFY:
+        return area.geojson
+    try:
+        with metrics.timer('geometry.simplify'):
+            simplified, vertices, simplified_vertices = simplify_area(
+                area.geojson,
+                settings.GEOMETRY_SIMPLIFY_MAX_RESOLUTION,
+                settings.GEOMETRY_SIMPLIFY_MAX_CELLS,
+                settings.GEOMETRY_MAX_VERTICES,
+                bbox=area.bbox,
+                vertices=area.vertices,
+            )
+    except (KeyError, TypeError, ValueError, IndexError, AttributeError):
+        # not a valid geometry, it's up to insights-api to reject it
+        return area.geojson
+    metrics.inc('geometry.vertices_in', vertices)
+    metrics.inc('geometry.vertices_out', simplified_vertices)
+    if simplified_vertices < vertices:
+        bytes_in, bytes_out = len(json.dumps(area.geojson)), len(json.dumps(simplified))
+        metrics.inc('geometry.bytes_in', bytes_in)
+        metrics.inc('geometry.bytes_out', bytes_out)
+        LOGGER.debug('simplified area from %s to %s vertices, %s to %s bytes',
+                     vertices, simplified_vertices, bytes_in, bytes_out)
+    return simplified
 
 
 def get_analytics_resolution(data: dict) -> int:
@@ -94,81 +267,120 @@ def get_analytics_resolution(data: dict) -> int:
         return item['resolution']
 
 
-async def get_analytics_sentences(selected_area: dict, reference_area: dict) -> tuple[list[str], str]:
+def prefetch_analytics(selected_area: Area, authorized: asyncio.Event) -> asyncio.Task:
     '''
-    accepts selected_area and reference_area as geojson.
+    start fetching analytics of selected area and the world before the request is authorized.
+    only cached analytics of selected area are looked up until authorized is set,
+    the area isn't simplified and insights-api isn't queried for a request that may be rejected.
+    the task is passed to get_analytics_sentences, or cancelled if the request is rejected
+    '''
+    async def get_cached() -> dict | None:
+        catalog = await get_axes()
+        analytics = _area_analytics.get((selected_area.hash, catalog.version))
+        if analytics is None:
+            analytics = (await _get_stored_analytics([selected_area.hash], catalog.version)).get(selected_area.hash)
+        return analytics
+
+    async def fetch() -> dict:
+        analytics, _ = await asyncio.gather(get_cached(), world_analytics.get())
+        if analytics is None:
+            await authorized.wait()
+            (analytics,) = await get_areas_analytics([selected_area])
+        return analytics
+    task = asyncio.create_task(fetch())
+    # errors of a task that is never awaited aren't logged as unretrieved
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+
+async def get_analytics_sentences(
+        selected_area: Area,
+        reference_area: Area | None,
+        prefetched: asyncio.Task = None,
+) -> tuple[list[str], list[tuple[str, str]]]:
+    '''
+    accepts selected_area and optional reference_area,
+    prefetched is prefetch_analytics task of the selected_area if it's started already.
     returns tuple:
         - textual description of indicators stats for selected_area compared to world and reference_area
-        - descriptions of indicators used in stats
+        - (label, description) of the indicator of every sentence
     '''
-    headers = {
-        'User-Agent': settings.USER_AGENT,
-    }
-    async with ClientSession(headers=headers) as session:
-        selected_task = asyncio.create_task(
-            query_insights_api(session, advanced_analytics_graphql, selected_area)
+    if prefetched is None:
+        # areas missing in the cache are requested from insights-api in one query
+        areas = [selected_area, reference_area] if reference_area else [selected_area]
+        # world analytics are served from cache, the task waits only for the first load
+        (analytics_selected_area, *rest), _ = await asyncio.gather(
+            get_areas_analytics(areas),
+            world_analytics.get(),
         )
-        world_task = asyncio.create_task(
-            query_insights_api(session, advanced_analytics_graphql)
-        )
-        axes_task = asyncio.create_task(
-            query_insights_api(session, axis_graphql)
-        )
-        tasks = [selected_task, world_task, axes_task]
-
-        reference_task = None
-        if reference_area:
-            reference_task = asyncio.create_task(
-                query_insights_api(session, advanced_analytics_graphql, reference_area)
-            )
-            tasks.append(reference_task)
-
-        analytics_selected_area, analytics_world, axes, *rest = await asyncio.gather(*tasks)
-        LOGGER.debug('got selected_area analytics with resolution %s', get_analytics_resolution(analytics_selected_area))
-        LOGGER.debug('got world analytics')
-        LOGGER.debug('got axes')
         analytics_reference_area = rest[0] if reference_area else {}
-        if reference_area:
-            LOGGER.debug('got reference_area analytics with resolution %s', get_analytics_resolution(analytics_reference_area))
-
-    metadata = {}
-    for axis in axes['data']['getAxes']['axis']:
-        num, den = axis['quotients']
-        if num['name'] not in metadata:
-            metadata[num['name']] = {
-                'unit': num['unit']['longName'],
-                'emoji': num['emoji'],
-                'label': num['label'],
-                'description': num['description'],
-            }
-    calculations_world = flatten_analytics(analytics_world, metadata)
-    calculations_selected_area = flatten_analytics(analytics_selected_area, metadata)
-    calculations_reference_area = flatten_analytics(analytics_reference_area, metadata) if reference_area else {}
-    sorted_calculations = get_sorted_area_stats(calculations_world, calculations_selected_area, calculations_reference_area)
-
-    # select descriptions of indicators that got included in sorted_calculations
-    descriptions = {
-        metadata[x['numerator']]['label']: metadata[x['numerator']]['description']
-        for x in sorted_calculations
-    }
-    descriptions_txt = '''
-        Here are descriptions for indicators:
-    ''' + ';\n'.join(f'{k}: {v}' for k, v in descriptions.items() if v)
-
-    return to_readable_sentence(sorted_calculations, calculations_world, calculations_reference_area), descriptions_txt
-
-
-async def query_insights_api(session: ClientSession, query: str, geojson=None) -> dict:
+    elif reference_area and reference_area.hash != selected_area.hash:
+        # selected area and world are on the way, reference area is requested separately
+        analytics_selected_area, (analytics_reference_area,) = await asyncio.gather(
+            prefetched,
+            get_areas_analytics([reference_area]),
+        )
+    else:
+        analytics_selected_area = await prefetched
+        analytics_reference_area = analytics_selected_area if reference_area else {}
+    catalog = await get_axes()
+    LOGGER.debug('got selected_area analytics with resolution %s', get_analytics_resolution(analytics_selected_area))
+    if reference_area:
+        LOGGER.debug('got reference_area analytics with resolution %s', get_analytics_resolution(analytics_reference_area))
+
+    metadata = catalog.metadata
+    interned = get_interned(catalog)
+    calculations_world = await get_world_calculations(catalog)
+    selected_area_table = AnalyticsTable(analytics_selected_area, metadata, interned)
+    reference_area_table = AnalyticsTable(analytics_reference_area, metadata, interned) if reference_area else None
+    sorted_calculations = rank_area_stats(
+        calculations_world, selected_area_table, reference_area_table, settings.MAX_ANALYTICS_SENTENCES)
+    # sentences are composed from dicts, only the selected rows and their world and reference values are converted
+    keys = [(x.calculation, x.numerator, x.denominator) for x in sorted_calculations]
+    world_rows = {key: calculations_world[key].as_dict() for key in keys if key in calculations_world}
+    reference_rows = {
+        key: x.as_dict() for key, x in reference_area_table.rows(keys).items()
+    } if reference_area else {}
+
+    starts = []
+    sentences = to_readable_sentence(
+        [x.as_dict() for x in sorted_calculations], world_rows, reference_rows, get_sentence_formatters(catalog), starts)
+    # description of the indicator of every sentence, the prompt includes them only for sentences that fit into it
+    descriptions = [
+        (metadata[x['numerator']]['label'], metadata[x['numerator']]['description'])
+        for x in starts
+    ]
+    return sentences, descriptions
+
+
+async def query_polygon_statistic(session: ClientSession, areas: list[dict | None]) -> list[dict]:
     '''
-    send graphql query to insights-api service for provided geojson
+    polygonStatistic analytics for every area, None area means the world.
+    every result has the shape of a response for a single polygonStatistic query
     '''
-    if '%s' in query:
-        # that means query requires polygon as parameter
-        geojson = json.dumps(geojson) if geojson else '{"type":"FeatureCollection","features":[]}'
-        query = query % geojson.replace('\\', '\\\\').replace('"','\\"')
-        #LOGGER.debug(query)
+    aliases = [f'area{i}' for i in range(len(areas))]
+    polygons = [json.dumps(area) if area else EMPTY_POLYGON for area in areas]
+    if settings.INSIGHTS_API_BATCH_QUERIES:
+        batches = [list(zip(aliases, polygons))]
+    else:
+        batches = [[(alias, polygon)] for alias, polygon in zip(aliases, polygons)]
+    responses = await asyncio.gather(*(
+        query_insights_api(session, polygon_statistic_graphql([a for a, _ in batch]), dict(batch))
+        for batch in batches
+    ))
+    data = {alias: value for response in responses for alias, value in response['data'].items()}
+    return [{'data': {'polygonStatistic': data[alias]}} for alias in aliases]
+
+
+async def query_insights_api(session: ClientSession, query: str, variables: dict = None) -> dict:
+    '''
+    send graphql query to insights-api service
+    '''
+    payload = {'query': query}
+    if variables:
+        payload['variables'] = variables
     LOGGER.debug('requesting %s...', settings.INSIGHTS_API_URL)
-    async with session.post(settings.INSIGHTS_API_URL, json={'query': query}) as resp:
+    async with session.post(settings.INSIGHTS_API_URL, json=payload, timeout=INSIGHTS_API_TIMEOUT) as resp:
         if resp.status != 200:
             raise HTTPException(status_code=resp.status)
         data = await resp.json()
@@ -178,12 +390,13 @@ async def query_insights_api(session: ClientSession, query: str, geojson=None) -
         return data
 
 
-def flatten_analytics(data: dict, metadata: dict) -> dict[tuple, dict]:
+def flatten_analytics(data: dict, metadata: Mapping[str, dict], interned: Interned = None) -> dict[tuple, Calculation]:
     '''
     flatten advancedAnalytics response for the world or selected area, add units & emoji
-    and return a dict (calculation, numerator, denominator) -> {calc_data}
+    and return a dict (calculation, numerator, denominator) -> Calculation
     '''
-
+    if interned is None:
+        interned = Interned()
     calculations_world = {}
     for item in data['data']['polygonStatistic']['analytics']['advancedAnalytics']:
         numerator = item['numerator']
@@ -197,6 +410,7 @@ def flatten_analytics(data: dict, metadata: dict) -> dict[tuple, dict]:
 
         if numeratorLabel == "Population (previous version)":
             continue
+        axis = interned.axis(item, metadata)
 
         # Iterate over each 'analytics' entry and add a dictionary for each calculation to the list
         for analytic in item['analytics']:
@@ -218,63 +432,149 @@ def flatten_analytics(data: dict, metadata: dict) -> dict[tuple, dict]:
                     # layers of low interpretability and strange dimensionality (ppl/km, ppl*day/km2)
                     continue
 
-            value = analytic['value']
-            quality = analytic['quality']
-            calculations_world[(calculation, numerator, denominator)] = {
-                'numerator': numerator,
-                'denominator': denominator,
-                'numeratorLabel': numeratorLabel,
-                'denominatorLabel': denominatorLabel,
-                'calculation': calculation,
-                'value': value,
-                'quality': quality,
-                'emoji': metadata[numerator]['emoji'],
-                'numeratorUnit': metadata[numerator]['unit'],
-                'denominatorUnit': metadata[denominator]['unit'],
-            }
+            key = interned.keys[interned.key_id((calculation, numerator, denominator))]
+            calculations_world[key] = Calculation(
+                axis, calculation, analytic['value'], analytic['quality'])
     return calculations_world
 
 
-def calc_sigma(calculations: dict, ref: dict, world: dict, key: tuple) -> float:
+class AnalyticsTable:
     '''
-    Calculate the sigma value for the 'mean' calculation type.
-
-    Sigma is computed as the absolute difference between the mean values from
-    two different polygons, divided by the standard deviation. This results in
-    a dimensionless value that can be used for sorting different types of measurements
+    advancedAnalytics of an area flattened into columns, filtered like flatten_analytics.
+    rows are in response order, only rows that make it into the prompt are turned into Calculation
     '''
-    stddev_key = 'stddev', *key[1:]
-    if key[0] != 'mean' or key not in ref or stddev_key not in world:
-        return 0
-
-    return abs(
-        (calculations['value'] - ref[key]["value"]) /
-        world[stddev_key]["value"]
-    )
-
-
-def get_sorted_area_stats(
-        calculations_world: dict[tuple, dict],
-        calculations_selected_area: dict[tuple, dict],
-        calculations_reference_area: dict[tuple, dict],
-) -> list[dict]:
+    __slots__ = ('keys', 'values', 'qualities', 'axes', 'means', 'interned', 'rows_by_id')
+
+    def __init__(self, data: dict, metadata: Mapping[str, dict], interned: Interned = None):
+        self.interned = interned = interned if interned is not None else Interned()
+        # (calculation, numerator, denominator) per row, interned
+        self.keys: list[tuple] = []
+        self.values: list[float] = []
+        self.qualities: list[float] = []
+        # AxisLabels per row, interned
+        self.axes: list = []
+        # rows of mean calculation, the only ones with sigma
+        self.means: list[int] = []
+        # interned key id -> row
+        self.rows_by_id: list[int | None] = []
+        ids = interned.ids
+
+        for item in data['data']['polygonStatistic']['analytics']['advancedAnalytics']:
+            numerator = item['numerator']
+            if numerator not in metadata:
+                continue
+            numerator_label = item['numeratorLabel']
+            denominator_label = item['denominatorLabel']
+            if numerator_label == "Population (previous version)":
+                continue
+            if denominator_label == 'Area' and ('Man-days' in numerator_label or 'Man-distance' in numerator_label):
+                continue
+            is_date = metadata[numerator]['unit'] == 'date'
+            if is_date and denominator_label != '1':
+                continue
+            denominator = item['denominator']
+            axis = interned.axis(item, metadata)
+            for analytic in item['analytics']:
+                value = analytic.get('value')
+                if value is None:
+                    continue
+                calculation = analytic['calculation']
+                if is_date and calculation == 'sum':
+                    continue
+                key = calculation, numerator, denominator
+                key_id = ids.get(key)
+                if key_id is None:
+                    key_id = interned.key_id(key)
+                if key_id >= len(self.rows_by_id):
+                    self.rows_by_id.extend([None] * (len(interned.keys) - len(self.rows_by_id)))
+                row = self.rows_by_id[key_id]
+                if row is None:
+                    row = self.rows_by_id[key_id] = len(self.keys)
+                    if calculation == 'mean':
+                        self.means.append(row)
+                    self.keys.append(interned.keys[key_id])
+                    self.values.append(value)
+                    self.qualities.append(analytic['quality'])
+                    self.axes.append(axis)
+                else:
+                    # repeated key keeps its first position, like a dict does
+                    self.values[row] = value
+                    self.qualities[row] = analytic['quality']
+                    self.axes[row] = axis
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key: tuple) -> int | None:
+        key_id = self.interned.ids.get(key)
+        if key_id is None or key_id >= len(self.rows_by_id):
+            return None
+        return self.rows_by_id[key_id]
+
+    def value(self, key: tuple) -> float | None:
+        row = self.find(key)
+        return None if row is None else self.values[row]
+
+    def row(self, row: int) -> Calculation:
+        return Calculation(self.axes[row], self.keys[row][0], self.values[row], self.qualities[row])
+
+    def rows(self, keys) -> dict[tuple, Calculation]:
+        return {key: self.row(row) for key in keys if (row := self.find(key)) is not None}
+
+
+def rank_area_stats(
+        calculations_world: dict[tuple, Calculation],
+        selected_area: AnalyticsTable,
+        reference_area: AnalyticsTable | None,
+        limit: int,
+) -> list[Calculation]:
     '''
-    add sigma to area analytics compared to the world mean metric
-    and return a list [{calc_data}] sorted by quality, sigma, numerator & value.
-    max list size = MAX_ANALYTICS_SENTENCES
+    top rows of the selected area sorted by quality bucket, sigma against the reference area,
+    sigma against the world, numerator and value, without sorting every row.
+    rows are grouped by quality bucket, and within a bucket rows with sigma go first:
+    only mean rows have sigma, they are sorted, other rows are picked by (numerator, value) top-K
     '''
-    for key, v in calculations_selected_area.items():
-        v['world_sigma'] = calc_sigma(v, calculations_world, calculations_world, key)
-        v['reference_area_sigma'] = calc_sigma(v, calculations_reference_area, calculations_world, key)
-
-    # Sort the list of calculations by the absolute value of the quality in ascending order
-    return sorted(calculations_selected_area.values(), key=lambda x: (
-        int(abs(x['quality']) / 2) * 2,
-        -x['reference_area_sigma'],  # <- will be the same for all rows if reference_area is None
-        -x['world_sigma'],
-        x['numerator'],
-        x['value']
-    ))[:settings.MAX_ANALYTICS_SENTENCES]
+    keys, values = selected_area.keys, selected_area.values
+    world_sigma, reference_area_sigma = {}, {}
+    for row in selected_area.means:
+        _, numerator, denominator = key = keys[row]
+        stddev = calculations_world.get(('stddev', numerator, denominator))
+        if stddev is None:
+            continue
+        world = calculations_world.get(key)
+        if world is not None and (sigma := abs((values[row] - world.value) / stddev.value)):
+            world_sigma[row] = sigma
+        reference = reference_area.value(key) if reference_area else None
+        if reference is not None and (sigma := abs((values[row] - reference) / stddev.value)):
+            reference_area_sigma[row] = sigma
+    has_sigma = world_sigma.keys() | reference_area_sigma.keys()
+
+    buckets: dict[int, list[int]] = {}
+    for row, quality in enumerate(selected_area.qualities):
+        buckets.setdefault(int(abs(quality) / 2) * 2, []).append(row)
+
+    top = []
+    for bucket in sorted(buckets):
+        if len(top) >= limit:
+            break
+        rows = buckets[bucket]
+        top += sorted((row for row in rows if row in has_sigma), key=lambda row: (
+            -reference_area_sigma.get(row, 0),
+            -world_sigma.get(row, 0),
+            keys[row][1],
+            values[row],
+        ))
+        if len(top) < limit:
+            plain = [row for row in rows if row not in has_sigma]
+            top += heapq.nsmallest(limit - len(top), plain, key=lambda row: (keys[row][1], values[row]))
+
+    result = []
+    for row in top[:limit]:
+        entry = selected_area.row(row)
+        entry.world_sigma = world_sigma.get(row, 0)
+        entry.reference_area_sigma = reference_area_sigma.get(row, 0)
+        result.append(entry)
+    return result
 
 
 def unit_to_str(entry: dict, sigma=False):
@@ -323,90 +623,127 @@ def unit_to_str(entry: dict, sigma=False):
     return s
 
 
+def format_number(x: float) -> str:
+    # Format the value to be more readable, especially handling scientific notation.
+    return f'{x:,.2f}' if x > 1e-3 else f'{x:.2e}'
+
+
+class SentenceFormatter:
+    '''
+    parts of analytics sentence that depend only on the axis of the entry:
+    axis label, unit suffix and the way values are formatted
+    '''
+    __slots__ = ('axis', 'unit', 'dates')
+
+    def __init__(self, entry: Mapping):
+        numerator_label = entry['numeratorLabel']
+        if entry['emoji']:
+            numerator_label = entry['emoji'] + ' ' + numerator_label
+        denominator_label = '' if entry['denominatorLabel'] == '1' else ' over ' + entry['denominatorLabel']
+        self.axis = numerator_label + denominator_label
+        self.unit = unit_to_str(entry)
+        self.dates = entry['numeratorUnit'] == 'date' and entry['denominatorLabel'] == '1'
+
+    def value(self, x: float | None, calculation: str) -> str:
+        if x is None:
+            return ''
+        if self.dates and x < 2000000000:
+            if calculation == 'stddev':
+                return str(timedelta(seconds=int(x)))
+            # Timestamp values are delivered in UTC. Include the 'Z' suffix to
+            # explicitly denote the UTC 00 offset.
+            return (
+                datetime.fromtimestamp(int(x), tz=timezone.utc)
+                .isoformat()
+                .replace('+00:00', 'Z')
+            )
+        return format_number(x) + self.unit
+
+
 def value_to_str(x: float, entry: dict, sigma=False):
     if x is None:
         return ''
+    if sigma:
+        return format_number(x)
+    return SentenceFormatter(entry).value(x, entry['calculation'])
 
-    if (not sigma
-            and entry['numeratorUnit'] == 'date'
-            and entry['denominatorLabel'] == '1'
-            and x < 2000000000):
-        if entry['calculation'] == 'stddev':
-            return str(timedelta(seconds=int(x)))
-        # Timestamp values are delivered in UTC. Include the 'Z' suffix to
-        # explicitly denote the UTC 00 offset.
-        return (
-            datetime.fromtimestamp(int(x), tz=timezone.utc)
-            .isoformat()
-            .replace('+00:00', 'Z')
-        )
 
-    unit_str = unit_to_str(entry, sigma)
-    # Format the value to be more readable, especially handling scientific notation.
-    return (f'{x:,.2f}' if x > 1e-3 else f'{x:.2e}') + unit_str
+def build_sentence_formatters(catalog: AxesCatalog) -> Mapping[tuple, SentenceFormatter]:
+    '''(numerator, denominator) -> SentenceFormatter of every axis of the catalog'''
+    formatters = {}
+    for axis in catalog.axes:
+        numerator, denominator = axis['quotients']
+        formatters[numerator['name'], denominator['name']] = SentenceFormatter({
+            'numeratorLabel': numerator['label'],
+            'denominatorLabel': denominator['label'],
+            'emoji': numerator['emoji'],
+            'numeratorUnit': numerator['unit']['longName'],
+            'denominatorUnit': denominator['unit']['longName'],
+        })
+    return MappingProxyType(formatters)
+
+
+def get_sentence_formatters(catalog: AxesCatalog) -> Mapping[tuple, SentenceFormatter]:
+    # formatters depend only on axes, they are built once per catalog version and shared read-only
+    return catalog.derive('sentence_formatters', build_sentence_formatters)
 
 
 def to_readable_sentence(
         selected_area_data: list[dict],
         world_data: dict[tuple, dict],
         reference_area_data: dict[tuple, dict] = None,
+        formatters: Mapping[tuple, SentenceFormatter] = None,
+        starts: list = None,
 ) -> list[str]:
     '''
     compose a list of readable sentences that describe analytics
-    for selected_area, world and reference_area
+    for selected_area, world and reference_area.
+    formatters are (numerator, denominator) -> SentenceFormatter, e.g. get_sentence_formatters(catalog),
+    formatters of other axes are built from entries for this call.
+    entries of the same axis in a row make one sentence, the first entry of every sentence is appended to starts
     '''
+    formatters = formatters or {}
+    built = {}
+    reference_area_data = reference_area_data or {}
     readable_sentences = []
     prev_axis = None
 
     # selected_area_data is sorted by importance
     for entry in selected_area_data:
-        numerator_label = entry['numeratorLabel']
-        if entry['emoji']:
-            numerator_label = entry['emoji'] + ' ' + numerator_label
-
-        denominator_label = " over " + entry['denominatorLabel']
-        if entry['denominatorLabel'] == "1":
-            denominator_label = ""
+        calculation_type = entry['calculation']
+        key = calculation_type, entry['numerator'], entry['denominator']
+        axis_key = entry['numerator'], entry['denominator']
+        formatter = formatters.get(axis_key) or built.get(axis_key)
+        if formatter is None:
+            formatter = built[axis_key] = SentenceFormatter(entry)
 
-        calculation_type = entry['calculation'] #.capitalize()
-
-        value = entry['value']
-        value_str = value_to_str(value, entry)
-
-        key = entry['calculation'], entry['numerator'], entry['denominator']
+        value_str = formatter.value(entry['value'], calculation_type)
 
         # compare with world
         world_value = world_data.get(key, {}).get('value')
-        world_value_formatted = value_to_str(world_value, entry)
+        world_value_formatted = formatter.value(world_value, calculation_type)
         world_sigma_str = ""
         if entry["world_sigma"]:
-            world_sigma_str = ', ' + value_to_str(entry['world_sigma'], entry, sigma=True) + ' sigma'
+            world_sigma_str = ', ' + format_number(entry['world_sigma']) + ' sigma'
         world_str = f' (globally {world_value_formatted}{world_sigma_str})' if world_value_formatted else ''
 
         # compare with reference_area
-        reference_area_value = (reference_area_data or {}).get(key, {}).get('value')
-        reference_area_value_formatted = value_to_str(reference_area_value, entry)
+        reference_area_value = reference_area_data.get(key, {}).get('value')
+        reference_area_value_formatted = formatter.value(reference_area_value, calculation_type)
         reference_area_sigma_str = ""
         if entry["reference_area_sigma"]:
-            reference_area_sigma_str = ', ' + value_to_str(entry['reference_area_sigma'], entry, sigma=True) + ' sigma'
+            reference_area_sigma_str = ', ' + format_number(entry['reference_area_sigma']) + ' sigma'
         reference_area_str = f' (reference_area {reference_area_value_formatted}{reference_area_sigma_str})' if reference_area_value_formatted else ''
 
-        #quality = entry['quality']
-        #quality = (quality + world_data[key]["quality"])/2
-        #quality_str = f"{abs(quality):.2f}"
-
-        sentence = (
-            f"{calculation_type} of {numerator_label}{denominator_label} is {value_str}{reference_area_str}{world_str}"
-            #f"with a quality metric of {quality_str}."
-        )
         # example: mean of Air temperature (min) is 15.73 (globally 1.03) (15.73 sigma)
-
-        if prev_axis == f'{numerator_label}{denominator_label}':
-            sentence = f', {calculation_type} is {value_str}{reference_area_str}{world_str}'
-            readable_sentences[-1] += sentence
+        if prev_axis == formatter.axis:
+            readable_sentences[-1] += f', {calculation_type} is {value_str}{reference_area_str}{world_str}'
         else:
-            readable_sentences.append(sentence)
+            readable_sentences.append(
+                f"{calculation_type} of {formatter.axis} is {value_str}{reference_area_str}{world_str}")
+            if starts is not None:
+                starts.append(entry)
 
-        prev_axis = f'{numerator_label}{denominator_label}'
+        prev_axis = formatter.axis
 
     return readable_sentences
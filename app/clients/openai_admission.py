@@ -0,0 +1,222 @@
+'''
+Admission of LLM calls of a worker by OpenAI rate limits.
+
+Rate-limit headers of every OpenAI response update request and token
+budgets of the organization. Admitted calls take their estimated tokens
+from the budget until the next headers correct it. Like OpenAI does, the
+budget is refilled continuously, by its limit per OPENAI_RATE_LIMIT_WINDOW.
+A call is admitted while the budgets cover it and the worker has a free slot. Waiting calls are queued by priority,
+round-robin between apps within a priority, and fail with 503 after their
+deadline.
+'''
+import asyncio
+import itertools
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+import httpx
+from starlette.exceptions import HTTPException
+
+from app import metrics
+from app.logger import LOGGER
+from app.settings import Settings
+
+settings = Settings()
+
+# calls users are waiting for go before background ones like cache warming
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+def parse_duration(value: str | None) -> float | None:
+    '''seconds of rate limit reset like "1s", "6m0s" or "20ms"'''
+    if not value:
+        return None
+    parts = _DURATION.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+class Budget:
+    '''
+    requests or tokens of a rate limit, unknown until the first response.
+    the limit is replenished continuously over window seconds, not at once when the reset header is due
+    '''
+    __slots__ = ('limit', 'remaining', 'updated_at', 'window')
+
+    def __init__(self, window: float = 60.0):
+        self.limit: int | None = None
+        self.remaining: float | None = None
+        self.updated_at = 0.0
+        self.window = window
+
+    def update(self, limit: str | None, remaining: str | None, now: float):
+        try:
+            remaining = int(remaining)
+            limit = int(limit) if limit else self.limit
+        except (TypeError, ValueError):
+            return
+        self._refill(now)
+        self.limit = limit
+        if self.remaining is not None:
+            # response of an earlier request doesn't count calls admitted after it
+            remaining = min(remaining, self.remaining)
+        self.remaining = remaining
+
+    def _refill(self, now: float):
+        if self.remaining is not None and self.limit:
+            self.remaining = min(self.remaining + self.limit * (now - self.updated_at) / self.window, self.limit)
+        self.updated_at = now
+
+    def wait(self, needed: int, now: float) -> float:
+        '''seconds until needed is available, 0 if it's available now'''
+        self._refill(now)
+        if self.remaining is None or not self.limit:
+            return 0.0
+        # call larger than the whole budget goes alone
+        needed = min(needed, self.limit)
+        if self.remaining >= needed:
+            return 0.0
+        return max((needed - self.remaining) * self.window / self.limit, 0.001)
+
+    def take(self, used: int):
+        if self.remaining is not None:
+            self.remaining -= used
+
+
+class _Waiter:
+    __slots__ = ('key', 'priority', 'tokens', 'future', 'queued_at', 'seq')
+
+    def __init__(self, key: Hashable, priority: int, tokens: int, seq: int):
+        self.key = key
+        self.priority = priority
+        self.tokens = tokens
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.seq = seq
+
+
+class Admission:
+
+    def __init__(self, name: str, max_concurrency: int, window: float = 60.0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.requests = Budget(window)
+        self.tokens = Budget(window)
+        self.paused_until = 0.0
+        self.in_flight = 0
+        # priority -> key of app -> waiters of the app
+        self._queues: dict[int, dict[Hashable, deque[_Waiter]]] = {}
+        # key of app -> sequence number of its last admitted call
+        self._served: dict[Hashable, int] = {}
+        self._seq = itertools.count(1)
+        self._timer: asyncio.TimerHandle | None = None
+        metrics.register_gauge(f'{name}.queue_depth', lambda: self.queued)
+        metrics.register_gauge(f'{name}.in_flight', lambda: self.in_flight)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for queue in self._queues.values() for waiters in queue.values())
+
+    def on_headers(self, status: int, headers: httpx.Headers):
+        '''update budgets from rate-limit headers of a response'''
+        now = time.monotonic()
+        for budget, kind in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+            budget.update(
+                headers.get(f'x-ratelimit-limit-{kind}'),
+                headers.get(f'x-ratelimit-remaining-{kind}'),
+                now,
+            )
+        if status == 429:
+            metrics.inc(f'{self.name}.rate_limited')
+            retry_after = parse_duration(headers.get('retry-after')) or 1.0
+            self.paused_until = max(self.paused_until, now + retry_after)
+            LOGGER.warning('OpenAI rate limit is reached, calls are paused for %.1f seconds', retry_after)
+        self._dispatch()
+
+    def _wait(self, waiter: _Waiter, now: float) -> float:
+        return max(
+            self.paused_until - now,
+            self.requests.wait(1, now),
+            self.tokens.wait(waiter.tokens, now),
+        )
+
+    def _dispatch(self):
+        '''admit waiters in the order of priority, round-robin between apps, while budgets allow'''
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self.in_flight < self.max_concurrency:
+            queue = next((self._queues[p] for p in sorted(self._queues) if self._queues[p]), None)
+            if queue is None:
+                return
+            # the app served least recently goes first, then the call waiting longest
+            key = min(queue, key=lambda k: (self._served.get(k, 0), queue[k][0].seq))
+            waiters = queue[key]
+            waiter = waiters[0]
+            now = time.monotonic()
+            if (wait := self._wait(waiter, now)) > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            waiters.popleft()
+            if not waiters:
+                del queue[key]
+            self._served[key] = next(self._seq)
+            self.in_flight += 1
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            metrics.observe(f'{self.name}.queue_wait', now - waiter.queued_at)
+            waiter.future.set_result(None)
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.priority, {})
+        if (waiters := queue.get(waiter.key)) and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del queue[waiter.key]
+
+    def _release(self, waiter: _Waiter):
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, key: Hashable, tokens: int, priority: int = INTERACTIVE, timeout: float = None):
+        '''
+        wait until the call of the app with key is admitted, it's in flight until the context exits.
+        raises HTTPException 503 when it's not admitted within timeout
+        '''
+        waiter = _Waiter(key, priority, tokens, next(self._seq))
+        self._queues.setdefault(priority, {}).setdefault(key, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except BaseException as e:
+            self._remove(waiter)
+            if waiter.future.done():
+                self._release(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.inc(f'{self.name}.queue_timeout')
+                raise HTTPException(status_code=503, detail='OpenAI is busy, try again later')
+            raise
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+
+openai_admission = Admission('openai', settings.OPENAI_MAX_CONCURRENCY, settings.OPENAI_RATE_LIMIT_WINDOW)
+
+
+async def on_openai_response(response: httpx.Response):
+    '''httpx response hook of OpenAI client'''
+    openai_admission.on_headers(response.status_code, response.headers)
@@ -1,218 +1,530 @@
+import abc
 import asyncio
 import hashlib
 import re
+from typing import AsyncIterator, Awaitable, Callable
 
-import asyncpg
+import httpx
+import openai
 from openai import AsyncOpenAI
+from openai.types.beta import Assistant
 from starlette.exceptions import HTTPException
 
-from app.secret import Secret
+from app import llm_cache, metrics
+from app.area import Area
+from app.clients.openai_admission import INTERACTIVE, openai_admission
+from app.clients.openai_registry import get_assistant, get_openai_client
+from app.settings import Settings
 from app.logger import LOGGER
-from app.db import get_db_conn
+from app.singleflight import SingleFlight
+from app.tokens import estimate_tokens
 
-secret = Secret()
+settings = Settings()
+
+llm_flight = SingleFlight('llm')
+
+
+class StreamedParts:
+    '''parts of LLM response streamed by a flight, callers joining it later get the parts sent before'''
+    __slots__ = ('parts', 'changed')
+
+    def __init__(self):
+        self.parts: list[str] = []
+        self.changed = asyncio.Event()
+
+    def append(self, part: str):
+        self.parts.append(part)
+        self.notify()
+
+    def notify(self):
+        # waiters hold the current event, the next change gets a fresh one
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+# (cache key, model) -> parts of the streamed response of the flight in progress
+_streams: dict[tuple, StreamedParts] = {}
+
+RUN_FAILED = ('failed', 'expired', 'cancelled', 'incomplete')
+# prompt is sent as several messages of about that many characters
+MESSAGE_CHUNK_SIZE = 20000
+
+
+def split_prompt(prompt: str, chunk_size: int = MESSAGE_CHUNK_SIZE) -> list[str]:
+    '''split prompt by lines into chunks a bit larger than chunk_size'''
+    chunks = []
+    current_chunk = ''
+    for line in prompt.split('\n'):
+        if len(current_chunk) > chunk_size:
+            chunks.append(current_chunk)
+            current_chunk = ''
+        current_chunk += line + '\n'
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
+def record_usage(usage):
+    '''count prompt tokens of an LLM request and the ones served from prompt cache of OpenAI'''
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) or 0
+    metrics.inc('openai.prompt_tokens', usage.prompt_tokens)
+    metrics.inc('openai.cached_prompt_tokens', cached)
+    LOGGER.info('LLM request used %s prompt tokens, %s of them cached', usage.prompt_tokens, cached)
+
+
+class LLMBackend(abc.ABC):
+    '''
+    the way LLM is asked for the response to a prompt.
+    model, instructions and parameters of the response are taken from the assistant
+    '''
+
+    def __init__(self, client: AsyncOpenAI):
+        self.client = client
+
+    @abc.abstractmethod
+    async def complete(
+            self,
+            assistant: Assistant,
+            prompt: str,
+            instructions: str | None,
+            override_instructions: bool,
+            on_delta: Callable[[str], None] = None,
+    ) -> str:
+        '''
+        response of LLM to the prompt. instructions are appended to the ones of the assistant
+        or replace them with override_instructions, empty ones keep the assistant's instructions
+        '''
+
+
+class AssistantsBackend(LLMBackend):
+    '''run of the assistant in a new thread with the prompt'''
+
+    async def complete(self, assistant, prompt, instructions, override_instructions, on_delta=None) -> str:
+        thread = await self.client.beta.threads.create(
+            messages=[{'role': 'user', 'content': chunk} for chunk in split_prompt(prompt)],
+        )
+
+        # assistant has it's own instructions, but we're able to override them per-run
+        LOGGER.debug('chatGPT instructions: %s', instructions)
+        run_params = {'assistant_id': assistant.id}
+        if instructions:
+            run_params['instructions' if override_instructions else 'additional_instructions'] = instructions
+
+        with metrics.timer('openai.run'):
+            if settings.OPENAI_STREAM_RUNS:
+                message_text, run_id = await stream_run(self.client, thread.id, run_params, on_delta)
+            else:
+                message_text, run_id = await poll_run(self.client, thread.id, run_params)
+        LOGGER.info('completed assistant_id %s, thread_id %s, run_id %s', assistant.id, thread.id, run_id)
+        LOGGER.debug('https://platform.openai.com/playground/assistants?assistant=%s&thread=%s', assistant.id, thread.id)
+
+        return message_text
+
+
+class ChatBackend(LLMBackend):
+    '''
+    one chat completion request with instructions and the prompt.
+    tools of the assistant (file_search, code_interpreter) aren't available to it.
+    usage of the request is reported, streamed responses ask for it in the last chunk
+    '''
+
+    async def complete(self, assistant, prompt, instructions, override_instructions, on_delta=None) -> str:
+        if not override_instructions:
+            instructions = '\n'.join(x for x in (assistant.instructions, instructions) if x)
+        elif not instructions:
+            # like a run without instructions
+            instructions = assistant.instructions
+        messages = [{'role': 'system', 'content': instructions}] if instructions else []
+        messages += [{'role': 'user', 'content': chunk} for chunk in split_prompt(prompt)]
+        params = {'model': assistant.model, 'messages': messages}
+        if assistant.temperature is not None:
+            params['temperature'] = assistant.temperature
+        if assistant.top_p is not None:
+            params['top_p'] = assistant.top_p
+        if assistant.response_format not in (None, 'auto'):
+            params['response_format'] = assistant.response_format.model_dump(by_alias=True, exclude_none=True)
+
+        with metrics.timer('openai.completion'):
+            if on_delta is None:
+                completion = await self.client.chat.completions.create(**params)
+                message_text = completion.choices[0].message.content or ''
+                usage = completion.usage
+            else:
+                parts = []
+                usage = None
+                stream = await self.client.chat.completions.create(
+                    stream=True, stream_options={'include_usage': True}, **params)
+                async with stream:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            usage = chunk.usage
+                        if chunk.choices and (delta := chunk.choices[0].delta.content):
+                            parts.append(delta)
+                            on_delta(delta)
+                message_text = ''.join(parts)
+        record_usage(usage)
+        LOGGER.info('completed chat completion with %s model of assistant_id %s', assistant.model, assistant.id)
+        return message_text
+
+
+BACKENDS = {
+    'assistants': AssistantsBackend,
+    'chat': ChatBackend,
+}
 
 
 class OpenAIClient:
 
-    def __init__(self, assistant_name, instructions=None, override_instructions=False):
-        self.client = AsyncOpenAI(api_key=secret.OPENAI_API_KEY, timeout=40.0)
+    def __init__(
+            self,
+            assistant_name,
+            instructions=None,
+            override_instructions=False,
+            backend='assistants',
+            app_id=None,
+            priority=INTERACTIVE,
+    ):
+        self.client = get_openai_client()
         self.assistant_name = assistant_name
         self.instructions = instructions
         self.override_instructions = override_instructions
-        self._assistant = None
-        self._model = None
+        # LLM calls are queued by OpenAI rate limits fairly between apps
+        self.app_id = app_id
+        self.priority = priority
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown LLM backend {backend}, expected one of: {", ".join(BACKENDS)}')
+        self.backend = BACKENDS[backend](self.client)
 
     @property
     async def assistant(self):
-        if self._assistant:
-            return self._assistant
-
-        LOGGER.debug('looking for %s assistant..', self.assistant_name)
-        self._assistant = [i async for i in self.client.beta.assistants.list() if i.name == self.assistant_name][0]
-        LOGGER.debug('chatGPT model: %s', self._assistant.model)
-        return self._assistant
+        return await get_assistant(self.assistant_name)
 
     @property
     async def model(self):
         assistant = await self.assistant
         return assistant.model
 
-    async def get_llm_response_from_cache(self, conn, cache_key, llm_model):
-        return await conn.fetchval(
-            'select response from llm_cache where hash = $1 and model_name = $2 and response is not null',
-            cache_key, llm_model)
-
-    async def get_cached_llm_commentary(self, prompt: str) -> str:
+    def get_cache_key(self, prompt: str) -> tuple[str, str]:
         to_cache = f'instructions: {self.instructions}; prompt: {prompt}'
         #LOGGER.debug('\n'.join(prompt.split(';')).replace('"', '\\"'))
-        cache_key = hashlib.md5(to_cache.encode("utf-8")).hexdigest()
+        return to_cache, hashlib.md5(to_cache.encode("utf-8")).hexdigest()
+
+    async def get_cached_llm_commentary(self, prompt: str) -> str:
+        to_cache, cache_key = self.get_cache_key(prompt)
         llm_model = await self.model
+        # equal concurrent requests of the worker share one cache lookup and LLM call
+        return await llm_flight.do(
+            (cache_key, llm_model),
+            lambda: self._get_cached_llm_commentary(prompt, to_cache, cache_key, llm_model),
+        )
 
-        conn = await get_db_conn()
-        if result := await self.get_llm_response_from_cache(conn, cache_key, llm_model):
-            await conn.close()
+    async def _get_cached_or_lease(self, to_cache: str, cache_key: str, llm_model: str, owner: str) -> str | None:
+        '''
+        returns cached response or response saved by other worker,
+        or None when the lease is acquired by owner and LLM should be asked
+        '''
+        if result := await llm_cache.get_response(cache_key, llm_model):
             LOGGER.debug('found LLM response for %s model in the cache', llm_model)
             return result
 
-        tr = conn.transaction()
-        await tr.start()
-        try:
-            # two equal queries will block, the second will fail with duplicate key error
-            await conn.execute(
-                'insert into llm_cache (hash, request, response, model_name) values ($1, $2, $3, $4)',
-                cache_key, to_cache, None, llm_model,
-            )
-        except asyncpg.exceptions.UniqueViolationError:
-            # other transaction saved an LLM response first, return it
-            await tr.rollback()
-            LOGGER.debug('return response committed by other transaction')
-            result = await self.get_llm_response_from_cache(conn, cache_key, llm_model)
-            await conn.close()
+        deadline = asyncio.get_running_loop().time() + settings.LLM_CACHE_WAIT_TIMEOUT
+        while not await llm_cache.acquire_lease(cache_key, to_cache, llm_model, owner):
+            # other worker is asking LLM for the same prompt or has already saved the response
+            try:
+                result = await llm_cache.wait_for_response(cache_key, llm_model, deadline)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail='timeout waiting for OpenAI response')
+            if result is not None:
+                LOGGER.debug('return response saved by other worker')
+                return result
+            LOGGER.debug('lease for hash = %s expired, taking it over', cache_key)
+        return None
+
+    async def _get_cached_llm_commentary(
+            self, prompt: str, to_cache: str, cache_key: str, llm_model: str, on_delta: Callable[[str], None] = None,
+    ) -> str:
+        owner = llm_cache.new_lease_owner()
+        if result := await self._get_cached_or_lease(to_cache, cache_key, llm_model, owner):
             return result
 
         LOGGER.debug('asking LLM for commentary..')
-        llm_response = await self.get_llm_commentary(prompt)
-        await conn.execute(
-            'update llm_cache set response = $1 where hash = $2 and model_name = $3',
-            llm_response, cache_key, llm_model,
-        )
-        await tr.commit()
-        await conn.close()
+        keeper = asyncio.create_task(llm_cache.keep_lease(cache_key, llm_model, owner))
+        try:
+            llm_response = await self.get_llm_commentary(prompt, on_delta)
+        except BaseException:
+            keeper.cancel()
+            await asyncio.shield(llm_cache.release_lease(cache_key, llm_model, owner))
+            raise
+        keeper.cancel()
+        await llm_cache.complete_lease(cache_key, llm_model, owner, llm_response)
         LOGGER.debug('saved LLM response for hash = %s and model_name = %s', cache_key, llm_model)
         return llm_response
 
-
-    async def get_llm_commentary(self, prompt: str) -> str:
+    async def stream_cached_llm_commentary(self, prompt: str) -> AsyncIterator[str]:
         '''
-        returns chatGPT response for provided prompt
+        yields parts of LLM response as they are generated, the whole response is saved to the cache.
+        equal concurrent requests of the worker share one LLM call and get all of its parts,
+        cached response, response of other worker and response of a call that isn't streamed are yielded at once.
+        raises HTTPException when the response differs from the parts sent already, e.g. after polling of a broken stream.
+        closing the iterator early cancels the run and releases the lease unless other requests wait for it
         '''
-        thread = await self.client.beta.threads.create()
-        current_chunk = ''
-        for line in prompt.split('\n'):
-            if len(current_chunk) > 20000:
-                message = await self.client.beta.threads.messages.create(
-                    thread_id=thread.id,
-                    role="user",
-                    content=current_chunk
-                )
-                current_chunk = ''
-            current_chunk += line + '\n'
-        if current_chunk:
-            message = await self.client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=current_chunk
-            )
+        to_cache, cache_key = self.get_cache_key(prompt)
+        llm_model = await self.model
+        key = cache_key, llm_model
+        # parts of the call in flight, or of the one started here.
+        # flights that aren't streamed have no parts, their response is yielded at once
+        streamed = _streams.get(key) or StreamedParts()
 
-        # assistant has it's own instructions, but we're able to override them per-run
+        async def stream() -> str:
+            LOGGER.debug('streaming LLM commentary..')
+            try:
+                return await self._get_cached_llm_commentary(prompt, to_cache, cache_key, llm_model, streamed.append)
+            finally:
+                if _streams.get(key) is streamed:
+                    del _streams[key]
+
+        def start() -> Awaitable[str]:
+            _streams[key] = streamed
+            return stream()
+
+        # the flight is joined before anything else runs, so streamed belongs to it
+        call = asyncio.ensure_future(llm_flight.join(key, start))
+        call.add_done_callback(lambda _: streamed.notify())
+        sent = 0
+        try:
+            while True:
+                while sent < len(streamed.parts):
+                    sent += 1
+                    yield streamed.parts[sent - 1]
+                if call.done():
+                    break
+                await streamed.changed.wait()
+            llm_response = call.result()
+        finally:
+            call.cancel()
+        sent = ''.join(streamed.parts[:sent])
+        if not llm_response.startswith(sent):
+            LOGGER.error('LLM response differs from the streamed one')
+            raise HTTPException(status_code=502, detail='OpenAI response changed while it was streamed')
+        if len(llm_response) > len(sent):
+            yield llm_response[len(sent):]
+
+    async def get_llm_commentary(self, prompt: str, on_delta: Callable[[str], None] = None) -> str:
+        '''
+        returns chatGPT response for provided prompt,
+        on_delta is called with parts of the response while it's streamed
+        '''
         assistant = await self.assistant
-        LOGGER.debug('chatGPT instructions: %s', self.instructions)
-        if self.override_instructions:
-            run = await self.client.beta.threads.runs.create(
-                thread_id=thread.id,
-                assistant_id=assistant.id,
-                instructions=self.instructions,
-            )
-        else:
-            run = await self.client.beta.threads.runs.create(
-                thread_id=thread.id,
-                assistant_id=assistant.id,
-                additional_instructions=self.instructions,
-            )
-
-        while not run.status == "completed":
-            await asyncio.sleep(1)
-            run = await self.client.beta.threads.runs.retrieve(
-                thread_id=thread.id,
-                run_id=run.id
-            )
-            LOGGER.debug("openAI thread status: %s", run.status)
-            if run.status in ("failed", "expired"):
+        tokens = estimate_tokens(prompt) + estimate_tokens(self.instructions) + settings.OPENAI_EXPECTED_OUTPUT_TOKENS
+        timeout = settings.OPENAI_QUEUE_TIMEOUT if self.priority == INTERACTIVE else None
+        async with openai_admission.admit(self.app_id, tokens, self.priority, timeout):
+            return await self.backend.complete(assistant, prompt, self.instructions, self.override_instructions, on_delta)
+
+
+def stream_fallback(e: Exception) -> bool:
+    '''streaming errors that polling of the run can recover from'''
+    if isinstance(e, openai.APIStatusError):
+        # stream isn't served, bad requests and rate limits would fail polling as well
+        return e.status_code >= 500 or e.status_code in (404, 405)
+    return True
+
+
+async def cancel_run(client: AsyncOpenAI, thread_id: str, run_id: str):
+    '''stop the run nobody waits for'''
+    try:
+        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        metrics.inc('openai.run_cancelled')
+        LOGGER.debug('cancelled openAI run %s', run_id)
+    except openai.APIError as e:
+        LOGGER.warning('failed to cancel openAI run %s: %s', run_id, e)
+
+
+async def stream_run(
+        client: AsyncOpenAI,
+        thread_id: str,
+        run_params: dict,
+        on_delta: Callable[[str], None] = None,
+) -> tuple[str, str]:
+    '''
+    create the run and follow its events until it's completed.
+    returns text of the last assistant message and run id.
+    the run is polled when streaming isn't available or breaks
+    '''
+    run_id = None
+    message_text = ''
+    try:
+        stream = await client.beta.threads.runs.create(thread_id=thread_id, stream=True, **run_params)
+        async with stream:
+            async for event in stream:
+                if event.event == 'thread.run.created':
+                    run_id = event.data.id
+                elif event.event == 'thread.message.delta':
+                    if on_delta:
+                        for part in event.data.delta.content or ():
+                            if part.type == 'text' and part.text and part.text.value:
+                                on_delta(part.text.value)
+                elif event.event == 'thread.message.completed':
+                    message_text = event.data.content[0].text.value
+                elif event.event == 'thread.run.completed':
+                    record_usage(event.data.usage)
+                    return message_text, run_id
+                elif event.event.removeprefix('thread.run.') in RUN_FAILED:
+                    LOGGER.error('openAI run %s: %s', event.event, event.data.last_error)
+                    raise HTTPException(status_code=400, detail='failed to get OpenAI response')
+    except (openai.APIError, httpx.TransportError) as e:
+        if not stream_fallback(e):
+            raise
+        LOGGER.warning('streaming of openAI run failed, polling it: %s', e)
+    except asyncio.CancelledError:
+        if run_id:
+            await asyncio.shield(cancel_run(client, thread_id, run_id))
+        raise
+    metrics.inc('openai.stream_fallback')
+    if run_id is None:
+        # the run could be created before the stream broke, the thread is new so its latest run is that one
+        runs = await client.beta.threads.runs.list(thread_id=thread_id, limit=1)
+        if runs.data:
+            run_id = runs.data[0].id
+    return await poll_run(client, thread_id, run_params, run_id)
+
+
+async def poll_run(client: AsyncOpenAI, thread_id: str, run_params: dict, run_id: str = None) -> tuple[str, str]:
+    '''
+    create the run unless run_id is given and poll it until it's completed.
+    polls are frequent at first and get rarer for long runs.
+    the run is cancelled and 504 is raised when it isn't completed in OPENAI_RUN_TIMEOUT.
+    returns text of the last assistant message and run id
+    '''
+    if run_id is None:
+        run = await client.beta.threads.runs.create(thread_id=thread_id, **run_params)
+    else:
+        run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    interval = settings.OPENAI_POLL_MIN_INTERVAL
+    deadline = asyncio.get_running_loop().time() + settings.OPENAI_RUN_TIMEOUT
+    try:
+        while not run.status == 'completed':
+            if run.status in RUN_FAILED:
+                LOGGER.error('openAI run %s: %s', run.status, run.last_error)
                 raise HTTPException(status_code=400, detail='failed to get OpenAI response')
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                # e.g. the run requires action or is stuck in the queue
+                LOGGER.error('openAI run %s is still %s, cancelling it', run.id, run.status)
+                await asyncio.shield(cancel_run(client, thread_id, run.id))
+                raise HTTPException(status_code=504, detail='timeout waiting for OpenAI response')
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, settings.OPENAI_POLL_MAX_INTERVAL)
+            run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+            metrics.inc('openai.run_polls')
+            LOGGER.debug('openAI thread status: %s', run.status)
+    except asyncio.CancelledError:
+        await asyncio.shield(cancel_run(client, thread_id, run.id))
+        raise
+    record_usage(run.usage)
 
-        messages = await self.client.beta.threads.messages.list(
-          thread_id=thread.id
-        )
+    messages = await client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, limit=1)
+    message_text = messages.data[0].content[0].text.value if messages.data else ''
+    return message_text, run.id
 
-        message_text = ""
-        for _, message in messages:
-            message_text = message[0].content[0].text.value
-            break
-        LOGGER.info('completed assistant_id %s, thread_id %s, run_id %s', assistant.id, thread.id, run.id)
-        LOGGER.debug('https://platform.openai.com/playground/assistants?assistant=%s&thread=%s', assistant.id, thread.id)
 
-        return message_text
+def squeeze(text: str) -> str:
+    return re.sub(r'\s+', ' ', text)
 
 
-def get_properties(geojson: dict) -> str:
-    '''parse input geojson for 'properties', deduplicate, concatenate, truncate and return'''
-    properties = []
+# static text every analytics prompt starts with, with and without reference area.
+# OpenAI caches prompt prefixes, so requests of any area share the cached instructions.
+# bump the version on changes of the text
+ANALYTICS_PROMPT_VERSION = 2
+ANALYTICS_PROMPT_PREFIX = {
+    True: squeeze('''
+        You are given values for three different areas. Selected region  area is the area you are writing the report about. Reference area is the one picked by user, likely the one that is easy for them to understand, likely being their home or primary region of operation. World values are given to put the difference between selected and reference area into perspective, or to serve as reference when no reference area is given. You may be provided with properties of the geographic objects of selected area and reference area. If properties are not available or lack names, call them "Area you selected" and "Your reference area" respectively. Start report with noting which area you will call what, something like: "Comparing your selected area to your reference area New Zhlobin".
+        Properties of the areas and user's bio follow the description of the areas.
+        Here is the description of the user\'s selected area compared to user\'s reference area and the world:
+    '''),
+    False: squeeze('''
+        Properties of the selected area and user's bio follow the description of the area.
+        Here is the description of the user\'s selected area compared to the world for the reference:
+    '''),
+}
 
-    def extract_properties(gj: dict) -> list:
-        '''
-        Recursively extracts properties from the GeoJSON object and updates properties var.
-        If the object is a FeatureCollection, it iterates over its features
-        and extracts properties from each feature.
-        '''
-        if gj.get('type') == 'FeatureCollection':
-            # Iterate through all features in the FeatureCollection
-            for feature in gj.get('features') or []:
-                # Recursively extract properties from each feature
-                extract_properties(feature)
-            return
-        # The base case: we're at a leaf and extract actual properties
-        properties.append(gj.get('properties'))
-
-    # update `properties` with recursive function
-    extract_properties(geojson)
-    # remove duplicated and empty props
-    deduplicated_properties = set(str(prop) for prop in properties if prop)
-    props_str = ', '.join(deduplicated_properties) or 'not available'
-    max_properties_length = 2000
-    if len(props_str) > max_properties_length:
-        props_str = props_str[:max_properties_length] + '...'
-    # Construct and return the result string with all unique and truncated properties
-    return f'(input GeoJSON properties: {props_str})'
+
+def take_within_budget(items: list[str], budget: int) -> tuple[list[str], int]:
+    '''leading items that fit into budget of tokens with separators, and tokens they take'''
+    taken = []
+    used = 0
+    for item in items:
+        # one token for separator
+        tokens = estimate_tokens(item) + 1
+        if used + tokens > budget:
+            break
+        taken.append(item)
+        used += tokens
+    return taken, used
 
 
 def get_analytics_prompt(
         sentences: list[str],
-        indicator_description: str,
+        descriptions: list[tuple[str, str]],
         bio: str,
         lang: str,
-        selected_area_geojson: dict,
-        reference_area_geojson: dict,
+        selected_area: Area,
+        reference_area: Area | None,
 ) -> str:
-    '''compose prompt to recieve analytics for provided axes'''
-    reference_area_props = get_properties(reference_area_geojson)
-    selected_area_props = get_properties(selected_area_geojson)
-    LOGGER.debug('reference_area geom is %s', 'not empty' if reference_area_geojson else 'empty')
-    LOGGER.debug('selected_area geom is %s', 'not empty' if selected_area_geojson else 'empty')
-    prompt_start = f'Selected area properties: {selected_area_props}'
-
-    if reference_area_geojson == selected_area_geojson:
+    '''
+    compose prompt to recieve analytics for provided axes.
+    sentences go from the most significant, descriptions are (label, description) of the indicator of every sentence.
+    the prompt fits into ANALYTICS_PROMPT_MAX_TOKENS: sentences are included while they fit,
+    then descriptions of indicators of included sentences
+    '''
+    LOGGER.debug('reference_area geom is %s', 'not empty' if reference_area else 'empty')
+    LOGGER.debug('selected_area geom is %s', 'not empty' if selected_area.geojson else 'empty')
+    if reference_area and reference_area.hash == selected_area.hash:
         # compare selected_area only with world
-        reference_area_geojson = None
+        reference_area = None
 
-    if reference_area_geojson:
-        prompt_start += f'''
-            User's reference area properties: {reference_area_props}
-
-            You are given values for three different areas. Selected region  area is the area you are writing the report about. Reference area is the one picked by user, likely the one that is easy for them to understand, likely being their home or primary region of operation. World values are given to put the difference between selected and reference area into perspective, or to serve as reference when no reference area is given. You may be provided with properties of the geographic objects of selected area and reference area. If properties are not available or lack names, call them "Area you selected" and "Your reference area" respectively. Start report with noting which area you will call what, something like: "Comparing your selected area to your reference area New Zhlobin".
-        '''
-    prompt_start += f'''
-        Here is the description of the user\'s selected area compared to '''
-    if reference_area_geojson:
-        prompt_start += f'user\'s reference area and the world:'
-    else:
-        prompt_start += 'the world for the reference:'
-    prompt_end = indicator_description + f'''
+    # prompts of all areas start with the same text, data of the request follows it
+    prompt_start = ANALYTICS_PROMPT_PREFIX[reference_area is not None]
+    descriptions_start = '''
+        Here are descriptions for indicators:
+    '''
+    prompt_end = f'''
+        Selected area properties: {selected_area.properties}'''
+    if reference_area:
+        prompt_end += f'''
+            User's reference area properties: {reference_area.properties}'''
+    prompt_end += f'''
         User wrote in their bio: "{bio}" '''
     if lang:
         prompt_end += f'''
             User have selected a language: {lang}. Answer in that language.
         '''
-    analytics_txt = ';\n'.join(sentences)
+    descriptions_start, prompt_end = squeeze(descriptions_start), squeeze(prompt_end)
+
+    tokens = {
+        'instructions': estimate_tokens(prompt_start) + estimate_tokens(descriptions_start),
+        'user': estimate_tokens(prompt_end),
+    }
+    budget = settings.ANALYTICS_PROMPT_MAX_TOKENS - sum(tokens.values())
+    included, tokens['sentences'] = take_within_budget([squeeze(x) for x in sentences], budget)
+    budget -= tokens['sentences']
+
+    # every indicator is described once
+    indicators = {}
+    for label, description in descriptions[:len(included)]:
+        if description and label not in indicators:
+            indicators[label] = squeeze(f'{label}: {description}')
+    described, tokens['descriptions'] = take_within_budget(list(indicators.values()), budget)
+
+    for section, used in tokens.items():
+        metrics.inc(f'analytics_prompt.tokens.{section}', used)
+    if dropped := len(sentences) - len(included):
+        metrics.inc('analytics_prompt.dropped_sentences', dropped)
+    LOGGER.debug('analytics prompt v%s tokens: %s, sentences: %s of %s, descriptions: %s of %s',
+                 ANALYTICS_PROMPT_VERSION, tokens, len(included), len(sentences), len(described), len(indicators))
 
-    return re.sub(r'\s+', ' ', f'{prompt_start} {analytics_txt} {prompt_end}')
+    analytics_txt = ';\n'.join(included)
+    descriptions_txt = ';\n'.join(described)
+    return squeeze(f'{prompt_start} {analytics_txt} {descriptions_start}{descriptions_txt} {prompt_end}')
@@ -0,0 +1,83 @@
+'''
+OpenAI client and assistants shared by requests of a worker.
+
+The client keeps its connection pool between requests. Assistants are
+resolved by name with one listing for all of them and refreshed in
+background, so requests don't page through assistants list.
+'''
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.types.beta import Assistant
+from starlette.exceptions import HTTPException
+
+from app.cache import RefreshingValue
+from app.clients.openai_admission import BACKGROUND, on_openai_response, openai_admission
+from app.logger import LOGGER
+from app.secret import Secret
+from app.settings import Settings
+
+settings = Settings()
+secret = Secret()
+
+_client: AsyncOpenAI | None = None
+
+
+def create_openai_client() -> AsyncOpenAI:
+    global _client
+    http_client = DefaultAsyncHttpxClient(limits=httpx.Limits(
+        max_connections=settings.HTTP_POOL_LIMIT,
+        max_keepalive_connections=settings.HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_TIMEOUT,
+    ), event_hooks={'response': [on_openai_response]})
+    _client = AsyncOpenAI(
+        api_key=secret.OPENAI_API_KEY,
+        base_url=settings.OPENAI_BASE_URL,
+        timeout=settings.OPENAI_TIMEOUT,
+        http_client=http_client,
+    )
+    return _client
+
+
+async def close_openai_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def get_openai_client() -> AsyncOpenAI:
+    '''client is created in app lifespan, or on first use outside of the app'''
+    if _client is None or _client.is_closed():
+        return create_openai_client()
+    return _client
+
+
+def assistant_names() -> set[str]:
+    return {x for x in (settings.OPENAI_ANALYTICS_ASSISTANT, settings.OPENAI_MCDA_ASSISTANT) if x}
+
+
+async def load_assistants() -> dict[str, Assistant]:
+    '''first assistant with each of configured names'''
+    names = assistant_names()
+    found = {}
+    async with openai_admission.admit('assistants', tokens=0, priority=BACKGROUND):
+        async for assistant in get_openai_client().beta.assistants.list():
+            if assistant.name in names and assistant.name not in found:
+                found[assistant.name] = assistant
+                LOGGER.debug('found %s assistant %s with %s model', assistant.name, assistant.id, assistant.model)
+                if len(found) == len(names):
+                    break
+    if missing := names - found.keys():
+        LOGGER.error('OpenAI assistants not found: %s', ', '.join(sorted(missing)))
+    return found
+
+
+assistants = RefreshingValue('openai_assistants', load_assistants, ttl=settings.OPENAI_ASSISTANTS_TTL)
+
+
+async def get_assistant(name: str) -> Assistant:
+    found = await assistants.get()
+    # assistant created later is found by background refresh
+    if name not in found:
+        raise HTTPException(status_code=500, detail=f'OpenAI assistant {name} not found')
+    return found[name]
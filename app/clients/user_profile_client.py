@@ -1,49 +1,137 @@
-from aiohttp import ClientSession
+'''
+UPS client with in-memory caching of its responses.
+
+Responses depend on the user, so every entry is keyed by a hash of auth token
+together with appId, and it never outlives the expiry of the token.
+Failed calls are cached for a short time too, so a broken UPS or a bad token
+isn't asked again by every request.
+'''
+import asyncio
+import base64
+import hashlib
+import time
+
+import aiohttp
+import ujson as json
 from starlette.exceptions import HTTPException
 
+from app import metrics
+from app.cache import LRUCache
+from app.clients.http import get_http_session, USER_PROFILE_API_TIMEOUT
 from app.logger import LOGGER
 from app.settings import Settings
+from app.singleflight import SingleFlight
 
 settings = Settings()
 
+# (path, token hash) -> (status, response json or error text)
+_responses = LRUCache(
+    'ups', settings.USER_PROFILE_CACHE_MAX_BYTES, settings.USER_PROFILE_CACHE_TTL,
+    sizeof=lambda entry: len(json.dumps(entry)),
+)
+ups_flight = SingleFlight('ups')
+
 
 def feature_enabled(feature, app_data) -> bool:
     return feature in app_data['features_enabled']
 
 
+def token_hash(auth_token: str | None) -> str:
+    return hashlib.sha256((auth_token or '').encode('utf-8')).hexdigest()
+
+
+def token_expiry(auth_token: str | None) -> float | None:
+    '''exp claim of JWT bearer token, signature is checked by UPS, it's used only to limit caching'''
+    if not auth_token:
+        return None
+    try:
+        payload = auth_token.split()[-1].split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def cache_ttl(ttl: float, auth_token: str | None) -> float:
+    expiry = token_expiry(auth_token)
+    if expiry is None:
+        return ttl
+    return min(ttl, expiry - time.time())
+
+
+async def _request_ups(path: str, auth_token: str | None) -> tuple[int, object]:
+    '''(status, response), UPS that can't be reached gives 502 and UPS that doesn't answer in time gives 504'''
+    headers = {
+        'Authorization': auth_token or '',
+    }
+    url = settings.USER_PROFILE_API_URL + path
+    try:
+        with metrics.timer('ups.request'):
+            async with get_http_session().get(url, headers=headers, timeout=USER_PROFILE_API_TIMEOUT) as resp:
+                if resp.status != 200:
+                    return resp.status, await resp.text()
+                return 200, await resp.json()
+    except asyncio.TimeoutError:
+        LOGGER.warning('UPS %s timed out', path)
+        return 504, 'user profile service timed out'
+    except aiohttp.ClientError as e:
+        LOGGER.warning('UPS %s failed: %r', path, e)
+        return 502, 'user profile service is unavailable'
+
+
+async def get_ups(path: str, auth_token: str | None):
+    '''
+    response of UPS for the user, served from cache when possible.
+    raises HTTPException with UPS status for errors
+    '''
+    key = path, token_hash(auth_token)
+    entry = _responses.get(key)
+    if entry is None:
+        metrics.inc('ups_cache.miss')
+        entry = await ups_flight.do(key, lambda: _load_ups(key, path, auth_token))
+    else:
+        metrics.inc('ups_cache.hit')
+    status, data = entry
+    if status != 200:
+        raise HTTPException(status_code=status, detail=data)
+    return data
+
+
+async def _load_ups(key: tuple, path: str, auth_token: str | None) -> tuple[int, object]:
+    entry = await _request_ups(path, auth_token)
+    if entry[0] == 200:
+        ttl = cache_ttl(settings.USER_PROFILE_CACHE_TTL, auth_token)
+    else:
+        LOGGER.debug('UPS %s responded with %s', path, entry[0])
+        ttl = cache_ttl(settings.USER_PROFILE_ERROR_CACHE_TTL, auth_token)
+    if ttl > 0:
+        _responses.set(key, entry, ttl=ttl)
+    return entry
+
+
 async def get_app_data(app_id: str, auth_token: str, user_data=True, features_config=False) -> dict:
     '''
     get info about user and app features from UPS.
     user_data flag indicates if it's necessary to retrieve info about authorized user.
     features_config flag indicates if it's necessary to request app configuration
     '''
-    headers = {
-        'Authorization': auth_token or '',
-        'User-Agent': settings.USER_AGENT,
-    }
-    result = {}
     LOGGER.debug(f'asking UPS {settings.USER_PROFILE_API_URL} for user data..')
-    async with ClientSession(headers=headers) as session:
-        if user_data:
-            url = settings.USER_PROFILE_API_URL + '/users/current_user'
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    raise HTTPException(status_code=resp.status, detail=await resp.text())
-                result['current_user'] = await resp.json()
-
-        if features_config:
-            url = settings.USER_PROFILE_API_URL + '/apps/' + app_id
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    raise HTTPException(status_code=resp.status, detail=await resp.text())
-                app_config = await resp.json()
-                result['features_config'] = app_config['featuresConfig']
+    calls = {}
+    if user_data:
+        calls['current_user'] = get_ups('/users/current_user', auth_token)
+    if features_config:
+        calls['features_config'] = get_ups('/apps/' + app_id, auth_token)
+    calls['features_enabled'] = get_ups('/features?appId=' + app_id, auth_token)
 
-        url = settings.USER_PROFILE_API_URL + '/features?appId=' + app_id
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                raise HTTPException(status_code=resp.status, detail=await resp.text())
-            features = await resp.json()
-            result['features_enabled'] = frozenset(x['name'] for x in features)
+    # every call is awaited before errors are raised, so responses of all of them get cached.
+    # the first error in the order above is raised, cached responses are shared and must not be modified
+    responses = await asyncio.gather(*calls.values(), return_exceptions=True)
+    result = dict(zip(calls, responses))
+    for response in responses:
+        if isinstance(response, BaseException):
+            raise response
 
+    result['features_enabled'] = frozenset(x['name'] for x in result['features_enabled'])
+    if features_config:
+        result['features_config'] = result['features_config']['featuresConfig']
     return result
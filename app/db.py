@@ -1,17 +1,78 @@
+import time
+from contextlib import asynccontextmanager
+
 import asyncpg
+import ujson as json
 
+from app import metrics
 from app.secret import Secret
 from app.settings import Settings
 
 settings = Settings()
 secret = Secret()
 
+_pool: asyncpg.Pool | None = None
 
-async def get_db_conn():
-    return await asyncpg.connect(
-        host=settings.PGHOST,
-        port=settings.PGPORT,
-        database=settings.PGDATABASE,
-        user=settings.PGUSER,
-        password=str(secret.PGPASSWORD)
+
+async def init_connection(conn: asyncpg.Connection):
+    '''called once for every new connection of the pool'''
+    await conn.set_type_codec(
+        'jsonb',
+        encoder=json.dumps,
+        decoder=json.loads,
+        schema='pg_catalog',
     )
+
+
+def connection_params() -> dict:
+    return {
+        'host': settings.PGHOST,
+        'port': settings.PGPORT,
+        'database': settings.PGDATABASE,
+        'user': settings.PGUSER,
+        'password': str(secret.PGPASSWORD),
+    }
+
+
+async def connect_db() -> asyncpg.Connection:
+    '''dedicated connection outside of the pool, e.g. for LISTEN'''
+    return await asyncpg.connect(**connection_params())
+
+
+async def create_db_pool() -> asyncpg.Pool:
+    '''create connection pool of the worker, called from app lifespan'''
+    global _pool
+    _pool = await asyncpg.create_pool(
+        **connection_params(),
+        min_size=settings.PG_POOL_MIN_SIZE,
+        max_size=settings.PG_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=settings.PG_POOL_MAX_INACTIVE_CONNECTION_LIFETIME,
+        # prepared statements live as long as the pooled connection, so they are reused across requests
+        statement_cache_size=settings.PG_STATEMENT_CACHE_SIZE,
+        command_timeout=settings.PG_COMMAND_TIMEOUT,
+        init=init_connection,
+    )
+    metrics.register_gauge('db.pool.size', _pool.get_size)
+    metrics.register_gauge('db.pool.idle', _pool.get_idle_size)
+    return _pool
+
+
+async def close_db_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+@asynccontextmanager
+async def get_db_conn():
+    '''
+    checkout a connection from the worker pool.
+    time spent waiting for a free connection is reported as db.pool.acquire_wait metric
+    '''
+    if _pool is None:
+        raise RuntimeError('database pool is not initialized')
+    started = time.monotonic()
+    async with _pool.acquire(timeout=settings.PG_POOL_ACQUIRE_TIMEOUT) as conn:
+        metrics.observe('db.pool.acquire_wait', time.monotonic() - started)
+        yield conn
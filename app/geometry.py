@@ -0,0 +1,413 @@
+import hashlib
+import math
+import operator
+
+import ujson as json
+
+# decimal digits of coordinates kept for hashing, 6 digits are ~0.1 m
+HASH_PRECISION = 6
+# positions dumped by one json.dumps call while hashing, it holds the GIL for ~5 ms
+DUMP_CHUNK = 10000
+
+
+def extract_geometries(geojson: dict) -> list[dict]:
+    '''geometries of GeoJSON object in document order, properties are dropped'''
+    match geojson.get('type'):
+        case 'FeatureCollection':
+            return [g for feature in geojson.get('features') or [] for g in extract_geometries(feature)]
+        case 'Feature':
+            return [geojson['geometry']] if geojson.get('geometry') else []
+        case 'GeometryCollection':
+            return [g for geometry in geojson.get('geometries') or [] for g in extract_geometries(geometry)]
+        case None:
+            return []
+        case _:
+            return [geojson]
+
+
+class TooManyVertices(Exception):
+    pass
+
+
+class Bounds:
+    '''bbox and vertex count of positions seen so far, raises TooManyVertices past max_vertices'''
+    __slots__ = ('min_x', 'min_y', 'max_x', 'max_y', 'vertices', 'max_vertices')
+
+    def __init__(self, max_vertices: int = None):
+        self.min_x = self.min_y = math.inf
+        self.max_x = self.max_y = -math.inf
+        self.vertices = 0
+        self.max_vertices = max_vertices
+
+    def add(self, positions: list[list[float]]):
+        self.vertices += len(positions)
+        if self.max_vertices is not None and self.vertices > self.max_vertices:
+            raise TooManyVertices(self.max_vertices)
+        if positions:
+            # comprehensions instead of zip(*positions): a single C call over a large ring holds the GIL
+            xs, ys = [p[0] for p in positions], [p[1] for p in positions]
+            self.min_x, self.max_x = min(self.min_x, min(xs)), max(self.max_x, max(xs))
+            self.min_y, self.max_y = min(self.min_y, min(ys)), max(self.max_y, max(ys))
+
+    @property
+    def bbox(self) -> tuple[float, float, float, float] | None:
+        if not self.vertices:
+            return None
+        return self.min_x, self.min_y, self.max_x, self.max_y
+
+
+def round_coordinates(coordinates: list, precision: int, bounds: Bounds = None) -> list:
+    '''rounded copy of coordinates, positions are added to bounds on the way'''
+    if not isinstance(coordinates, list):
+        raise TypeError('coordinates must be arrays')
+    if coordinates and not isinstance(coordinates[0], list):
+        # a single position, + 0.0 turns -0.0 into 0.0
+        if bounds is not None:
+            bounds.add([coordinates])
+        return [round(c, precision) + 0.0 for c in coordinates]
+    if coordinates and coordinates[0] and not isinstance(coordinates[0][0], list):
+        # array of positions
+        if bounds is not None:
+            bounds.add(coordinates)
+        return [[round(c, precision) + 0.0 for c in position] for position in coordinates]
+    return [round_coordinates(c, precision, bounds) for c in coordinates]
+
+
+def signed_area(points: list[list[float]]) -> float:
+    '''shoelace formula, positive for counterclockwise ring'''
+    xs, ys = [p[0] for p in points], [p[1] for p in points]
+    return (sum(map(operator.mul, xs, ys[1:] + ys[:1])) - sum(map(operator.mul, xs[1:] + xs[:1], ys))) / 2
+
+
+def canonical_ring(ring: list[list[float]], exterior: bool) -> list[list[float]]:
+    '''
+    exterior ring goes counterclockwise and holes go clockwise (RFC 7946),
+    ring starts from its smallest vertex
+    '''
+    points = []
+    for point in ring:
+        # drop closing vertex and repeated vertices
+        if not points or point != points[-1]:
+            points.append(point)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    if len(points) < 3:
+        return ring
+    if (signed_area(points) > 0) != exterior:
+        points.reverse()
+    start = points.index(min(points))
+    points = points[start:] + points[:start]
+    return points + [points[0]]
+
+
+def canonical_polygon(rings: list) -> list:
+    return [canonical_ring(ring, exterior=i == 0) for i, ring in enumerate(rings)]
+
+
+def canonical_geometry(geometry: dict, precision: int = HASH_PRECISION, bounds: Bounds = None) -> dict:
+    '''geometry with rounded coordinates and normalized rings, without foreign members'''
+    geometry_type = geometry['type']
+    coordinates = round_coordinates(geometry['coordinates'], precision, bounds)
+    if geometry_type == 'Polygon':
+        coordinates = canonical_polygon(coordinates)
+    elif geometry_type == 'MultiPolygon':
+        coordinates = sorted((canonical_polygon(p) for p in coordinates), key=dump_coordinates)
+    return {'type': geometry_type, 'coordinates': coordinates}
+
+
+def dump_coordinates(coordinates: list) -> str:
+    '''
+    json.dumps of coordinates, long arrays of positions are dumped in chunks,
+    so the area is hashed in a thread without holding the event loop
+    '''
+    if coordinates and isinstance(coordinates[0], list) and coordinates[0] and isinstance(coordinates[0][0], list):
+        return '[' + ','.join(dump_coordinates(c) for c in coordinates) + ']'
+    if len(coordinates) <= DUMP_CHUNK:
+        return json.dumps(coordinates)
+    chunks = (json.dumps(coordinates[i:i + DUMP_CHUNK])[1:-1] for i in range(0, len(coordinates), DUMP_CHUNK))
+    return '[' + ','.join(chunks) + ']'
+
+
+def dump_geometry(geometry: dict) -> str:
+    '''json.dumps(geometry, sort_keys=True) of canonical geometry'''
+    return f'{{"coordinates":{dump_coordinates(geometry["coordinates"])},"type":{json.dumps(geometry["type"])}}}'
+
+
+def geometry_hash(geojson: dict) -> str:
+    '''
+    hash of the area that doesn't depend on properties, key and feature order,
+    ring orientation, start vertex and coordinate noise below HASH_PRECISION
+    '''
+    return hash_geometries(extract_geometries(geojson))
+
+
+def hash_geometries(geometries: list[dict], bounds: Bounds = None) -> str:
+    '''geometry_hash of extracted geometries, bbox and vertices are collected into bounds'''
+    try:
+        canonical = sorted(dump_geometry(canonical_geometry(g, bounds=bounds)) for g in geometries)
+    except (KeyError, TypeError, ValueError, IndexError, AttributeError):
+        # not a valid geometry, it's up to insights-api to reject it
+        canonical = [json.dumps(geometries, sort_keys=True)]
+    return hashlib.md5(','.join(canonical).encode('utf-8')).hexdigest()
+
+
+# average H3 hexagon edge length (km) and area (km2) by resolution
+H3_EDGE_KM = (
+    1281.256011, 483.0568391, 182.5129565, 68.97922179, 26.07175968, 9.854090990, 3.724532667, 1.406475763,
+    0.531414010, 0.200786148, 0.075863783, 0.028663897, 0.010830188, 0.004092010, 0.001546100, 0.000584169,
+)
+H3_AREA_KM2 = (
+    4357449.416, 609788.4417, 86801.78040, 12393.43493, 1770.347654, 252.9033645, 36.12906621, 5.161293360,
+    0.737327598, 0.105332513, 0.015047502, 0.002149643, 0.000307092, 0.000043870, 0.000006267, 0.000000895,
+)
+KM_PER_DEGREE = 111.32
+# simplification tolerance is at most that share of the smaller side of the area bbox,
+# so areas smaller than analytics resolution keep their shape
+MAX_TOLERANCE_SHARE = 0.005
+
+
+def iter_positions(coordinates: list):
+    '''arrays of positions of geometry coordinates: rings, lines or the point itself'''
+    if not coordinates or not isinstance(coordinates[0], list):
+        yield [coordinates] if coordinates else []
+    elif not isinstance(coordinates[0][0], list):
+        yield coordinates
+    else:
+        for c in coordinates:
+            yield from iter_positions(c)
+
+
+def count_vertices(geometries: list[dict]) -> int:
+    return sum(len(positions) for g in geometries for positions in iter_positions(g['coordinates']))
+
+
+def get_bbox(geometries: list[dict]) -> tuple[float, float, float, float] | None:
+    bounds = []
+    for geometry in geometries:
+        for positions in iter_positions(geometry['coordinates']):
+            if positions:
+                xs, ys = [p[0] for p in positions], [p[1] for p in positions]
+                bounds.append((min(xs), min(ys), max(xs), max(ys)))
+    if not bounds:
+        return None
+    min_x, min_y, max_x, max_y = zip(*bounds)
+    return min(min_x), min(min_y), max(max_x), max(max_y)
+
+
+def bbox_area_km2(bbox: tuple[float, float, float, float]) -> float:
+    min_x, min_y, max_x, max_y = bbox
+    mid_latitude = math.radians((min_y + max_y) / 2)
+    return ((max_x - min_x) * KM_PER_DEGREE * math.cos(mid_latitude)) * ((max_y - min_y) * KM_PER_DEGREE)
+
+
+def estimate_resolution(area_km2: float, max_resolution: int, max_cells: int) -> int:
+    '''finest H3 resolution that covers the area with at most max_cells cells'''
+    for resolution in range(max_resolution, 0, -1):
+        if area_km2 / H3_AREA_KM2[resolution] <= max_cells:
+            return resolution
+    return 0
+
+
+def _sq_segment_distance(p, a, b, x_scale: float) -> float:
+    x, y = a[0] * x_scale, a[1]
+    px, py = p[0] * x_scale, p[1]
+    dx, dy = b[0] * x_scale - x, b[1] - y
+    if dx or dy:
+        t = ((px - x) * dx + (py - y) * dy) / (dx * dx + dy * dy)
+        if t > 1:
+            x, y = x + dx, y + dy
+        elif t > 0:
+            x += dx * t
+            y += dy * t
+    dx, dy = px - x, py - y
+    return dx * dx + dy * dy
+
+
+def simplify_line(points: list, tolerance: float, x_scale: float = 1.0) -> list:
+    '''
+    radial distance pass followed by Douglas-Peucker,
+    first and last points are kept.
+    tolerance is in degrees of latitude, longitudes are multiplied by x_scale (cos of the latitude)
+    '''
+    if len(points) <= 2:
+        return points
+    sq_tolerance = tolerance * tolerance
+
+    # drop points closer than tolerance to the previous kept one, cheap and removes most of the noise
+    reduced = [points[0]]
+    for point in points[1:-1]:
+        prev = reduced[-1]
+        if ((point[0] - prev[0]) * x_scale) ** 2 + (point[1] - prev[1]) ** 2 > sq_tolerance:
+            reduced.append(point)
+    reduced.append(points[-1])
+
+    keep = [False] * len(reduced)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(reduced) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_distance, index = 0.0, 0
+        a, b = reduced[first], reduced[last]
+        for i in range(first + 1, last):
+            distance = _sq_segment_distance(reduced[i], a, b, x_scale)
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if max_distance > sq_tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, kept in zip(reduced, keep) if kept]
+
+
+def simplify_ring(ring: list, tolerance: float, x_scale: float = 1.0) -> list:
+    '''
+    simplified ring that keeps orientation and at least 4 vertices,
+    the original ring is returned if simplification would collapse it
+    '''
+    if len(ring) <= 4:
+        return ring
+    # Douglas-Peucker needs distinct ends, so closed ring is simplified as two halves
+    middle = len(ring) // 2
+    if ring[middle] == ring[0]:
+        return ring
+    simplified = (
+        simplify_line(ring[:middle + 1], tolerance, x_scale)[:-1] + simplify_line(ring[middle:], tolerance, x_scale)
+    )
+    if len(simplified) < 4:
+        return ring
+    original_area = signed_area(ring[:-1])
+    simplified_area = signed_area(simplified[:-1])
+    if original_area * simplified_area <= 0:
+        # orientation flipped or ring degenerated
+        return ring
+    return simplified
+
+
+def _orientation(a, b, c) -> float:
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+
+def _in_box(a, b, p) -> bool:
+    return min(a[0], b[0]) <= p[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= p[1] <= max(a[1], b[1])
+
+
+def segments_intersect(a, b, c, d) -> bool:
+    '''whether segments ab and cd cross or touch'''
+    d1, d2 = _orientation(c, d, a), _orientation(c, d, b)
+    d3, d4 = _orientation(a, b, c), _orientation(a, b, d)
+    if ((d1 > 0 > d2) or (d1 < 0 < d2)) and ((d3 > 0 > d4) or (d3 < 0 < d4)):
+        return True
+    return (
+        (d1 == 0 and _in_box(c, d, a)) or (d2 == 0 and _in_box(c, d, b))
+        or (d3 == 0 and _in_box(a, b, c)) or (d4 == 0 and _in_box(a, b, d))
+    )
+
+
+def rings_intersect(rings: list) -> bool:
+    '''
+    whether any ring crosses or touches itself or another ring,
+    neighbour segments of a ring share a vertex and aren't compared.
+    segments are bucketed into a grid of ~one segment per cell, so only close ones are compared
+    '''
+    segments = []
+    for r, ring in enumerate(rings):
+        points = [p for i, p in enumerate(ring) if not i or p != ring[i - 1]]
+        last = len(points) - 2
+        for i in range(last + 1):
+            a, b = points[i], points[i + 1]
+            segments.append((r, i, last, a, b, min(a[0], b[0]), min(a[1], b[1]), max(a[0], b[0]), max(a[1], b[1])))
+    if len(segments) < 2:
+        return False
+    min_x, min_y = min(s[5] for s in segments), min(s[6] for s in segments)
+    size = max(max(s[7] for s in segments) - min_x, max(s[8] for s in segments) - min_y) / math.sqrt(len(segments)) or 1.0
+
+    def cell(x, y) -> tuple[int, int]:
+        return int((x - min_x) / size), int((y - min_y) / size)
+
+    grid = {}
+    for segment in segments:
+        (x0, y0), (x1, y1) = cell(segment[5], segment[6]), cell(segment[7], segment[8])
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                grid.setdefault((x, y), []).append(segment)
+    for key, bucket in grid.items():
+        for n, (r, i, last, a, b, ax0, ay0, ax1, ay1) in enumerate(bucket):
+            for s, j, _, c, d, bx0, by0, bx1, by1 in bucket[n + 1:]:
+                if ax0 > bx1 or bx0 > ax1 or ay0 > by1 or by0 > ay1:
+                    continue
+                if r == s and (abs(i - j) == 1 or {i, j} == {0, last}):
+                    continue
+                # a pair sharing several cells is compared only in the one holding its common bbox corner
+                if cell(max(ax0, bx0), max(ay0, by0)) != key:
+                    continue
+                if segments_intersect(a, b, c, d):
+                    return True
+    return False
+
+
+def simplify_polygon(rings: list, tolerance: float, x_scale: float = 1.0) -> list:
+    '''simplified rings of a polygon, the original ones if simplified rings would cross or touch'''
+    simplified = [simplify_ring(r, tolerance, x_scale) for r in rings]
+    if simplified != rings and rings_intersect(simplified):
+        return rings
+    return simplified
+
+
+def simplify_geometry(geometry: dict, tolerance: float, x_scale: float = 1.0) -> dict:
+    match geometry['type']:
+        case 'Polygon':
+            coordinates = simplify_polygon(geometry['coordinates'], tolerance, x_scale)
+        case 'MultiPolygon':
+            coordinates = [simplify_polygon(p, tolerance, x_scale) for p in geometry['coordinates']]
+        case 'LineString':
+            coordinates = simplify_line(geometry['coordinates'], tolerance, x_scale)
+        case 'MultiLineString':
+            coordinates = [simplify_line(line, tolerance, x_scale) for line in geometry['coordinates']]
+        case _:
+            return geometry
+    return {**geometry, 'coordinates': coordinates}
+
+
+def simplify_area(
+        geojson: dict,
+        max_resolution: int,
+        max_cells: int,
+        max_vertices: int,
+        bbox: tuple[float, float, float, float] = None,
+        vertices: int = None,
+) -> tuple[dict, int, int]:
+    '''
+    simplify geometries of the area to the precision of analytics resolution.
+    tolerance is half of H3 edge length at the resolution estimated from the area bbox,
+    but at most MAX_TOLERANCE_SHARE of the smaller bbox side. it's doubled until the area fits into max_vertices.
+    distances are measured in km, longitudes are scaled by cos of the bbox middle latitude.
+    rings never collapse, polygons whose simplified rings would cross or touch keep the original rings.
+    parts of a multipolygon are checked separately.
+    properties are dropped. bbox and vertices are computed unless they're known already.
+    returns (FeatureCollection, vertices before, vertices after)
+    '''
+    geometries = extract_geometries(geojson)
+    if vertices is None:
+        vertices = count_vertices(geometries)
+    if bbox is None:
+        bbox = get_bbox(geometries)
+    if bbox is None:
+        return geojson, vertices, vertices
+    resolution = estimate_resolution(bbox_area_km2(bbox), max_resolution, max_cells)
+    tolerance = H3_EDGE_KM[resolution] / 2 / KM_PER_DEGREE
+    min_x, min_y, max_x, max_y = bbox
+    x_scale = math.cos(math.radians((min_y + max_y) / 2))
+    if extent := min((max_x - min_x) * x_scale, max_y - min_y):
+        tolerance = min(tolerance, extent * MAX_TOLERANCE_SHARE)
+
+    simplified, simplified_vertices = geometries, vertices
+    for _ in range(10):
+        simplified = [simplify_geometry(g, tolerance, x_scale) for g in geometries]
+        simplified_vertices = count_vertices(simplified)
+        if simplified_vertices <= max_vertices:
+            break
+        tolerance *= 2
+    return {
+        'type': 'FeatureCollection',
+        'features': [{'type': 'Feature', 'properties': {}, 'geometry': g} for g in simplified],
+    }, vertices, simplified_vertices
@@ -0,0 +1,182 @@
+'''
+Lease protocol of llm_cache table.
+
+A worker that misses the cache commits a pending row (response is null) with
+lease_owner and lease_expires_at right away and asks the LLM without holding
+a DB connection. Workers asking for the same prompt wait for the response:
+they are woken up by NOTIFY on LEASE_CHANNEL and poll the row in case the
+notification was missed. If the owner crashes, its lease expires and one of
+the waiters takes it over.
+
+Saved responses are kept in a per-worker LRU in front of the table (L1),
+pending rows never get there.
+'''
+import asyncio
+import os
+import socket
+import uuid
+
+import asyncpg
+
+from app import metrics
+from app.cache import LRUCache
+from app.db import get_db_conn, connect_db
+from app.logger import LOGGER
+from app.settings import Settings
+
+settings = Settings()
+
+LEASE_CHANNEL = 'llm_cache'
+
+# cache_key -> events of local coroutines waiting for the response
+_waiters: dict[str, set[asyncio.Event]] = {}
+_listener_conn: asyncpg.Connection | None = None
+
+# (cache_key, llm_model) -> response
+_l1 = LRUCache('llm', max_bytes=settings.LLM_L1_CACHE_MAX_BYTES, ttl=settings.LLM_L1_CACHE_TTL)
+
+
+def new_lease_owner() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def _on_notify(conn, pid, channel, payload):
+    for event in _waiters.get(payload, ()):
+        event.set()
+
+
+async def start_listener():
+    '''LISTEN on a dedicated connection, so waiters don't hold pooled connections'''
+    global _listener_conn
+    try:
+        _listener_conn = await connect_db()
+        await _listener_conn.add_listener(LEASE_CHANNEL, _on_notify)
+    except (OSError, asyncpg.PostgresError) as e:
+        # waiters fall back to polling
+        LOGGER.error('failed to listen on %s channel: %s', LEASE_CHANNEL, e)
+        _listener_conn = None
+
+
+async def stop_listener():
+    global _listener_conn
+    if _listener_conn is not None:
+        await _listener_conn.close()
+        _listener_conn = None
+
+
+async def get_response(cache_key: str, llm_model: str) -> str | None:
+    if (response := _l1.get((cache_key, llm_model))) is not None:
+        metrics.inc('llm_cache.l1_hit')
+        return response
+
+    async with get_db_conn() as conn:
+        response = await conn.fetchval(
+            'select response from llm_cache where hash = $1 and model_name = $2 and response is not null',
+            cache_key, llm_model)
+    if response is None:
+        metrics.inc('llm_cache.miss')
+        return None
+    metrics.inc('llm_cache.l2_hit')
+    _l1.set((cache_key, llm_model), response)
+    return response
+
+
+async def acquire_lease(cache_key: str, request: str, llm_model: str, owner: str) -> bool:
+    '''
+    commit pending row owned by `owner`. returns False if the row already has
+    a response or a live lease of another worker. pending rows with expired lease are taken over
+    '''
+    async with get_db_conn() as conn:
+        acquired = await conn.fetchval('''
+            insert into llm_cache as c (hash, request, response, model_name, lease_owner, lease_expires_at)
+            values ($1, $2, null, $3, $4, now() + make_interval(secs => $5))
+            on conflict (hash, model_name) do update
+                set lease_owner = excluded.lease_owner,
+                    lease_expires_at = excluded.lease_expires_at
+                where c.response is null and coalesce(c.lease_expires_at < now(), true)
+            returning lease_owner''',
+            cache_key, request, llm_model, owner, settings.LLM_CACHE_LEASE_SECONDS)
+    return acquired == owner
+
+
+async def extend_lease(cache_key: str, llm_model: str, owner: str) -> bool:
+    async with get_db_conn() as conn:
+        status = await conn.execute('''
+            update llm_cache set lease_expires_at = now() + make_interval(secs => $4)
+            where hash = $1 and model_name = $2 and lease_owner = $3 and response is null''',
+            cache_key, llm_model, owner, settings.LLM_CACHE_LEASE_SECONDS)
+    return status == 'UPDATE 1'
+
+
+async def complete_lease(cache_key: str, llm_model: str, owner: str, response: str):
+    '''save response and wake up waiters'''
+    async with get_db_conn() as conn:
+        saved = await conn.fetchval('''
+            with updated as (
+                update llm_cache set response = $4, lease_owner = null, lease_expires_at = null
+                where hash = $1 and model_name = $2 and lease_owner = $3
+                returning hash
+            )
+            -- pg_notify returns void, which is decoded as None
+            select u.hash from updated u, pg_notify($5, u.hash)''',
+            cache_key, llm_model, owner, response, LEASE_CHANNEL)
+    _l1.set((cache_key, llm_model), response)
+    if saved is None:
+        # lease expired and was taken over, the new owner will save its own response
+        LOGGER.warning('lost llm_cache lease for hash = %s and model_name = %s', cache_key, llm_model)
+
+
+async def release_lease(cache_key: str, llm_model: str, owner: str):
+    '''drop pending row after failure, so one of the waiters retries right away'''
+    async with get_db_conn() as conn:
+        await conn.execute('''
+            with deleted as (
+                delete from llm_cache
+                where hash = $1 and model_name = $2 and lease_owner = $3 and response is null
+                returning hash
+            )
+            select pg_notify($4, hash) from deleted''',
+            cache_key, llm_model, owner, LEASE_CHANNEL)
+
+
+async def keep_lease(cache_key: str, llm_model: str, owner: str):
+    '''extend lease periodically while the owner is waiting for the LLM'''
+    while True:
+        await asyncio.sleep(settings.LLM_CACHE_LEASE_SECONDS / 3)
+        if not await extend_lease(cache_key, llm_model, owner):
+            return
+
+
+async def wait_for_response(cache_key: str, llm_model: str, deadline: float) -> str | None:
+    '''
+    wait until other worker saves the response.
+    returns None when the lease is gone (owner failed or crashed) and the caller should try to take it over
+    '''
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    _waiters.setdefault(cache_key, set()).add(event)
+    interval = 0.1
+    try:
+        with metrics.timer('llm_cache.lease_wait'):
+            while (timeout := deadline - loop.time()) > 0:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(interval, timeout))
+                except asyncio.TimeoutError:
+                    interval = min(interval * 2, settings.LLM_CACHE_POLL_INTERVAL)
+                event.clear()
+                async with get_db_conn() as conn:
+                    row = await conn.fetchrow('''
+                        select response, coalesce(lease_expires_at < now(), true) as expired
+                        from llm_cache where hash = $1 and model_name = $2''',
+                        cache_key, llm_model)
+                if row is None or (row['response'] is None and row['expired']):
+                    return None
+                if row['response'] is not None:
+                    _l1.set((cache_key, llm_model), row['response'])
+                    return row['response']
+    finally:
+        events = _waiters[cache_key]
+        events.discard(event)
+        if not events:
+            del _waiters[cache_key]
+    raise asyncio.TimeoutError
@@ -1,10 +1,15 @@
+from contextlib import asynccontextmanager
 from typing import TYPE_CHECKING
 
 import sentry_sdk
 from starlette.applications import Starlette
-from starlette.responses import PlainTextResponse
+from starlette.responses import PlainTextResponse, JSONResponse
 from starlette.routing import Route
 
+from . import metrics, llm_cache
+from .db import create_db_pool, close_db_pool
+from .clients.http import create_http_session, close_http_session
+from .clients.openai_registry import create_openai_client, close_openai_client, assistants
 from .settings import Settings
 from .secret import Secret
 from .views import llm_analytics, search, save_search_choice, mcda_suggestion
@@ -28,15 +33,36 @@ async def health(request: 'Request') -> 'Response':
     return PlainTextResponse('ok')
 
 
+async def metrics_snapshot(request: 'Request') -> 'Response':
+    return JSONResponse(metrics.snapshot())
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    # shared resources are created once per worker
+    await create_db_pool()
+    await llm_cache.start_listener()
+    create_http_session()
+    create_openai_client()
+    # assistants are resolved before the first LLM request if OpenAI is available
+    assistants.prefetch()
+    yield
+    await close_openai_client()
+    await close_http_session()
+    await llm_cache.stop_listener()
+    await close_db_pool()
+
+
 routes = [
     Route("/llm-analytics", methods=['POST'], endpoint=llm_analytics),
     Route("/search", methods=['GET'], endpoint=search),
     Route("/search/click", methods=['POST'], endpoint=save_search_choice),
     Route("/mcda-suggestion", methods=['GET'], endpoint=mcda_suggestion),
     Route("/health", endpoint=health),
+    Route("/metrics", endpoint=metrics_snapshot),
 ]
 
-app = Starlette(routes=routes)
+app = Starlette(routes=routes, lifespan=lifespan)
 
 
 def create_app():
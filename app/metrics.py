@@ -0,0 +1,58 @@
+'''
+In-process metrics of a worker.
+
+Every uvicorn worker keeps its own registry, so GET /metrics returns a snapshot
+of the worker that served the request.
+'''
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable
+
+_counters: dict[str, int] = defaultdict(int)
+_timers: dict[str, dict] = {}
+_gauges: dict[str, Callable[[], float]] = {}
+
+
+def inc(name: str, value: int = 1):
+    _counters[name] += value
+
+
+def observe(name: str, seconds: float):
+    '''record duration of a single event'''
+    stats = _timers.get(name)
+    if stats is None:
+        stats = _timers[name] = {'count': 0, 'sum': 0.0, 'max': 0.0}
+    stats['count'] += 1
+    stats['sum'] += seconds
+    if seconds > stats['max']:
+        stats['max'] = seconds
+
+
+@contextmanager
+def timer(name: str):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started)
+
+
+def register_gauge(name: str, fn: Callable[[], float]):
+    '''gauge value is computed by fn at snapshot time'''
+    _gauges[name] = fn
+
+
+def snapshot() -> dict:
+    gauges = {}
+    for name, fn in _gauges.items():
+        try:
+            gauges[name] = fn()
+        except Exception:
+            # source of the gauge is gone (e.g. pool closed)
+            gauges[name] = None
+    return {
+        'counters': dict(_counters),
+        'timers': {name: dict(stats) for name, stats in _timers.items()},
+        'gauges': gauges,
+    }
@@ -19,14 +19,96 @@ class Settings:
     PGPORT: int = 5432
     PGDATABASE: str = None
     PGUSER: str = None
+    PG_POOL_MIN_SIZE: int = 1
+    PG_POOL_MAX_SIZE: int = 10
+    # seconds to wait for a free connection of the pool
+    PG_POOL_ACQUIRE_TIMEOUT: float = 10.0
+    PG_POOL_MAX_INACTIVE_CONNECTION_LIFETIME: float = 300.0
+    PG_STATEMENT_CACHE_SIZE: int = 100
+    PG_COMMAND_TIMEOUT: float = 30.0
+    # pending llm_cache row is owned by one worker for that many seconds, the owner extends it while LLM is running
+    LLM_CACHE_LEASE_SECONDS: float = 60.0
+    # max seconds to wait for the response of other worker
+    LLM_CACHE_WAIT_TIMEOUT: float = 180.0
+    # max interval between polls of pending llm_cache row
+    LLM_CACHE_POLL_INTERVAL: float = 2.0
+    # in-memory cache of LLM responses in front of llm_cache table, per worker
+    LLM_L1_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    LLM_L1_CACHE_TTL: float = 3600.0
+
+    # shared aiohttp connection pool of a worker
+    HTTP_POOL_LIMIT: int = 100
+    HTTP_POOL_LIMIT_PER_HOST: int = 30
+    HTTP_DNS_CACHE_TTL: int = 300
+    HTTP_KEEPALIVE_TIMEOUT: float = 30.0
+    # total seconds per upstream request
+    INSIGHTS_API_TIMEOUT: float = 120.0
+    USER_PROFILE_API_TIMEOUT: float = 15.0
+    NOMINATIM_TIMEOUT: float = 15.0
+    # UPS responses are cached per user for that many seconds, but not longer than auth token is valid
+    USER_PROFILE_CACHE_TTL: float = 60.0
+    USER_PROFILE_ERROR_CACHE_TTL: float = 5.0
+    USER_PROFILE_CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+
+    # world analytics are refreshed in background when they get older than that many seconds
+    WORLD_ANALYTICS_TTL: float = 3600.0
+    AXES_TTL: float = 600.0
+    # cached polygonStatistic analytics of areas
+    INSIGHTS_CACHE_TTL: float = 86400.0
+    INSIGHTS_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    # send analytics of all areas in one GraphQL document instead of a query per area
+    INSIGHTS_API_BATCH_QUERIES: bool = True
+    # areas are simplified to the precision of H3 resolution insights-api is expected to use for them:
+    # the finest resolution up to GEOMETRY_SIMPLIFY_MAX_RESOLUTION covering the area with GEOMETRY_SIMPLIFY_MAX_CELLS
+    # cells. tolerance is capped by the area size, so small areas keep their shape
+    GEOMETRY_SIMPLIFY: bool = True
+    GEOMETRY_SIMPLIFY_MAX_RESOLUTION: int = 8
+    GEOMETRY_SIMPLIFY_MAX_CELLS: int = 100000
+    # vertex budget of an area sent to insights-api
+    GEOMETRY_MAX_VERTICES: int = 20000
+    # limits of /llm-analytics request body and of the selected area in it. they're checked before the user
+    # is authorized: the body is parsed on the event loop and the area is walked in a thread, ~1 s per 200k vertices
+    REQUEST_MAX_BYTES: int = 8 * 1024 * 1024
+    AREA_MAX_VERTICES: int = 200000
+    # look up cached analytics of selected area and fetch the world ones while user is authorized in UPS,
+    # uncached area is simplified and requested only after authorization
+    LLM_ANALYTICS_PREFETCH: bool = True
 
     USER_AGENT: str = 'insights-llm-api'
     OPENAI_ANALYTICS_INSTRUCTIONS: str = None
     # how many analytics sentences we want to include into prompt:
     MAX_ANALYTICS_SENTENCES: int = 400
+    # estimated tokens of analytics prompt, the most significant sentences and descriptions of their indicators fit into it
+    ANALYTICS_PROMPT_MAX_TOKENS: int = 12000
     OPENAI_ANALYTICS_ASSISTANT: str = None
     OPENAI_MCDA_ASSISTANT: str = None
     OPENAI_MCDA_INSTRUCTIONS: str = None
+    # OpenAI API URL, default one is used when it's not set
+    OPENAI_BASE_URL: str = None
+    # total seconds per OpenAI API request
+    OPENAI_TIMEOUT: float = 40.0
+    # how LLM is asked, model and instructions are taken from the assistant in both cases:
+    # 'assistants' for a run of the assistant, 'chat' for one chat completion request.
+    # 'chat' ignores tools of the assistant (file_search, code_interpreter), switching backends can change answers
+    OPENAI_ANALYTICS_BACKEND: str = 'assistants'
+    OPENAI_MCDA_BACKEND: str = 'assistants'
+    # LLM calls of a worker in flight, more calls wait in a queue
+    OPENAI_MAX_CONCURRENCY: int = 16
+    # seconds a call waits for OpenAI rate limits or a free slot before 503
+    OPENAI_QUEUE_TIMEOUT: float = 30.0
+    # seconds in which OpenAI replenishes a rate limit in full, budgets are refilled continuously at that pace
+    OPENAI_RATE_LIMIT_WINDOW: float = 60.0
+    # tokens of LLM response reserved in the budget of a call
+    OPENAI_EXPECTED_OUTPUT_TOKENS: int = 1000
+    # assistant runs are followed by events of a stream, polled when it's disabled or unavailable
+    OPENAI_STREAM_RUNS: bool = True
+    # polls of a run start with the min interval, it grows up to the max one
+    OPENAI_POLL_MIN_INTERVAL: float = 0.2
+    OPENAI_POLL_MAX_INTERVAL: float = 1.0
+    # seconds a run is polled for before it's cancelled and 504 is returned
+    OPENAI_RUN_TIMEOUT: float = 120.0
+    # assistants are looked up by name and refreshed in background when they get older than that many seconds
+    OPENAI_ASSISTANTS_TTL: float = 600.0
 
     @property
     def LOG_CONFIG(self):
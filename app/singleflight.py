@@ -0,0 +1,102 @@
+'''
+Coalescing of concurrent identical calls within a worker.
+
+The first caller of a key starts the work in a task, callers arriving while
+it's running await the same task. Coordination between workers is left to
+the database.
+'''
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from app import metrics
+
+T = TypeVar('T')
+
+
+class _Call:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, _Call] = {}
+
+    def _forget(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def _join(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> _Call:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            metrics.inc(f'singleflight.{self.name}.coalesced')
+        return call
+
+    async def _wait(self, key: Hashable, call: _Call) -> T:
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                # every caller is gone, nobody needs the result.
+                # callers arriving before the task is done start a new call
+                self._forget(key, call)
+                call.task.cancel()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        '''
+        return result of fn() shared by all concurrent callers of the key.
+        exception raised by fn() is raised for every caller.
+        cancelled caller doesn't affect others, the work is cancelled when no callers are left
+        '''
+        return await self.join(key, fn)
+
+    def join(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> Awaitable[T]:
+        '''
+        like do(), but the call of the key is joined right away, fn() is called now if there's none.
+        returns awaitable of the result
+        '''
+        metrics.inc(f'singleflight.{self.name}.calls')
+        return self._wait(key, self._join(key, fn))
+
+    async def do_batch(self, keys: list[Hashable], fn: Callable[[list], Awaitable[dict]]) -> dict:
+        '''
+        results of every key: keys in flight join their calls, the rest are done by one fn(keys) call
+        that returns key -> result. the batch is cancelled when no callers of its keys are left
+        '''
+        metrics.inc(f'singleflight.{self.name}.calls', len(keys))
+        new = [key for key in keys if key not in self._calls]
+        calls = {}
+        if new:
+            batch = asyncio.ensure_future(fn(new))
+            pending = set()
+
+            async def pick(key: Hashable) -> T:
+                return (await asyncio.shield(batch))[key]
+
+            def on_pick_done(task: asyncio.Task):
+                pending.discard(task)
+                if not pending and not batch.done():
+                    batch.cancel()
+
+            for key in new:
+                calls[key] = self._join(key, lambda key=key: pick(key))
+                pending.add(calls[key].task)
+                calls[key].task.add_done_callback(on_pick_done)
+            # errors of the cancelled batch are not logged as unretrieved
+            batch.add_done_callback(lambda t: t.cancelled() or t.exception())
+        for key in keys:
+            if key not in calls:
+                # in flight already
+                calls[key] = self._join(key, None)
+        results = await asyncio.gather(*(self._wait(key, call) for key, call in calls.items()))
+        return dict(zip(calls, results))
@@ -0,0 +1,13 @@
+'''
+Local estimate of LLM tokens, no tokenizer is needed.
+
+English text and numbers average about 4 characters per token for OpenAI
+models, the estimate is used for budgets, not for billing.
+'''
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str | None) -> int:
+    if not text:
+        return 0
+    return -(-len(text) // CHARS_PER_TOKEN)
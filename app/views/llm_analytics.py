@@ -1,9 +1,14 @@
-from json.decoder import JSONDecodeError
+import asyncio
+import time
+from typing import AsyncIterator
 
-from starlette.responses import JSONResponse
+import ujson as json
+from starlette.responses import JSONResponse, StreamingResponse
 from starlette.exceptions import HTTPException
 
-from app.clients.insights_api_client import get_analytics_sentences
+from app import metrics
+from app.area import ingest_area, read_json
+from app.clients.insights_api_client import get_analytics_sentences, prefetch_analytics
 from app.clients.openai_client import get_analytics_prompt, OpenAIClient
 from app.clients.user_profile_client import get_app_data, feature_enabled
 from app.logger import LOGGER
@@ -12,6 +17,38 @@ from app.settings import Settings
 settings = Settings()
 
 
+def sse(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+async def sse_commentary(parts: AsyncIterator[str], started: float) -> AsyncIterator[str]:
+    '''
+    server-sent events of LLM response:
+        - 'delta' with the next part of markdown text
+        - 'done' after the last part
+        - 'error' with detail and status when LLM request failed after the response started
+    '''
+    first = True
+    try:
+        async for part in parts:
+            if first:
+                metrics.observe('llm_analytics.first_byte', time.monotonic() - started)
+                first = False
+            yield sse('delta', {'text': part})
+    except HTTPException as e:
+        yield sse('error', {'detail': e.detail, 'status': e.status_code})
+        return
+    except Exception:
+        LOGGER.exception('failed to stream LLM response')
+        yield sse('error', {'detail': 'failed to get OpenAI response', 'status': 500})
+        return
+    finally:
+        # client has disconnected if parts are left: the run is cancelled and the lease is released
+        await parts.aclose()
+    metrics.observe('llm_analytics.total', time.monotonic() - started)
+    yield sse('done', {})
+
+
 async def llm_analytics(request: 'Request') -> 'Response':
     '''
     Handles POST requests to /llm-analytics.
@@ -19,38 +56,75 @@ async def llm_analytics(request: 'Request') -> 'Response':
     Request format:
         - 'appId' (str): UUID of client application
         - 'features' (dict): A GeoJSON representing the selected area.
+        - 'stream' (bool, optional): stream the response as server-sent events
 
     Response format:
         - 'data' (str): analytics for selected area in markdown format
+        - or text/event-stream of the analytics when 'stream' is set, see sse_commentary
     '''
     # parse input params of original query
-    try:
-        data = await request.json()
-    except JSONDecodeError:
-        raise HTTPException(status_code=400, detail='malformed request')
+    data = await read_json(request, settings.REQUEST_MAX_BYTES)
     if not (app_id := data.get('appId')):
         raise HTTPException(status_code=400, detail='missing appId')
     if not (selected_area_geojson := data.get('features')):
         raise HTTPException(status_code=400, detail='missing features')
+    # walking a large area takes long, other requests of the worker are served meanwhile
+    selected_area = await asyncio.to_thread(ingest_area, selected_area_geojson, settings.AREA_MAX_VERTICES)
 
-    app_data = await get_app_data(app_id, auth_token=request.headers.get('Authorization'), features_config=True)
-    if not feature_enabled('llm_analytics', app_data):
-        raise HTTPException(status_code=403, detail='llm_analytics is not enabled for the user')
+    started = time.monotonic()
+    auth_token = request.headers.get('Authorization')
+    # analytics of selected area and the world don't depend on the user, they're fetched while UPS is asked.
+    # requests without a token are rejected by UPS, nothing is fetched for them
+    prefetched = None
+    authorized = asyncio.Event()
+    if settings.LLM_ANALYTICS_PREFETCH and auth_token:
+        prefetched = prefetch_analytics(selected_area, authorized)
+        prefetched_at = []
+        prefetched.add_done_callback(lambda _: prefetched_at.append(time.monotonic()))
+    try:
+        with metrics.timer('llm_analytics.ups'):
+            app_data = await get_app_data(app_id, auth_token=auth_token, features_config=True)
+        if prefetched:
+            # time of analytics fetching hidden behind UPS call
+            metrics.observe('llm_analytics.overlap', (prefetched_at[0] if prefetched_at else time.monotonic()) - started)
+        if not feature_enabled('llm_analytics', app_data):
+            raise HTTPException(status_code=403, detail='llm_analytics is not enabled for the user')
+        authorized.set()
 
-    bio = app_data['current_user'].get('bio')
-    reference_area = app_data['features_config'].get('reference_area') or {}
-    reference_area_geojson = reference_area.get('referenceAreaGeometry') or {}
-    LOGGER.debug('user bio: %s', bio)
+        bio = app_data['current_user'].get('bio')
+        reference_area = app_data['features_config'].get('reference_area') or {}
+        reference_area_geojson = reference_area.get('referenceAreaGeometry') or {}
+        # reference area is stored in user profile, it's not limited like request
+        reference_area = None
+        if reference_area_geojson:
+            reference_area = await asyncio.to_thread(ingest_area, reference_area_geojson)
+        LOGGER.debug('user bio: %s', bio)
 
-    LOGGER.debug(f'asking insights-api {settings.INSIGHTS_API_URL} for advanced analytics..')
-    sentences, indicator_description = await get_analytics_sentences(selected_area_geojson, reference_area_geojson)
+        LOGGER.debug(f'asking insights-api {settings.INSIGHTS_API_URL} for advanced analytics..')
+        with metrics.timer('llm_analytics.analytics'):
+            sentences, descriptions = await get_analytics_sentences(selected_area, reference_area, prefetched)
+    finally:
+        # speculative fetch isn't needed when the request is rejected or failed
+        if prefetched:
+            prefetched.cancel()
 
     # build cache key from request and check if it's in llm_cache table
     lang = request.headers.get('User-Language')
-    prompt = get_analytics_prompt(sentences, indicator_description, bio, lang, selected_area_geojson, reference_area_geojson)
+    prompt = get_analytics_prompt(sentences, descriptions, bio, lang, selected_area, reference_area)
     openai_client = OpenAIClient(
         assistant_name=settings.OPENAI_ANALYTICS_ASSISTANT,
         instructions=settings.OPENAI_ANALYTICS_INSTRUCTIONS,
-        override_instructions=True)
-    llm_response = await openai_client.get_cached_llm_commentary(prompt)
+        override_instructions=True,
+        backend=settings.OPENAI_ANALYTICS_BACKEND,
+        app_id=app_id)
+    if data.get('stream'):
+        return StreamingResponse(
+            sse_commentary(openai_client.stream_cached_llm_commentary(prompt), started),
+            media_type='text/event-stream',
+            # proxies shouldn't buffer the events
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+    with metrics.timer('llm_analytics.llm'):
+        llm_response = await openai_client.get_cached_llm_commentary(prompt)
+    metrics.observe('llm_analytics.total', time.monotonic() - started)
     return JSONResponse({'data': llm_response})
@@ -26,6 +26,6 @@ async def mcda_suggestion(request: 'Request') -> 'Response':
     if not feature_enabled('llm_mcda', app_data):
         raise HTTPException(status_code=403, detail='llm_mcda is not enabled for the user')
     bio = app_data['current_user'].get('bio')
-    llm_mcda = await get_mcda_suggestion(query, bio)
+    llm_mcda = await get_mcda_suggestion(query, bio, app_id)
 
     return JSONResponse(llm_mcda)
@@ -45,6 +45,13 @@ def format_bivariate_axis_label(quotients):
     return f"{numerator['label']} to {denominator['label']} ({numerator['unit']['shortName']}/{denominator['unit']['shortName']})"
 
 
-def set_axis_label(axis):
-    quotients = axis.get('quotients', [])
-    axis['label'] = format_bivariate_axis_label(quotients)
+def label_axes(catalog) -> tuple[dict, ...]:
+    '''axes of the catalog, the ones without label get a copy with formatted label'''
+    return tuple(
+        axis if axis['label'] else {**axis, 'label': format_bivariate_axis_label(axis.get('quotients', []))}
+        for axis in catalog.axes
+    )
+
+
+def get_labelled_axes(catalog) -> tuple[dict, ...]:
+    return catalog.derive('mcda.labelled_axes', label_axes)
@@ -3,31 +3,37 @@ import time
 import ujson as json
 from starlette.exceptions import HTTPException
 
+from app.clients.axes_catalog import AxesCatalog
 from app.clients.insights_api_client import get_axes
 from app.clients.openai_client import OpenAIClient
 from app.logger import LOGGER
 from app.settings import Settings
 from .prompt import get_mcda_prompt
-from .formatters import set_axis_label, format_bivariate_axis_unit
+from .formatters import get_labelled_axes, format_bivariate_axis_unit
 
 settings = Settings()
 
 
-async def get_mcda_suggestion(query: str, bio: str) -> dict:
-    axis_data = await get_axes()
-    for axis in axis_data['data']['getAxes']['axis']:
-        if not axis['label']:
-            set_axis_label(axis)
-    prompt = await get_mcda_prompt(query, bio, axis_data)
+def get_indicators_to_axis(catalog: AxesCatalog) -> dict[tuple, dict]:
+    return catalog.derive('mcda.indicators_to_axis', lambda c: {
+        (x['quotients'][0]['name'], x['quotients'][1]['name']): x for x in get_labelled_axes(c)
+    })
+
+
+async def get_mcda_suggestion(query: str, bio: str, app_id: str = None) -> dict:
+    catalog = await get_axes()
+    prompt = await get_mcda_prompt(query, bio, catalog)
     openai_client = OpenAIClient(
         assistant_name=settings.OPENAI_MCDA_ASSISTANT,
         instructions=settings.OPENAI_MCDA_INSTRUCTIONS,
-        override_instructions=True)
+        override_instructions=True,
+        backend=settings.OPENAI_MCDA_BACKEND,
+        app_id=app_id)
     llm_response = await openai_client.get_cached_llm_commentary(prompt)
-    return make_valid_mcda(llm_response, axis_data)
+    return make_valid_mcda(llm_response, catalog)
 
 
-def make_valid_mcda(llm_response: str, axis_data: dict) -> dict:
+def make_valid_mcda(llm_response: str, catalog: AxesCatalog) -> dict:
     '''convert json response from LLM to MCDA format accepted by DN-FE'''
     llm_mcda = json.loads(llm_response)
     if 'error' in llm_mcda:
@@ -35,9 +41,7 @@ def make_valid_mcda(llm_response: str, axis_data: dict) -> dict:
 
     original_request = llm_mcda['original_request']
     analysis_name = llm_mcda['analysis_name']
-    indicators_to_axis = {
-        (x['quotients'][0]['name'], x['quotients'][1]['name']): x for x in axis_data['data']['getAxes']['axis']
-    }
+    indicators_to_axis = get_indicators_to_axis(catalog)
     layers = []
     for llm_layer in llm_mcda['axes']:
         try:
@@ -1,10 +1,20 @@
+from dataclasses import dataclass
+
+from app import metrics
+from app.clients.axes_catalog import AxesCatalog
+from app.logger import LOGGER
+from app.tokens import estimate_tokens
 from .examples import solar_farms_example, cropland_burn_risk_example
+from .formatters import get_labelled_axes
 
+# the prompt starts with static prefix that depends only on axes, user's request follows it.
+# OpenAI caches prompt prefixes, so requests of all users share the cached axes and instructions.
+# bump the version on changes of the prefix text
+PROMPT_VERSION = 2
 
-async def get_mcda_prompt(query, bio, axis_data) -> str:
-    '''MCDA Wizard assistant knows terminology and has instructions on what to do with axis data.'''
-    return '''
-        {axis_and_indicators_description}
+
+# examples and instructions follow the description of axes
+MCDA_INSTRUCTIONS = '''
 
         ## Example of how to provide the indicators for some user request
 
@@ -26,14 +36,14 @@ async def get_mcda_prompt(query, bio, axis_data) -> str:
 
         ### Step 1: Pick 2..4 indicators that will help to perform geospatial analysis requested by user
 
-        The user's request is: """{user_query}""".
+        The user's request is given at the end of this prompt.
         When analyzing the user's query, first check if the request is meaningful. If the request appears to be random, or does not make sense as a valid request (e.g., gibberish or accidental typing), do not respond with an analysis. Instead, respond with {{"error": <reason why the input doesn't seem relevant or valid for analysis>}}. If the input is valid, proceed as usual.
 
-        Use the user's bio "{user_bio}" to prioritize indicators that align with the user's lifestyle or preferences. When the user's query is vague, the bio (if present) can provide clues about their priorities or concerns. But focus on the request """{user_query}""", do not shift the main focus away from it and leverage bio details only if applicable. 
+        Use the user's bio given at the end of this prompt to prioritize indicators that align with the user's lifestyle or preferences. When the user's query is vague, the bio (if present) can provide clues about their priorities or concerns. But focus on the user's request, do not shift the main focus away from it and leverage bio details only if applicable. 
 
         Rules for selecting indicators:
 
-        - Select the most relevant indicators for the map analysis of the user's query "{user_query}".
+        - Select the most relevant indicators for the map analysis of the user's query.
         - Identify indicators that directly measure or are significantly impacted by the user's specific request, rather than those that are proxies or indirectly related.
         - Start with most important indicators.
         - Include the subject of analysis into the indicators list. e.g. Forest area for forest analysis, Hotels for hotel analysis.
@@ -42,7 +52,7 @@ async def get_mcda_prompt(query, bio, axis_data) -> str:
         - Each indicator should add distinct and valuable insights to the analysis. Skip adding similar ones. e.g. population density and proximity to populated areas are interchangeable: they both measure population density in different ways, it's redundant to include both.
         - When indicators get colored, the map gets unreadable, because indicators similar in meaning reduce contrast. Do not include indicators capturing the same risk. Avoid pairing "Number of days under cyclone impact, last year (n) (days)" with "Tropical Cyclone hazard (index)", or combining "Hazard & Exposure" layers with any "Number of days under X" layer, because they capture the same risk and provide overlapping insights. When deciding between similar indicators, explain your choice in comment.
         - Diversity of insights and avoidance of duplicate perspectives within a category of risk is crucial – pick diverse indicators.
-        - Ensure that indicators align with """{user_query}""" request, rather than the consequences or secondary effects.
+        - Ensure that indicators align with the user's request, rather than the consequences or secondary effects.
         - Explain your picks in "comment" field. Provide brief explanations for each selected layer, directly linking it to the user's request.
         - Indicators are provided with multiple normalization options (by area, by population, by roads, etc). Select only relevant normalization.
         - Use layerSpatialRes to match the scale of the user's question: "where on the planet" can rely on admin_national layers, "in which city of the country" requires at least admin_subnational or grid_coarse, "where in the city" demands feature_derived or grid_fine. You may select more detailed layers but never less detailed ones.
@@ -85,17 +95,52 @@ async def get_mcda_prompt(query, bio, axis_data) -> str:
         ### Step 4: create a json containing indicators selected for analysis
 
     '''.format(
-        axis_and_indicators_description=get_axis_description(axis_data),
-        solar_farms_example=solar_farms_example,
-        cropland_burn_risk_example=cropland_burn_risk_example,
-        user_bio=bio,
-        user_query=query,
-    )
+    solar_farms_example=solar_farms_example,
+    cropland_burn_risk_example=cropland_burn_risk_example,
+)
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    '''static start of MCDA prompt rendered once per axes catalog version'''
+    text: str
+    # estimated tokens of the text
+    tokens: int
+
+
+async def get_mcda_prompt(query, bio, catalog: AxesCatalog) -> str:
+    '''MCDA Wizard assistant knows terminology and has instructions on what to do with axis data.'''
+    prefix = get_mcda_prompt_prefix(catalog)
+    suffix = get_mcda_prompt_suffix(query, bio)
+    metrics.inc('mcda_prompt.tokens.prefix', prefix.tokens)
+    metrics.inc('mcda_prompt.tokens.suffix', estimate_tokens(suffix))
+    LOGGER.debug('mcda prompt v%s', PROMPT_VERSION)
+    return prefix.text + suffix
+
+
+def get_mcda_prompt_suffix(query, bio) -> str:
+    '''user's request and bio, they go after the static prefix'''
+    return f'''
+        ## User's request
+
+        The user's request is: """{query}""".
+        The user's bio: "{bio}".
+    '''
+
+
+def get_mcda_prompt_prefix(catalog: AxesCatalog) -> PromptPrefix:
+    '''axes, examples and instructions, the same for all requests while axes are the same'''
+    return catalog.derive(f'mcda.prompt_prefix.v{PROMPT_VERSION}', render_mcda_prompt_prefix)
+
+
+def render_mcda_prompt_prefix(catalog: AxesCatalog) -> PromptPrefix:
+    text = '\n        ' + get_axis_description(get_labelled_axes(catalog)) + MCDA_INSTRUCTIONS
+    return PromptPrefix(text=text, tokens=estimate_tokens(text))
     # min, max and stddev values describe an indicator's distribution and help
     # tune visualization scales.
 
 
-def get_axis_description(axis_data: dict) -> str:
+def get_axis_description(labelled_axes: tuple[dict, ...]) -> str:
     axes = [
         {
             'axis_name': x['label'],
@@ -109,7 +154,7 @@ def get_axis_description(axis_data: dict) -> str:
             'layerSpatialRes': x['quotients'][0]['layerSpatialRes'],
             'layerTemporalExt': x['quotients'][0]['layerTemporalExt'],
         }
-        for x in sorted(axis_data['data']['getAxes']['axis'], key=lambda a: a['quality'] or 0, reverse=True)
+        for x in sorted(labelled_axes, key=lambda a: a['quality'] or 0, reverse=True)
         if (x['quality'] and x['quality'] > 0.5
                 and x['quotients'][1]['name'] != 'populated_area_km2')  # weird denominator, area_km2 replaces it for any analysis
     ]
@@ -1,4 +1,3 @@
-import ujson as json
 from json.decoder import JSONDecodeError
 
 from starlette.responses import JSONResponse
@@ -40,20 +39,13 @@ async def save_search_choice(request: 'Request') -> 'Response':
     if not (feature_type := data.get('selectedFeatureType')):
         raise HTTPException(status_code=400, detail='missing selectedFeatureType')
 
-    conn = await get_db_conn()
-    await conn.set_type_codec(
-        'jsonb',
-        encoder=json.dumps,
-        decoder=json.loads,
-        schema='pg_catalog',
-    )
-    await conn.execute('''
-        insert into search_history
-        (app_id, query, search_results, selected_feature, selected_feature_type)
-        values ($1, $2, $3, $4, $5)''',
-        app_id, query, search_results, feature, feature_type
-    )
-    await conn.close()
+    async with get_db_conn() as conn:
+        await conn.execute('''
+            insert into search_history
+            (app_id, query, search_results, selected_feature, selected_feature_type)
+            values ($1, $2, $3, $4, $5)''',
+            app_id, query, search_results, feature, feature_type
+        )
     LOGGER.debug('saved user choice for query = %s', query)
 
     return JSONResponse({})
@@ -1,20 +1,22 @@
 import hashlib
-import ujson as json
 
 import asyncpg
-from aiohttp import ClientSession
 from starlette.responses import JSONResponse
 from starlette.exceptions import HTTPException
 
+from app.clients.http import get_http_session, NOMINATIM_TIMEOUT
 from app.clients.user_profile_client import get_app_data, feature_enabled
 from app.db import get_db_conn
 from app.logger import LOGGER
 from app.secret import Secret
 from app.settings import Settings
+from app.singleflight import SingleFlight
 
 settings = Settings()
 secret = Secret()
 
+nominatim_flight = SingleFlight('nominatim')
+
 
 async def get_nominatim_response_from_cache(conn, cache_key: str) -> dict | None:
     return await conn.fetchval(
@@ -31,43 +33,37 @@ async def search_locations(query: str, lang: str) -> dict:
     if lang:
         url += f'&accept-language={lang}'
     cache_key = hashlib.md5(url.encode("utf-8")).hexdigest()
-
-    conn = await get_db_conn()
-    await conn.set_type_codec(
-        'jsonb',
-        encoder=json.dumps,
-        decoder=json.loads,
-        schema='pg_catalog',
-    )
-    if result := await get_nominatim_response_from_cache(conn, cache_key):
-        await conn.close()
-        LOGGER.debug('found response in cache')
-        return result
-
-    tr = conn.transaction()
-    await tr.start()
-    try:
+    # equal concurrent queries of the worker share one cache lookup and nominatim request
+    return await nominatim_flight.do(cache_key, lambda: _search_locations(url, cache_key))
+
+
+async def _search_locations(url: str, cache_key: str) -> dict:
+    async with get_db_conn() as conn:
+        if result := await get_nominatim_response_from_cache(conn, cache_key):
+            LOGGER.debug('found response in cache')
+            return result
+
+        tr = conn.transaction()
+        await tr.start()
+        try:
+            await conn.execute(
+                'insert into nominatim_cache (query_hash, query, response) values ($1, $2, $3)',
+                cache_key, url, None,
+            )
+        except asyncpg.exceptions.UniqueViolationError:
+            # other transaction saved nominatim response first, return it
+            await tr.rollback()
+            LOGGER.debug('return nominatim response committed by other transaction')
+            return await get_nominatim_response_from_cache(conn, cache_key)
+
+        session = get_http_session()
+        async with session.get('https://nominatim.openstreetmap.org/' + url, timeout=NOMINATIM_TIMEOUT) as response:
+            nominatim_response = await response.json()
         await conn.execute(
-            'insert into nominatim_cache (query_hash, query, response) values ($1, $2, $3)',
-            cache_key, url, None,
+            'update nominatim_cache set response = $1 where query_hash = $2',
+            nominatim_response, cache_key,
         )
-    except asyncpg.exceptions.UniqueViolationError:
-        # other transaction saved nominatim response first, return it
-        await tr.rollback()
-        LOGGER.debug('return nominatim response committed by other transaction')
-        result = await get_nominatim_response_from_cache(conn, cache_key)
-        await conn.close()
-        return result
-
-    async with ClientSession() as session:
-        async with session.get('https://nominatim.openstreetmap.org/' + url) as response:
-            nominatim_response = await response.json()
-    await conn.execute(
-        'update nominatim_cache set response = $1 where query_hash = $2',
-        nominatim_response, cache_key,
-    )
-    await tr.commit()
-    await conn.close()
+        await tr.commit()
     LOGGER.debug('saved nominatim response for query = %s', url)
     return nominatim_response
 
@@ -0,0 +1,56 @@
+'''
+Memory of analytics pipeline measured with tracemalloc:
+    - world: flattened world analytics, kept in memory per catalog version
+    - request: area tables, ranking, reference rows and sentences of one /llm-analytics request
+
+    python -m benchmarks.analytics_memory
+'''
+import tracemalloc
+
+from app.clients.axes_catalog import AxesCatalog
+from app.clients.insights_api_client import (
+    AnalyticsTable, get_interned, get_sentence_formatters, get_world_calculations_from, rank_area_stats,
+    to_readable_sentence, settings,
+)
+from tests.fixtures import make_axes, make_analytics
+
+
+def measure(fn):
+    '''(result, peak bytes, allocated blocks still alive)'''
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    return result, peak, blocks
+
+
+def main():
+    print(f'{"indicators":>10} {"stage":>8} {"peak KB":>9} {"blocks":>8}')
+    for indicators in (300, 3000):
+        axes = make_axes(indicators)
+        catalog = AxesCatalog(axes)
+        metadata = catalog.metadata
+        world, selected, reference = (make_analytics(axes, seed) for seed in (1, 2, 3))
+
+        calculations_world, peak, blocks = measure(lambda: get_world_calculations_from(world, catalog))
+        print(f'{indicators:>10} {"world":>8} {peak / 1024:>9.0f} {blocks:>8}')
+
+        def request():
+            interned = get_interned(catalog)
+            selected_area = AnalyticsTable(selected, metadata, interned)
+            reference_area = AnalyticsTable(reference, metadata, interned)
+            rows = rank_area_stats(calculations_world, selected_area, reference_area, settings.MAX_ANALYTICS_SENTENCES)
+            keys = [(x.calculation, x.numerator, x.denominator) for x in rows]
+            world_rows = {key: calculations_world[key].as_dict() for key in keys if key in calculations_world}
+            reference_rows = {key: x.as_dict() for key, x in reference_area.rows(keys).items()}
+            return rows, to_readable_sentence(
+                [x.as_dict() for x in rows], world_rows, reference_rows, get_sentence_formatters(catalog))
+
+        _, peak, blocks = measure(request)
+        print(f'{indicators:>10} {"request":>8} {peak / 1024:>9.0f} {blocks:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''
+Flatten and rank analytics of selected and reference areas:
+a dict per row with a full sort (flatten_analytics + sorted_area_stats, the test reference)
+against columns with top-K selection (AnalyticsTable + rank_area_stats).
+Checks that both produce the same rows.
+
+    python -m benchmarks.analytics_ranking
+'''
+import gc
+import timeit
+
+from app.clients.axes_catalog import AxesCatalog
+from app.clients.insights_api_client import (
+    AnalyticsTable, flatten_analytics, get_interned, rank_area_stats, settings,
+)
+from tests.fixtures import make_axes, make_analytics
+from tests.test_analytics import sorted_area_stats
+
+REPEAT = 5
+
+
+def main():
+    limit = settings.MAX_ANALYTICS_SENTENCES
+    print(f'{"indicators":>10} {"rows":>7} {"sorted ms":>10} {"top-K ms":>11} {"same":>5}')
+    for indicators in (300, 1000, 3000):
+        axes = make_axes(indicators)
+        catalog = AxesCatalog(axes)
+        metadata = catalog.metadata
+        # keys and labels are interned per catalog, like for requests
+        interned = get_interned(catalog)
+        world, selected, reference = (make_analytics(axes, seed) for seed in (1, 2, 3))
+        calculations_world = flatten_analytics(world, metadata, interned)
+        # fixtures are long lived, keep them out of GC passes
+        gc.collect()
+        gc.freeze()
+
+        def sorted_rows():
+            return sorted_area_stats(
+                calculations_world, flatten_analytics(selected, metadata), flatten_analytics(reference, metadata), limit)
+
+        def columns():
+            return rank_area_stats(
+                calculations_world,
+                AnalyticsTable(selected, metadata, interned),
+                AnalyticsTable(reference, metadata, interned),
+                limit,
+            )
+
+        rows = len(flatten_analytics(selected, metadata))
+        same = sorted_rows() == [x.as_dict() for x in columns()]
+        sorted_ms = min(timeit.repeat(sorted_rows, number=1, repeat=REPEAT)) * 1000
+        columns_ms = min(timeit.repeat(columns, number=1, repeat=REPEAT)) * 1000
+        print(f'{indicators:>10} {rows:>7} {sorted_ms:>10.1f} {columns_ms:>11.1f} {str(same):>5}')
+        gc.unfreeze()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''
+Simplification of boundaries before they are sent to insights-api:
+vertices, request bytes, time spent and area error for boundaries of growing size.
+Real boundaries, e.g. exported from OSM, are measured as well when GeoJSON files are given.
+
+    python -m benchmarks.geometry_simplify [boundary.geojson ...]
+'''
+import sys
+import time
+
+import ujson as json
+
+from app.geometry import count_vertices, extract_geometries, signed_area, simplify_area
+from app.settings import Settings
+from tests.fixtures import make_boundary
+
+settings = Settings()
+
+# (vertices, radius in degrees): drawn neighbourhoods, district, region, country
+CASES = [(500, 0.003), (500, 0.01), (2_000, 0.1), (20_000, 1.0), (200_000, 5.0)]
+
+
+def area_of(geojson: dict) -> float:
+    area = 0.0
+    for g in extract_geometries(geojson):
+        for polygon in g['coordinates'] if g['type'] == 'MultiPolygon' else [g['coordinates']]:
+            area += abs(signed_area(polygon[0][:-1])) - sum(abs(signed_area(r[:-1])) for r in polygon[1:])
+    return area
+
+
+def main(paths: list[str]):
+    boundaries = [(f'{radius}', make_boundary(vertices, radius=radius)) for vertices, radius in CASES]
+    for path in paths:
+        with open(path) as f:
+            boundaries.append((path, json.load(f)))
+    print(f'{"vertices":>10} {"boundary":>20} {"kept":>8} {"KB before":>10} {"KB after":>9} {"ms":>8} {"area error":>11}')
+    for name, boundary in boundaries:
+        vertices = count_vertices(extract_geometries(boundary))
+        started = time.perf_counter()
+        simplified, _, kept = simplify_area(
+            boundary,
+            settings.GEOMETRY_SIMPLIFY_MAX_RESOLUTION,
+            settings.GEOMETRY_SIMPLIFY_MAX_CELLS,
+            settings.GEOMETRY_MAX_VERTICES,
+        )
+        elapsed = (time.perf_counter() - started) * 1000
+        error = abs(area_of(simplified) / area_of(boundary) - 1)
+        print(f'{vertices:>10} {name[-20:]:>20} {kept:>8} {len(json.dumps(boundary)) / 1024:>10.1f} '
+              f'{len(json.dumps(simplified)) / 1024:>9.1f} {elapsed:>8.1f} {error:>10.4%}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
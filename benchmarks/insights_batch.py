@@ -0,0 +1,117 @@
+'''
+Compare insights-api request modes for selected and reference areas:
+    - legacy: a query per area, GeoJSON escaped into the query text
+    - variables: a query per area, GeoJSON passed as a variable
+    - batched: one query with an alias per area
+
+Runs a local fake insights-api, reports request bytes and latency.
+
+    python -m benchmarks.insights_batch [vertices]
+'''
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import ujson as json
+from aiohttp import web
+
+PORT = 8791
+os.environ.setdefault('INSIGHTS_API_URL', f'http://127.0.0.1:{PORT}/graphql')
+
+from app.clients import insights_api_client
+from app.clients.http import get_http_session, close_http_session
+from tests.fixtures import make_axes, make_analytics, make_boundary
+
+# processing time of insights-api per HTTP request, not counting the analytics itself
+UPSTREAM_OVERHEAD = 0.02
+ROUNDS = 20
+
+legacy_graphql = '''
+{
+  polygonStatistic (polygonStatisticRequest: {polygon: "%s"})
+  {''' + insights_api_client.advanced_analytics_fields + '''
+  }
+}
+'''
+
+stats = {'requests': 0, 'bytes': 0}
+
+
+def make_app(analytics: dict) -> web.Application:
+    polygon_statistic = analytics['data']['polygonStatistic']
+
+    async def graphql(request: web.Request) -> web.Response:
+        body = await request.read()
+        stats['requests'] += 1
+        stats['bytes'] += len(body)
+        payload = json.loads(body)
+        await asyncio.sleep(UPSTREAM_OVERHEAD)
+        # parse polygons like the real service does
+        if variables := payload.get('variables'):
+            for polygon in variables.values():
+                json.loads(polygon)
+            data = {alias: polygon_statistic for alias in variables}
+        else:
+            query = payload['query']
+            start = query.index('polygon: "') + len('polygon: "')
+            json.loads(json.loads('"' + query[start:query.index('"})', start)] + '"'))
+            data = {'polygonStatistic': polygon_statistic}
+        return web.json_response({'data': data}, dumps=json.dumps)
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post('/graphql', graphql)
+    return app
+
+
+async def legacy(areas: list[dict]):
+    session = get_http_session()
+
+    async def query(area):
+        geojson = json.dumps(area)
+        query = legacy_graphql % geojson.replace('\\', '\\\\').replace('"', '\\"')
+        async with session.post(insights_api_client.settings.INSIGHTS_API_URL, json={'query': query}) as resp:
+            return await resp.json()
+
+    return await asyncio.gather(*(query(area) for area in areas))
+
+
+async def variables(areas: list[dict]):
+    insights_api_client.settings.INSIGHTS_API_BATCH_QUERIES = False
+    return await insights_api_client.query_polygon_statistic(get_http_session(), areas)
+
+
+async def batched(areas: list[dict]):
+    insights_api_client.settings.INSIGHTS_API_BATCH_QUERIES = True
+    return await insights_api_client.query_polygon_statistic(get_http_session(), areas)
+
+
+async def main(vertices: int):
+    analytics = make_analytics(make_axes())
+    runner = web.AppRunner(make_app(analytics))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', PORT).start()
+
+    areas = [make_boundary(vertices, seed=1), make_boundary(vertices // 10, seed=2)]
+    print(f'selected area: {vertices} vertices, reference area: {vertices // 10} vertices')
+    print(f'{"mode":<10} {"requests":>8} {"request KB":>11} {"median ms":>10} {"p90 ms":>8}')
+    try:
+        for name, fn in (('legacy', legacy), ('variables', variables), ('batched', batched)):
+            await fn(areas)  # warm up connections
+            stats.update(requests=0, bytes=0)
+            timings = []
+            for _ in range(ROUNDS):
+                started = time.perf_counter()
+                await fn(areas)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            print(f'{name:<10} {stats["requests"] / ROUNDS:>8.0f} {stats["bytes"] / ROUNDS / 1024:>11.1f} '
+                  f'{statistics.median(timings):>10.1f} {timings[int(len(timings) * 0.9)]:>8.1f}')
+    finally:
+        await close_http_session()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,67 @@
+'''
+Compare LLM backends of OpenAIClient for one analytics-sized prompt:
+    - assistants, polled: thread with the prompt, run polled until it's completed
+    - assistants: thread with the prompt, run events streamed
+    - chat: one chat completion request
+
+Runs a local fake OpenAI API where every request costs LATENCY on top of
+the model time, reports OpenAI calls and latency per prompt.
+
+    python -m benchmarks.llm_backends [prompt characters]
+'''
+import asyncio
+import os
+import statistics
+import sys
+import time
+import warnings
+
+PORT = 8793
+os.environ.setdefault('OPENAI_BASE_URL', f'http://127.0.0.1:{PORT}/v1')
+os.environ.setdefault('OPENAI_API_KEY', 'fake')
+os.environ.setdefault('OPENAI_ANALYTICS_ASSISTANT', 'assistant')
+
+from app.clients import openai_client
+from app.clients.openai_client import OpenAIClient, split_prompt
+from app.clients.openai_registry import close_openai_client
+from tests.fake_openai import FakeOpenAI
+
+# network round trip and processing of a request by OpenAI, not counting the model
+LATENCY = 0.15
+RUN_SECONDS = 2.0
+ROUNDS = 5
+
+
+async def main(prompt_size: int):
+    # Assistants API is deprecated by the SDK
+    warnings.simplefilter('ignore', DeprecationWarning)
+    fake = FakeOpenAI(run_seconds=RUN_SECONDS, latency=LATENCY)
+    await fake.start(PORT)
+    line = 'mean of population over area in the selected area is 1.5 times larger than in the world;\n'
+    prompt = line * (prompt_size // len(line))
+    print(f'prompt: {len(prompt)} characters in {len(split_prompt(prompt))} messages, '
+          f'{LATENCY * 1000:.0f} ms per request, {RUN_SECONDS * 1000:.0f} ms of the model')
+    print(f'{"backend":<20} {"calls":>6} {"median ms":>10} {"max ms":>8}')
+    try:
+        for name, backend, stream_runs in (
+            ('assistants, polled', 'assistants', False),
+            ('assistants', 'assistants', True),
+            ('chat', 'chat', True),
+        ):
+            openai_client.settings.OPENAI_STREAM_RUNS = stream_runs
+            client = OpenAIClient(assistant_name='assistant', instructions='instructions', backend=backend)
+            await client.assistant
+            fake.requests.clear()
+            timings = []
+            for _ in range(ROUNDS):
+                started = time.perf_counter()
+                await client.get_llm_commentary(prompt)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f'{name:<20} {fake.calls / ROUNDS:>6.1f} {statistics.median(timings):>10.0f} {max(timings):>8.0f}')
+    finally:
+        await close_openai_client()
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 60000))
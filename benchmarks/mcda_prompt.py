@@ -0,0 +1,51 @@
+'''
+Build MCDA prompt (get_mcda_prompt) for a request: the prefix with axes
+rendered for every request against the one memoized per catalog version.
+Checks that both produce the same prompt.
+
+    python -m benchmarks.mcda_prompt
+'''
+import asyncio
+import time
+
+from app.clients.axes_catalog import AxesCatalog
+from app.views.mcda.prompt import get_mcda_prompt, get_mcda_prompt_suffix, render_mcda_prompt_prefix
+from tests.fixtures import make_axes
+
+NUMBER = 20
+REPEAT = 5
+QUERY = 'Best place to put solar farms'
+BIO = 'I am an urban planner'
+
+
+async def best_ms(build) -> float:
+    '''min of REPEAT runs of NUMBER awaited builds, per build'''
+    timings = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        for _ in range(NUMBER):
+            await build()
+        timings.append((time.perf_counter() - started) * 1000 / NUMBER)
+    return min(timings)
+
+
+async def main():
+    print(f'{"indicators":>10} {"tokens":>7} {"rendered ms":>12} {"memoized ms":>12} {"same":>5}')
+    for indicators in (100, 300, 1000):
+        catalog = AxesCatalog(make_axes(indicators))
+
+        async def rendered():
+            return render_mcda_prompt_prefix(catalog).text + get_mcda_prompt_suffix(QUERY, BIO)
+
+        async def memoized():
+            return await get_mcda_prompt(QUERY, BIO, catalog)
+
+        prompt = await memoized()
+        same = await rendered() == prompt
+        rendered_ms = await best_ms(rendered)
+        memoized_ms = await best_ms(memoized)
+        print(f'{indicators:>10} {len(prompt) // 4:>7} {rendered_ms:>12.2f} {memoized_ms:>12.3f} {str(same):>5}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+'''
+Burst of LLM calls from several apps against OpenAI token rate limit:
+    - unlimited: every call goes to OpenAI at once, 429 responses are retried by the SDK
+    - admission: calls are admitted by rate-limit headers and queued fairly between apps
+
+Runs a local fake OpenAI API with a token budget per second, reports
+failed calls, 429 responses and latency of the calls per app.
+
+    python -m benchmarks.openai_burst [calls]
+'''
+import asyncio
+import os
+import statistics
+import sys
+import time
+from unittest import mock
+
+PORT = 8794
+os.environ.setdefault('OPENAI_BASE_URL', f'http://127.0.0.1:{PORT}/v1')
+os.environ.setdefault('OPENAI_API_KEY', 'fake')
+os.environ.setdefault('OPENAI_ANALYTICS_ASSISTANT', 'assistant')
+# the fake replenishes its limit every second
+os.environ.setdefault('OPENAI_RATE_LIMIT_WINDOW', '1')
+
+from starlette.exceptions import HTTPException
+import openai
+
+from app.clients.openai_admission import Budget, openai_admission
+from app.clients.openai_client import OpenAIClient
+from app.clients.openai_registry import close_openai_client
+from tests.fake_openai import FakeOpenAI
+
+APPS = ('app-1', 'app-2', 'app-3', 'app-4')
+PROMPT = 'mean of population over area in the selected area is 1.5 times larger than in the world;\n' * 250
+TOKEN_LIMIT = 40000
+
+
+async def burst(calls: int) -> tuple[int, dict[str, list[float]]]:
+    failed = 0
+    timings = {app: [] for app in APPS}
+
+    async def call(app_id: str):
+        nonlocal failed
+        client = OpenAIClient(assistant_name='assistant', backend='chat', app_id=app_id)
+        started = time.perf_counter()
+        try:
+            await client.get_llm_commentary(PROMPT)
+        except (HTTPException, openai.APIError):
+            failed += 1
+            return
+        timings[app_id].append(time.perf_counter() - started)
+
+    # the first app sends half of the calls
+    apps = [APPS[0] if i % 2 else APPS[1 + i // 2 % (len(APPS) - 1)] for i in range(calls)]
+    await asyncio.gather(*(call(app_id) for app_id in apps))
+    return failed, timings
+
+
+async def main(calls: int):
+    fake = FakeOpenAI(run_seconds=0.5, latency=0.05, token_limit=TOKEN_LIMIT, window=1.0)
+    await fake.start(PORT)
+    await OpenAIClient(assistant_name='assistant').assistant
+    print(f'{calls} calls of ~{len(PROMPT) // 4} tokens, {TOKEN_LIMIT} tokens per second')
+    print(f'{"mode":<10} {"failed":>6} {"429":>5} {"median s":>9} {"max s":>6}  '
+          + ' '.join(f'{app + " s":>8}' for app in APPS))
+    try:
+        for name, admission in (('unlimited', False), ('admission', True)):
+            fake.requests.clear()
+            await asyncio.sleep(1.0)
+            with mock.patch.object(openai_admission, 'max_concurrency', openai_admission.max_concurrency if admission else 10 ** 6), \
+                    mock.patch.object(openai_admission, 'on_headers', openai_admission.on_headers if admission else lambda *args: None), \
+                    mock.patch.object(openai_admission, '_wait', openai_admission._wait if admission else lambda *args: 0.0), \
+                    mock.patch.object(openai_admission, 'tokens', openai_admission.tokens if admission else Budget()):
+                failed, timings = await burst(calls)
+            all_timings = sorted(x for values in timings.values() for x in values)
+            print(f'{name:<10} {failed:>6} {fake.requests["rate_limited"]:>5} '
+                  f'{statistics.median(all_timings):>9.2f} {all_timings[-1]:>6.2f}  '
+                  + ' '.join(f'{statistics.median(timings[app]) if timings[app] else 0:>8.2f}' for app in APPS))
+    finally:
+        await close_openai_client()
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 48))
@@ -0,0 +1,78 @@
+'''
+Compare ways to wait for an assistant run:
+    - legacy: status is polled every second, then messages are listed
+    - polling: status is polled with growing intervals, then messages are listed
+    - streaming: run events are streamed until it's completed
+
+Runs a local fake OpenAI API, reports OpenAI calls per run and latency added
+on top of the run itself.
+
+    python -m benchmarks.openai_runs
+'''
+import asyncio
+import os
+import statistics
+import time
+import warnings
+
+PORT = 8792
+os.environ.setdefault('OPENAI_BASE_URL', f'http://127.0.0.1:{PORT}/v1')
+os.environ.setdefault('OPENAI_API_KEY', 'fake')
+os.environ.setdefault('OPENAI_ANALYTICS_ASSISTANT', 'assistant')
+
+from openai import AsyncOpenAI
+
+from app.clients import openai_client
+from app.clients.openai_client import OpenAIClient
+from app.clients.openai_registry import close_openai_client
+from tests.fake_openai import FakeOpenAI
+
+# model time of the runs, spread over the polling intervals
+RUN_SECONDS = (0.6, 1.1, 1.7, 2.4, 3.3, 4.6)
+PROMPT = 'Describe the selected area.\n' * 100
+
+
+async def legacy(client: AsyncOpenAI, thread_id: str, run_params: dict, on_delta=None) -> tuple[str, str]:
+    run = await client.beta.threads.runs.create(thread_id=thread_id, **run_params)
+    while not run.status == 'completed':
+        await asyncio.sleep(1)
+        run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    messages = await client.beta.threads.messages.list(thread_id=thread_id)
+    return messages.data[0].content[0].text.value, run.id
+
+
+async def main():
+    # Assistants API is deprecated by the SDK
+    warnings.simplefilter('ignore', DeprecationWarning)
+    fake = FakeOpenAI()
+    await fake.start(PORT)
+    client = OpenAIClient(assistant_name='assistant')
+    await client.assistant
+    stream_run = openai_client.stream_run
+
+    print(f'{"mode":<10} {"calls":>6} {"median ms":>10} {"max ms":>8}  (latency on top of the run)')
+    try:
+        for name, driver, streaming in (
+            ('legacy', legacy, True),
+            ('polling', stream_run, False),
+            ('streaming', stream_run, True),
+        ):
+            openai_client.stream_run = driver
+            openai_client.settings.OPENAI_STREAM_RUNS = streaming
+            fake.requests.clear()
+            overheads = []
+            for run_seconds in RUN_SECONDS:
+                fake.run_seconds = run_seconds
+                started = time.perf_counter()
+                await client.get_llm_commentary(PROMPT)
+                overheads.append((time.perf_counter() - started - run_seconds) * 1000)
+            calls = fake.calls / len(RUN_SECONDS)
+            print(f'{name:<10} {calls:>6.1f} {statistics.median(overheads):>10.0f} {max(overheads):>8.0f}')
+    finally:
+        openai_client.stream_run = stream_run
+        await close_openai_client()
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
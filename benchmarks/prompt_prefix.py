@@ -0,0 +1,77 @@
+'''
+Share of prompt tokens served from prompt cache of OpenAI for requests of
+different users: MCDA prompts of different queries and bios, analytics
+prompts of different areas.
+
+Runs a local fake OpenAI API that caches prompt prefixes the way OpenAI does,
+the prompts are sent by chat LLM backend with INSTRUCTIONS as system message.
+
+    python -m benchmarks.prompt_prefix
+'''
+import asyncio
+import random
+from types import SimpleNamespace
+
+from openai import AsyncOpenAI
+
+from app import metrics
+from app.area import Area
+from app.clients.axes_catalog import AxesCatalog
+from app.clients.openai_client import ChatBackend, get_analytics_prompt
+from app.views.mcda.prompt import get_mcda_prompt
+from tests.fake_openai import FakeOpenAI
+from tests.fixtures import make_axes
+
+REQUESTS = 20
+INSTRUCTIONS = 'Answer in markdown, keep the report short and specific. ' * 80
+ASSISTANT = SimpleNamespace(
+    id='asst_0', model='gpt-fake', instructions=None, temperature=None, top_p=None, response_format=None,
+)
+
+
+async def mcda_prompts(catalog: AxesCatalog) -> list[str]:
+    return [
+        await get_mcda_prompt(f'best place for business #{i}', f'bio of user {i}', catalog)
+        for i in range(REQUESTS)
+    ]
+
+
+def analytics_prompts(catalog: AxesCatalog) -> list[str]:
+    rnd = random.Random(1)
+    prompts = []
+    for i in range(REQUESTS):
+        area = Area(geojson={}, hash=str(i), bbox=None, vertices=0, properties=f'{{"name": "Area {i}"}}')
+        sentences = [
+            f'mean of {label} is {rnd.random():.3f} (world: {rnd.random():.3f})'
+            for label in list(catalog.metadata)[:100]
+        ]
+        descriptions = [(x, f'{x} description') for x in catalog.metadata][:100]
+        prompts.append(get_analytics_prompt(sentences, descriptions, f'bio of user {i}', None, area, None))
+    return prompts
+
+
+async def main():
+    fake = FakeOpenAI(run_seconds=0)
+    client = AsyncOpenAI(base_url=await fake.start(), api_key='fake', max_retries=0)
+    backend = ChatBackend(client)
+    catalog = AxesCatalog(make_axes())
+    print(f'{REQUESTS} requests, {len(INSTRUCTIONS) // 4} tokens of instructions')
+    print(f'{"prompt":<12} {"prompt tokens":>14} {"cached":>8} {"share":>6}')
+    try:
+        for name, prompts in (('mcda', await mcda_prompts(catalog)), ('analytics', analytics_prompts(catalog))):
+            fake.prompts.clear()
+            counters = metrics.snapshot()['counters']
+            before = counters.get('openai.prompt_tokens', 0), counters.get('openai.cached_prompt_tokens', 0)
+            for prompt in prompts:
+                await backend.complete(ASSISTANT, prompt, INSTRUCTIONS, True)
+            counters = metrics.snapshot()['counters']
+            total = counters['openai.prompt_tokens'] - before[0]
+            cached = counters['openai.cached_prompt_tokens'] - before[1]
+            print(f'{name:<12} {total:>14} {cached:>8} {cached / total:>6.0%}')
+    finally:
+        await client.close()
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
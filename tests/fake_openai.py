@@ -0,0 +1,285 @@
+'''
+Local fake of OpenAI Assistants and Chat Completions API used by benchmarks and tests.
+
+A run or a completion takes run_seconds, its answer is streamed in chunks
+spread over that time when the client asks for a stream. Every request
+takes latency seconds more. Requests are counted per endpoint.
+With drop_streams, streams of runs end before the first event while the run goes on.
+
+With token_limit, prompts of runs and completions are limited to that many
+tokens per window seconds like OpenAI rate limits: the budget is replenished
+continuously, it's reported in x-ratelimit headers, requests over it get 429.
+
+Chat completions report usage like OpenAI prompt caching does: the longest
+prefix shared with an earlier prompt is cached in 128 token steps once it's
+1024 tokens or more.
+'''
+import asyncio
+import itertools
+import os
+import time
+from collections import Counter
+
+import ujson as json
+from aiohttp import web
+
+ANSWER = 'Selected area has **more** population than the reference area, see details below.'
+CHARS_PER_TOKEN = 4
+
+
+class FakeOpenAI:
+
+    def __init__(
+            self,
+            run_seconds: float = 1.0,
+            chunks: int = 10,
+            streaming: bool = True,
+            drop_streams: bool = False,
+            answer: str = ANSWER,
+            latency: float = 0.0,
+            token_limit: int = None,
+            window: float = 1.0,
+    ):
+        self.run_seconds = run_seconds
+        self.chunks = chunks
+        self.streaming = streaming
+        self.drop_streams = drop_streams
+        self.answer = answer
+        self.latency = latency
+        self.token_limit = token_limit
+        self.window = window
+        self.refilled_at = time.monotonic()
+        self.tokens_used = 0.0
+        self.assistants = [{
+            'id': 'asst_0', 'object': 'assistant', 'name': 'assistant', 'model': 'gpt-fake',
+            'instructions': 'be brief', 'temperature': 1.0, 'top_p': 1.0, 'response_format': 'auto',
+        }]
+        self.completions = []
+        self.prompts = []
+        self.requests = Counter()
+        self.runs = {}
+        self._ids = itertools.count()
+        self._runner = None
+
+    @property
+    def calls(self) -> int:
+        return sum(self.requests.values())
+
+    def _id(self, prefix: str) -> str:
+        return f'{prefix}_{next(self._ids)}'
+
+    def _run(self, thread_id: str, run_id: str) -> dict:
+        run = self.runs[run_id]
+        if run['cancelled']:
+            status = 'cancelled'
+        elif time.monotonic() - run['started'] >= self.run_seconds:
+            status = 'completed'
+        else:
+            status = 'in_progress'
+        return {
+            'id': run_id, 'object': 'thread.run', 'thread_id': thread_id,
+            'assistant_id': run['assistant_id'], 'status': status, 'last_error': None,
+        }
+
+    def _message(self, thread_id: str, run_id: str | None, text: str, status: str = 'completed') -> dict:
+        return {
+            'id': 'msg_' + (run_id or thread_id), 'object': 'thread.message', 'thread_id': thread_id,
+            'run_id': run_id, 'role': 'assistant', 'status': status,
+            'content': [{'type': 'text', 'text': {'value': text, 'annotations': []}}],
+        }
+
+    def _chunks(self) -> list[str]:
+        size = -(-len(self.answer) // self.chunks)
+        return [self.answer[i:i + size] for i in range(0, len(self.answer), size)]
+
+    def _usage(self, messages: list[dict]) -> dict:
+        prompt = ''.join(x['content'] for x in messages)
+        shared = max((len(os.path.commonprefix([prompt, x])) for x in self.prompts), default=0)
+        self.prompts.append(prompt)
+        cached = shared // CHARS_PER_TOKEN // 128 * 128
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+        completion_tokens = len(self.answer) // CHARS_PER_TOKEN
+        return {
+            'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': cached if cached >= 1024 else 0},
+        }
+
+    async def list_assistants(self, request: web.Request) -> web.Response:
+        self.requests['assistants.list'] += 1
+        return web.json_response({'object': 'list', 'data': self.assistants, 'has_more': False}, dumps=json.dumps)
+
+    async def create_thread(self, request: web.Request) -> web.Response:
+        self.requests['threads.create'] += 1
+        return web.json_response({'id': self._id('thread'), 'object': 'thread'}, dumps=json.dumps)
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        self.requests['messages.create'] += 1
+        body = await request.json(loads=json.loads)
+        thread_id = request.match_info['thread_id']
+        message = self._message(thread_id, None, body['content']) | {'role': 'user'}
+        return web.json_response(message, dumps=json.dumps)
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        self.requests['messages.list'] += 1
+        thread_id = request.match_info['thread_id']
+        message = self._message(thread_id, request.query.get('run_id'), self.answer)
+        return web.json_response({'object': 'list', 'data': [message], 'has_more': False}, dumps=json.dumps)
+
+    async def retrieve_run(self, request: web.Request) -> web.Response:
+        self.requests['runs.retrieve'] += 1
+        return web.json_response(self._run(request.match_info['thread_id'], request.match_info['run_id']), dumps=json.dumps)
+
+    async def list_runs(self, request: web.Request) -> web.Response:
+        self.requests['runs.list'] += 1
+        thread_id = request.match_info['thread_id']
+        runs = [self._run(thread_id, run_id) for run_id, run in reversed(self.runs.items()) if run['thread_id'] == thread_id]
+        limit = int(request.query.get('limit', 20))
+        return web.json_response({'object': 'list', 'data': runs[:limit], 'has_more': False}, dumps=json.dumps)
+
+    async def create_run(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json(loads=json.loads)
+        thread_id = request.match_info['thread_id']
+        if body.get('stream'):
+            self.requests['runs.stream'] += 1
+            if not self.streaming:
+                return web.json_response({'error': {'message': 'streaming is not available'}}, status=501)
+        else:
+            self.requests['runs.create'] += 1
+        run_id = self._id('run')
+        self.runs[run_id] = {
+            'started': time.monotonic(), 'thread_id': thread_id, 'assistant_id': body['assistant_id'], 'cancelled': False,
+        }
+        if not body.get('stream'):
+            return web.json_response(self._run(thread_id, run_id), dumps=json.dumps)
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        if self.drop_streams:
+            return response
+
+        async def send(event: str, data: dict):
+            await response.write(f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode())
+
+        await send('thread.run.created', self._run(thread_id, run_id))
+        message = self._message(thread_id, run_id, '', status='in_progress')
+        await send('thread.message.created', message)
+        chunks = self._chunks()
+        for chunk in chunks:
+            await asyncio.sleep(self.run_seconds / len(chunks))
+            if self.runs[run_id]['cancelled']:
+                # client has closed the stream
+                return response
+            await send('thread.message.delta', {
+                'id': message['id'], 'object': 'thread.message.delta',
+                'delta': {'content': [{'index': 0, 'type': 'text', 'text': {'value': chunk}}]},
+            })
+        await send('thread.message.completed', self._message(thread_id, run_id, self.answer))
+        await send('thread.run.completed', self._run(thread_id, run_id))
+        await response.write(b'event: done\ndata: [DONE]\n\n')
+        return response
+
+    async def cancel_run(self, request: web.Request) -> web.Response:
+        self.requests['runs.cancel'] += 1
+        self.runs[request.match_info['run_id']]['cancelled'] = True
+        return web.json_response(self._run(request.match_info['thread_id'], request.match_info['run_id']), dumps=json.dumps)
+
+    async def create_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json(loads=json.loads)
+        self.completions.append(body)
+        completion_id = self._id('chatcmpl')
+        usage = self._usage(body['messages'])
+        if not body.get('stream'):
+            self.requests['chat.completions.create'] += 1
+            await asyncio.sleep(self.run_seconds)
+            return web.json_response({
+                'id': completion_id, 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                'choices': [{
+                    'index': 0, 'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': self.answer},
+                }],
+                'usage': usage,
+            }, dumps=json.dumps)
+
+        self.requests['chat.completions.stream'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        chunks = self._chunks()
+        for i, chunk in enumerate(chunks):
+            await asyncio.sleep(self.run_seconds / len(chunks))
+            await response.write(b'data: ' + json.dumps({
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                'choices': [{
+                    'index': 0, 'delta': {'content': chunk},
+                    'finish_reason': 'stop' if i == len(chunks) - 1 else None,
+                }],
+            }).encode() + b'\n\n')
+        if (body.get('stream_options') or {}).get('include_usage'):
+            await response.write(b'data: ' + json.dumps({
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                'choices': [], 'usage': usage,
+            }).encode() + b'\n\n')
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+    @web.middleware
+    async def delay(self, request: web.Request, handler) -> web.StreamResponse:
+        await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens_used = max(self.tokens_used - self.token_limit * (now - self.refilled_at) / self.window, 0.0)
+        self.refilled_at = now
+
+    @web.middleware
+    async def rate_limit(self, request: web.Request, handler) -> web.StreamResponse:
+        if self.token_limit is None:
+            return await handler(request)
+        if request.method == 'POST' and request.path.endswith(('/runs', '/completions', '/threads')):
+            tokens = len(await request.read()) // 4
+            self._refill()
+            if self.tokens_used + tokens > self.token_limit:
+                self.requests['rate_limited'] += 1
+                retry_after = (self.tokens_used + tokens - self.token_limit) * self.window / self.token_limit
+                return web.json_response(
+                    {'error': {'message': 'rate limit reached', 'type': 'tokens', 'code': 'rate_limit_exceeded'}},
+                    status=429, headers={'retry-after': f'{retry_after:.3f}'},
+                )
+            self.tokens_used += tokens
+        return await handler(request)
+
+    async def rate_limit_headers(self, request: web.Request, response: web.StreamResponse):
+        if self.token_limit is not None:
+            self._refill()
+            # time until the budget is full again
+            reset_in = self.tokens_used * self.window / self.token_limit
+            response.headers['x-ratelimit-limit-tokens'] = str(self.token_limit)
+            response.headers['x-ratelimit-remaining-tokens'] = str(int(self.token_limit - self.tokens_used))
+            response.headers['x-ratelimit-reset-tokens'] = f'{reset_in * 1000:.0f}ms'
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.delay, self.rate_limit])
+        app.on_response_prepare.append(self.rate_limit_headers)
+        app.router.add_get('/v1/assistants', self.list_assistants)
+        app.router.add_post('/v1/threads', self.create_thread)
+        app.router.add_post('/v1/threads/{thread_id}/messages', self.create_message)
+        app.router.add_get('/v1/threads/{thread_id}/messages', self.list_messages)
+        app.router.add_get('/v1/threads/{thread_id}/runs', self.list_runs)
+        app.router.add_post('/v1/threads/{thread_id}/runs', self.create_run)
+        app.router.add_get('/v1/threads/{thread_id}/runs/{run_id}', self.retrieve_run)
+        app.router.add_post('/v1/threads/{thread_id}/runs/{run_id}/cancel', self.cancel_run)
+        app.router.add_post('/v1/chat/completions', self.create_completion)
+        return app
+
+    async def start(self, port: int = 0) -> str:
+        '''returns base URL for OpenAI client'''
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{port}/v1'
+
+    async def stop(self):
+        await self._runner.cleanup()
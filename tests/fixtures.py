@@ -0,0 +1,103 @@
+'''
+Synthetic insights-api data for tests and benchmarks.
+'''
+import math
+import random
+
+UNITS = ['people', 'number', 'square kilometers', 'date', 'index', None, 'degrees Celsius', 'United States dollar']
+DENOMINATORS = [
+    ('one', '1', None),
+    ('population', 'Population', 'people'),
+    ('area_km2', 'Area', 'square kilometers'),
+]
+CALCULATIONS = ['mean', 'stddev', 'max', 'min', 'sum']
+
+
+def make_indicator(name: str, label: str, unit: str | None, emoji: str = None) -> dict:
+    return {
+        'name': name,
+        'label': label,
+        'maxZoom': 8,
+        'emoji': emoji,
+        'description': f'{label} description',
+        'copyrights': [],
+        'direction': [],
+        'unit': {'id': unit and unit[:3], 'shortName': unit and unit[:3], 'longName': unit},
+        'layerSpatialRes': 'grid_fine',
+        'layerTemporalExt': 'static',
+    }
+
+
+def make_axes(indicators: int = 300, seed: int = 1) -> dict:
+    '''getAxes response, every indicator is combined with every denominator'''
+    rnd = random.Random(seed)
+    axes = []
+    denominators = [make_indicator(name, label, unit) for name, label, unit in DENOMINATORS]
+    for i in range(indicators):
+        numerator = make_indicator(f'indicator_{i}', f'Indicator {i}', rnd.choice(UNITS), '🚗' if i % 7 == 0 else None)
+        for denominator in denominators:
+            axes.append({
+                'label': '' if i % 3 else f'Indicator {i} to {denominator["label"]}',
+                'datasetStats': {'minValue': 0, 'maxValue': 100, 'mean': 50, 'stddev': 10},
+                'quality': rnd.random(),
+                'quotients': [numerator, denominator],
+                'transformation': None,
+            })
+    for denominator in denominators:
+        axes.append({
+            'label': denominator['label'],
+            'datasetStats': {'minValue': 0, 'maxValue': 100, 'mean': 50, 'stddev': 10},
+            'quality': 0.9,
+            'quotients': [denominator, make_indicator('one', '1', None)],
+            'transformation': None,
+        })
+    return {'data': {'getAxes': {'axis': axes}}}
+
+
+def make_analytics(axes: dict, seed: int = 2) -> dict:
+    '''polygonStatistic response with every calculation of every axis'''
+    rnd = random.Random(seed)
+    items = []
+    for axis in axes['data']['getAxes']['axis']:
+        numerator, denominator = axis['quotients']
+        is_date = numerator['unit']['longName'] == 'date'
+        items.append({
+            'numerator': numerator['name'],
+            'denominator': denominator['name'],
+            'numeratorLabel': numerator['label'],
+            'denominatorLabel': denominator['label'],
+            'resolution': 8,
+            'analytics': [
+                {
+                    'calculation': calculation,
+                    'value': 1.6e9 + rnd.random() * 1e8 if is_date else rnd.random() * 10 ** rnd.randint(-4, 6),
+                    'quality': rnd.random() * 4 - 2,
+                }
+                for calculation in CALCULATIONS
+            ],
+        })
+    return {'data': {'polygonStatistic': {'analytics': {'advancedAnalytics': items}}}}
+
+
+def make_boundary(vertices: int, seed: int = 3, center=(27.5, 53.9), radius=1.0) -> dict:
+    '''
+    Feature with a jagged polygon, similar to an admin boundary:
+    coastline-like noise at several scales on top of a circle
+    '''
+    rnd = random.Random(seed)
+    phases = [rnd.random() * math.tau for _ in range(4)]
+    ring = []
+    for i in range(vertices - 1):
+        angle = math.tau * i / (vertices - 1)
+        r = radius * (1
+                      + 0.2 * math.sin(3 * angle + phases[0])
+                      + 0.05 * math.sin(40 * angle + phases[1])
+                      + 0.01 * math.sin(400 * angle + phases[2])
+                      + 0.002 * rnd.random())
+        ring.append([round(center[0] + r * math.cos(angle), 7), round(center[1] + r * math.sin(angle), 7)])
+    ring.append(ring[0])
+    return {
+        'type': 'Feature',
+        'properties': {'name': f'Boundary of {vertices} vertices'},
+        'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+    }
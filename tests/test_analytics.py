@@ -1,6 +1,17 @@
+import tracemalloc
 import unittest
+from unittest import mock
 
-from app.clients.insights_api_client import to_readable_sentence, unit_to_str
+from app.area import Area
+
+from app.clients.axes_catalog import AxesCatalog
+from app.clients.calculations import Interned
+from app.clients.insights_api_client import (
+    AnalyticsTable, flatten_analytics, get_sentence_formatters, rank_area_stats, to_readable_sentence, unit_to_str,
+)
+from app.clients import openai_client
+from app.clients.openai_client import ANALYTICS_PROMPT_PREFIX, get_analytics_prompt
+from tests.fixtures import make_axes, make_analytics
 
 
 class TestAnalytics(unittest.TestCase):
@@ -189,6 +200,31 @@ class TestAnalytics(unittest.TestCase):
         actual = to_readable_sentence(selected_area_data, world_data, reference_area_data)[0]
         self.assertEqual(expected, actual)
 
+    def test_catalog_formatters(self):
+        axes = make_axes(indicators=100)
+        catalog = AxesCatalog(axes)
+        world, selected, reference = (make_analytics(axes, seed) for seed in (1, 2, 3))
+        calculations_world = flatten_analytics(world, catalog.metadata)
+        rows = rank_area_stats(
+            calculations_world,
+            AnalyticsTable(selected, catalog.metadata),
+            AnalyticsTable(reference, catalog.metadata),
+            400,
+        )
+        rows = [x.as_dict() for x in rows]
+        world_rows = {key: x.as_dict() for key, x in calculations_world.items()}
+        formatters = get_sentence_formatters(catalog)
+        self.assertEqual(len(formatters), len(catalog.axes))
+        self.assertEqual(
+            to_readable_sentence(rows, world_rows, formatters=formatters),
+            to_readable_sentence(rows, world_rows),
+        )
+        # shared by requests, built once and never filled by them
+        self.assertIs(get_sentence_formatters(catalog), formatters)
+        self.assertEqual(len(formatters), len(catalog.axes))
+        with self.assertRaises(TypeError):
+            formatters['a', 'b'] = None
+
     def test_unit_to_str(self):
         # Population without a car over Population
         entry = {
@@ -244,5 +280,110 @@ class TestAnalytics(unittest.TestCase):
         self.assertEqual(s, ' kilometers')
 
 
+def sorted_area_stats(calculations_world: dict, calculations_selected_area: dict,
+                      calculations_reference_area: dict, limit: int) -> list[dict]:
+    '''
+    reference for rank_area_stats: sigma of every mean row against the world and the reference area
+    (in units of world stddev), and a full sort by quality bucket, sigma, numerator & value
+    '''
+    rows = []
+    for key, calculation in calculations_selected_area.items():
+        row = calculation.as_dict()
+        stddev = calculations_world.get(('stddev', *key[1:]))
+        if key[0] == 'mean' and stddev is not None:
+            for field, ref in (('world_sigma', calculations_world), ('reference_area_sigma', calculations_reference_area)):
+                if key in ref:
+                    row[field] = abs((row['value'] - ref[key].value) / stddev.value)
+        rows.append(row)
+    return sorted(rows, key=lambda x: (
+        int(abs(x['quality']) / 2) * 2,
+        -x['reference_area_sigma'],
+        -x['world_sigma'],
+        x['numerator'],
+        x['value'],
+    ))[:limit]
+
+
+class TestRankAreaStats(unittest.TestCase):
+
+    def test_same_as_sorted_dicts(self):
+        axes = make_axes(indicators=100)
+        metadata = AxesCatalog(axes).metadata
+        world, selected, reference = (make_analytics(axes, seed) for seed in (1, 2, 3))
+        calculations_world = flatten_analytics(world, metadata)
+        for limit in (1, 50, 400):
+            for reference_area in (reference, None):
+                expected = sorted_area_stats(
+                    calculations_world,
+                    flatten_analytics(selected, metadata),
+                    flatten_analytics(reference_area, metadata) if reference_area else {},
+                    limit,
+                )
+                actual = rank_area_stats(
+                    calculations_world,
+                    AnalyticsTable(selected, metadata),
+                    AnalyticsTable(reference_area, metadata) if reference_area else None,
+                    limit,
+                )
+                self.assertEqual(expected, [x.as_dict() for x in actual])
+
+
+def traced(fn):
+    '''result of fn and bytes it allocated that are still alive'''
+    tracemalloc.start()
+    try:
+        result = fn()
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, allocated
+
+
+class TestAnalyticsMemory(unittest.TestCase):
+
+    def setUp(self):
+        axes = make_axes(indicators=100)
+        self.metadata = AxesCatalog(axes).metadata
+        self.world, self.selected = make_analytics(axes, 1), make_analytics(axes, 2)
+        self.interned = Interned()
+
+    def test_records_smaller_than_dicts(self):
+        calculations, records_size = traced(lambda: flatten_analytics(self.world, self.metadata, self.interned))
+        _, dicts_size = traced(lambda: {key: x.as_dict() for key, x in calculations.items()})
+        # records include interned keys and labels
+        self.assertLess(records_size, dicts_size * 0.7)
+
+    def test_table_smaller_than_dicts(self):
+        flatten_analytics(self.world, self.metadata, self.interned)
+        table, table_size = traced(lambda: AnalyticsTable(self.selected, self.metadata, self.interned))
+        calculations = flatten_analytics(self.selected, self.metadata, self.interned)
+        _, dicts_size = traced(lambda: {key: x.as_dict() for key, x in calculations.items()})
+        # keys and labels of the area are interned already, a row is a few list slots
+        self.assertEqual(len(table), len(calculations))
+        self.assertLess(table_size, dicts_size * 0.25)
+
+
+class TestAnalyticsPrompt(unittest.TestCase):
+
+    def test_token_budget(self):
+        area = Area(geojson={}, hash='a', bbox=None, vertices=0, properties='')
+        sentences = [f'mean of indicator {i} is {"1" * 40}' for i in range(100)]
+        descriptions = [(f'indicator {i}', f'about {i}' if i % 2 else '') for i in range(100)]
+        with mock.patch.object(openai_client.settings, 'ANALYTICS_PROMPT_MAX_TOKENS', 500):
+            prompt = get_analytics_prompt(sentences, descriptions, 'bio', None, area, None)
+        self.assertLessEqual(len(prompt) // 4, 500)
+        included = [x for x in sentences if x in prompt]
+        # the most significant sentences are kept
+        self.assertEqual(included, sentences[:len(included)])
+        self.assertLess(len(included), len(sentences))
+        # indicators of dropped sentences are not described
+        self.assertNotIn(f'indicator {len(included) + 1}: about', prompt)
+        self.assertTrue(prompt.startswith(ANALYTICS_PROMPT_PREFIX[False]))
+        self.assertTrue(prompt.endswith('User wrote in their bio: "bio" '))
+
+        prompt = get_analytics_prompt(sentences[:4], descriptions[:4] * 2, 'bio', None, area, None)
+        # empty descriptions are skipped, every indicator is described once
+        self.assertIn('indicators: indicator 1: about 1; indicator 3: about 3 Selected area properties:', prompt)
+
 if __name__ == '__main__':
     unittest.main()
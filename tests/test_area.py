@@ -0,0 +1,55 @@
+import unittest
+
+from starlette.exceptions import HTTPException
+
+from app.area import MAX_PROPERTIES_LENGTH, ingest_area
+from app.geometry import geometry_hash
+
+
+def feature(ring, **properties):
+    return {
+        'type': 'Feature',
+        'properties': properties,
+        'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+    }
+
+
+square = [[0, 0], [2, 0], [2, 1], [0, 1], [0, 0]]
+triangle = [[5, 5], [6, 5], [6, -1], [5, 5]]
+
+
+class TestIngestArea(unittest.TestCase):
+
+    def test_summary(self):
+        geojson = {'type': 'FeatureCollection', 'features': [feature(square, name='a'), feature(triangle)]}
+        area = ingest_area(geojson)
+        self.assertEqual(area.hash, geometry_hash(geojson))
+        self.assertEqual(area.bbox, (0, -1, 6, 5))
+        self.assertEqual(area.vertices, 9)
+        self.assertIs(area.geojson, geojson)
+
+    def test_properties(self):
+        features = [feature(square, name='b'), feature(square), feature(square, name='a'), feature(square, name='b')]
+        area = ingest_area({'type': 'FeatureCollection', 'features': features})
+        # distinct properties in document order
+        self.assertEqual(area.properties, "(input GeoJSON properties: {'name': 'b'}, {'name': 'a'})")
+        self.assertEqual(ingest_area(feature(square)).properties, '(input GeoJSON properties: not available)')
+
+    def test_properties_truncated(self):
+        features = [feature(square, name=str(i) * 100) for i in range(1000)]
+        area = ingest_area({'type': 'FeatureCollection', 'features': features})
+        self.assertTrue(area.properties.endswith('...)'))
+        self.assertEqual(len(area.properties), len('(input GeoJSON properties: ...)') + MAX_PROPERTIES_LENGTH)
+
+    def test_limits(self):
+        with self.assertRaises(HTTPException) as e:
+            ingest_area(feature(square), max_vertices=4)
+        self.assertEqual(e.exception.status_code, 413)
+        self.assertEqual(ingest_area(feature(square), max_vertices=5).vertices, 5)
+        with self.assertRaises(HTTPException) as e:
+            ingest_area(['not', 'an', 'object'])
+        self.assertEqual(e.exception.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from app.cache import LRUCache, RefreshingValue
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache('test', max_bytes=30, ttl=60, sizeof=len)
+        cache.set('a', 'x' * 10)
+        cache.set('b', 'x' * 10)
+        cache.set('c', 'x' * 10)
+        # touch 'a', so 'b' becomes the oldest one
+        self.assertEqual(cache.get('a'), 'x' * 10)
+        cache.set('d', 'x' * 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'x' * 10)
+        self.assertEqual(cache.size, 30)
+
+    def test_oversized_value_is_not_admitted(self):
+        cache = LRUCache('test', max_bytes=10, ttl=60, sizeof=len)
+        cache.set('a', 'x' * 5)
+        cache.set('b', 'x' * 11)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'x' * 5)
+
+    def test_replace_value(self):
+        cache = LRUCache('test', max_bytes=10, ttl=60, sizeof=len)
+        cache.set('a', 'x' * 5)
+        cache.set('a', 'y' * 3)
+        self.assertEqual(cache.get('a'), 'yyy')
+        self.assertEqual(cache.size, 3)
+
+    @patch('app.cache.time.monotonic')
+    def test_ttl(self, monotonic):
+        monotonic.return_value = 100
+        cache = LRUCache('test', max_bytes=10, ttl=60, sizeof=len)
+        cache.set('a', 'x')
+        cache.set('b', 'y', ttl=10)
+        monotonic.return_value = 120
+        self.assertEqual(cache.get('a'), 'x')
+        self.assertIsNone(cache.get('b'))
+        monotonic.return_value = 160
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)
+
+
+class TestRefreshingValue(unittest.IsolatedAsyncioTestCase):
+
+    async def test_stale_while_revalidate(self):
+        loads = []
+        release = asyncio.Event()
+
+        async def loader():
+            loads.append(1)
+            if len(loads) > 1:
+                await release.wait()
+            return len(loads)
+
+        value = RefreshingValue('test', loader, ttl=0)
+        self.assertEqual(await value.get(), 1)
+        # ttl passed: stale value is returned while refresh is running
+        self.assertEqual(await value.get(), 1)
+        await asyncio.sleep(0)
+        self.assertEqual(await value.get(), 1)
+        # only one refresh at a time
+        self.assertEqual(len(loads), 2)
+        value.ttl = 60
+        release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(await value.get(), 2)
+
+    async def test_failed_refresh_keeps_value(self):
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            if len(loads) > 1:
+                raise ValueError('upstream is down')
+            return 'value'
+
+        value = RefreshingValue('test', loader, ttl=0, retry_interval=60)
+        self.assertEqual(await value.get(), 'value')
+        self.assertEqual(await value.get(), 'value')
+        await asyncio.sleep(0)
+        # failed refresh is not retried before retry_interval
+        self.assertEqual(await value.get(), 'value')
+        self.assertEqual(len(loads), 2)
+
+    async def test_invalidate(self):
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            return len(loads)
+
+        value = RefreshingValue('test', loader, ttl=60)
+        self.assertEqual(await value.get(), 1)
+        value.invalidate()
+        self.assertEqual(await value.get(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
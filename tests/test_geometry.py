@@ -0,0 +1,131 @@
+import unittest
+
+import ujson as json
+
+from app.geometry import (
+    DUMP_CHUNK, canonical_geometry, canonical_ring, count_vertices, dump_geometry, extract_geometries, geometry_hash,
+    rings_intersect, signed_area, simplify_area, simplify_geometry, simplify_line,
+)
+from tests.fixtures import make_boundary
+
+
+square = [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+
+
+def polygon(*rings, **properties):
+    return {
+        'type': 'Feature',
+        'properties': properties,
+        'geometry': {'type': 'Polygon', 'coordinates': list(rings)},
+    }
+
+
+class TestGeometryHash(unittest.TestCase):
+
+    def test_canonical_ring(self):
+        # clockwise ring starting from other vertex
+        ring = [[1, 1], [1, 0], [0, 0], [0, 1], [1, 1]]
+        self.assertEqual(canonical_ring(ring, exterior=True), square)
+        self.assertEqual(canonical_ring(square, exterior=False), [[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]])
+
+    def test_properties_and_key_order(self):
+        a = polygon(square, name='a')
+        b = {'geometry': {'coordinates': [square], 'type': 'Polygon'}, 'type': 'Feature', 'properties': {}}
+        self.assertEqual(geometry_hash(a), geometry_hash(b))
+
+    def test_orientation_start_vertex_and_precision(self):
+        ring = [[1.0000000001, 1], [1, 0], [0, 0], [0, 1], [1, 1]]
+        self.assertEqual(geometry_hash(polygon(square)), geometry_hash(polygon(ring)))
+
+    def test_feature_collection(self):
+        other = [[2, 2], [3, 2], [3, 3], [2, 2]]
+        a = {'type': 'FeatureCollection', 'features': [polygon(square), polygon(other)]}
+        b = {'type': 'FeatureCollection', 'features': [polygon(other), polygon(square)]}
+        self.assertEqual(geometry_hash(a), geometry_hash(b))
+        self.assertEqual(geometry_hash(polygon(square)), geometry_hash({'type': 'FeatureCollection', 'features': [polygon(square)]}))
+
+    def test_different_areas(self):
+        shifted = [[0, 0], [1, 0], [1, 1.001], [0, 1], [0, 0]]
+        self.assertNotEqual(geometry_hash(polygon(square)), geometry_hash(polygon(shifted)))
+        hole = [[0.2, 0.2], [0.4, 0.2], [0.4, 0.4], [0.2, 0.2]]
+        self.assertNotEqual(geometry_hash(polygon(square)), geometry_hash(polygon(square, hole)))
+
+    def test_dump_in_chunks(self):
+        ring = make_boundary(vertices=DUMP_CHUNK * 2 + 1)['geometry']['coordinates'][0]
+        other = make_boundary(vertices=DUMP_CHUNK + 1, seed=4, center=(10, 10))['geometry']['coordinates'][0]
+        for geometry in (
+            {'type': 'LineString', 'coordinates': ring},
+            {'type': 'MultiPolygon', 'coordinates': [[other], [ring, other]]},
+            {'type': 'Point', 'coordinates': [1, -0.0]},
+            {'type': 'Polygon', 'coordinates': []},
+        ):
+            canonical = canonical_geometry(geometry)
+            self.assertEqual(dump_geometry(canonical), json.dumps(canonical, sort_keys=True))
+
+    def test_invalid_geometry(self):
+        self.assertIsInstance(geometry_hash(polygon('not a ring')), str)
+
+
+class TestSimplifyArea(unittest.TestCase):
+
+    def test_noise_is_removed(self):
+        area = make_boundary(vertices=20000, seed=1)
+        simplified, vertices, simplified_vertices = simplify_area(area, 8, 100000, 20000)
+        self.assertEqual(vertices, 20000)
+        self.assertLess(simplified_vertices, vertices / 2)
+        ring = extract_geometries(simplified)[0]['coordinates'][0]
+        original = extract_geometries(area)[0]['coordinates'][0]
+        self.assertEqual(ring[0], ring[-1])
+        self.assertAlmostEqual(signed_area(ring[:-1]) / signed_area(original[:-1]), 1, places=2)
+
+    def test_vertex_budget(self):
+        area = make_boundary(vertices=20000, seed=2)
+        simplified, _, simplified_vertices = simplify_area(area, 8, 100000, 500)
+        self.assertLessEqual(simplified_vertices, 500)
+        self.assertEqual(count_vertices(extract_geometries(simplified)), simplified_vertices)
+
+    def test_small_areas(self):
+        # neighbourhoods are far smaller than an edge of H3 cell at analytics resolution
+        for radius in (0.003, 0.005, 0.01, 0.05):
+            area = make_boundary(vertices=500, radius=radius)
+            simplified, _, simplified_vertices = simplify_area(area, 8, 100000, 20000)
+            ring = extract_geometries(simplified)[0]['coordinates'][0]
+            original = extract_geometries(area)[0]['coordinates'][0]
+            self.assertGreater(simplified_vertices, 50)
+            self.assertAlmostEqual(signed_area(ring[:-1]) / signed_area(original[:-1]), 1, places=3)
+
+    def test_longitude_scale(self):
+        # at 60 degrees of latitude a degree of longitude is half as long as a degree of latitude
+        line = [[0, 0], [0.002, 0.5], [0, 1]]
+        self.assertEqual(simplify_line(line, 0.0015), line)
+        self.assertEqual(simplify_line(line, 0.0015, x_scale=0.5), [[0, 0], [0, 1]])
+
+    def test_small_ring_is_kept(self):
+        hole = [[0.5, 0.5], [0.5000001, 0.5], [0.5000001, 0.5000001], [0.5, 0.5000001], [0.5, 0.5]]
+        simplified, vertices, simplified_vertices = simplify_area(polygon(square, hole), 8, 100000, 20000)
+        self.assertEqual(vertices, simplified_vertices)
+        self.assertEqual(extract_geometries(simplified)[0]['coordinates'], [square, hole])
+
+
+    def test_thin_hole_near_shell(self):
+        # dropping the bump of the shell would cut through the hole
+        shell = [[0, 0], [10, 0], [10, 4], [10.5, 5], [10, 6], [10, 10], [0, 10], [0, 0]]
+        hole = [[9.8, 4.8], [9.8, 5.2], [10.3, 5.2], [10.3, 4.8], [9.8, 4.8]]
+        self.assertNotIn([10.5, 5], simplify_geometry(polygon(shell)['geometry'], 0.6)['coordinates'][0])
+        self.assertEqual(simplify_geometry(polygon(shell, hole)['geometry'], 0.6)['coordinates'], [shell, hole])
+
+    def test_self_touching_ring(self):
+        # the notch reaches the bottom edge once its vertex is dropped
+        ring = [[0, 0], [5, -0.4], [10, 0], [10, 5], [5, 0], [0, 5], [0, 0]]
+        self.assertFalse(rings_intersect([ring]))
+        self.assertTrue(rings_intersect([[[0, 0], [10, 0], [10, 5], [5, 0], [0, 5], [0, 0]]]))
+        self.assertEqual(simplify_geometry(polygon(ring)['geometry'], 0.5)['coordinates'], [ring])
+
+    def test_simplified_rings_are_valid(self):
+        area = make_boundary(vertices=20000, seed=3)
+        simplified, _, _ = simplify_area(area, 8, 100000, 500)
+        self.assertFalse(rings_intersect(extract_geometries(simplified)[0]['coordinates']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp import ClientTimeout, web
+
+from app.clients import http
+
+
+class TestHttpSession(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        async def slow(request):
+            await asyncio.sleep(0.3)
+            return web.Response(text='ok')
+
+        async def redirect(request):
+            raise web.HTTPFound('/')
+
+        app = web.Application()
+        app.router.add_get('/', slow)
+        app.router.add_get('/redirect', redirect)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/'
+        with mock.patch.object(http.settings, 'HTTP_POOL_LIMIT', 1):
+            self.session = http.create_http_session()
+
+    async def asyncTearDown(self):
+        await http.close_http_session()
+        await self.runner.cleanup()
+
+    async def get(self, timeout: float = None):
+        async with self.session.get(self.url, timeout=ClientTimeout(total=timeout)) as response:
+            return await response.text()
+
+    async def test_queue_timeout(self):
+        first = asyncio.create_task(self.get())
+        await asyncio.sleep(0.05)
+        self.assertEqual(http._stats['queued'], 0)
+        self.assertEqual(http._stats['active'], 1)
+        # the only connection is busy, the second request times out waiting for it
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.get(timeout=0.05)
+        self.assertEqual(http._stats['queued'], 0)
+        self.assertEqual(await first, 'ok')
+        self.assertEqual(http._stats['in_flight'], 0)
+        self.assertEqual(http._stats['active'], 0)
+
+    async def test_redirect(self):
+        request = asyncio.create_task(self.session.get(self.url + 'redirect'))
+        await asyncio.sleep(0.1)
+        # the connection of the redirect is released before the next one is taken
+        self.assertEqual(http._stats['active'], 1)
+        async with await request as response:
+            self.assertEqual(await response.text(), 'ok')
+        self.assertEqual(http._stats['active'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
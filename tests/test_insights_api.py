@@ -0,0 +1,72 @@
+import re
+import unittest
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from unittest import mock
+
+import ujson as json
+
+from app.clients import insights_api_client
+from app.clients.insights_api_client import EMPTY_POLYGON, polygon_statistic_graphql, query_polygon_statistic
+
+
+class FakeSession:
+    '''insights-api answers every alias with the polygon of its variable'''
+
+    def __init__(self):
+        self.payloads = []
+
+    @asynccontextmanager
+    async def post(self, url, json, timeout):
+        self.payloads.append(json)
+        aliases = re.findall(r'(\w+): polygonStatistic\(', json['query'])
+        data = {alias: {'polygon': json['variables'][alias]} for alias in reversed(aliases)}
+
+        async def read_json():
+            return {'data': data}
+
+        yield SimpleNamespace(status=200, json=read_json)
+
+
+def square(x: float) -> dict:
+    return {'type': 'Polygon', 'coordinates': [[[x, 0], [x + 1, 0], [x + 1, 1], [x, 1], [x, 0]]]}
+
+
+class TestPolygonStatistic(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.areas = [square(0), None, square(2)]
+
+    def test_graphql(self):
+        query = polygon_statistic_graphql(['area0', 'area1'])
+        self.assertTrue(query.startswith('query PolygonStatistic($area0: String, $area1: String) {'))
+        for alias in ('area0', 'area1'):
+            self.assertEqual(query.count(f'{alias}: polygonStatistic(polygonStatisticRequest: {{polygon: ${alias}}})'), 1)
+        self.assertEqual(query.count('{'), query.count('}'))
+
+    async def test_batched(self):
+        with mock.patch.object(insights_api_client.settings, 'INSIGHTS_API_BATCH_QUERIES', True):
+            results = await query_polygon_statistic(self.session, self.areas)
+        payload, = self.session.payloads
+        self.assertEqual(list(payload['variables']), ['area0', 'area1', 'area2'])
+        # polygons are passed as variables, not escaped into the document
+        self.assertNotIn('coordinates', payload['query'])
+        self.assertEqual(
+            [json.loads(x['data']['polygonStatistic']['polygon']) for x in results],
+            [square(0), json.loads(EMPTY_POLYGON), square(2)],
+        )
+
+    async def test_not_batched(self):
+        with mock.patch.object(insights_api_client.settings, 'INSIGHTS_API_BATCH_QUERIES', False):
+            results = await query_polygon_statistic(self.session, self.areas)
+        self.assertEqual([list(x['variables']) for x in self.session.payloads], [['area0'], ['area1'], ['area2']])
+        self.assertEqual(self.session.payloads[0]['query'], polygon_statistic_graphql(['area0']))
+        self.assertEqual(
+            [json.loads(x['data']['polygonStatistic']['polygon']) for x in results],
+            [square(0), json.loads(EMPTY_POLYGON), square(2)],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+from contextlib import asynccontextmanager
+from unittest import mock
+
+from app.area import Area
+from app.clients import insights_api_client
+from app.clients.insights_api_client import _get_areas_analytics, prefetch_analytics
+
+
+class FakeInsightsCache:
+    '''insights_cache table: (geometry_hash, axes_version) -> (response, created_at)'''
+
+    def __init__(self):
+        self.rows = {}
+        self.upserts = []
+
+    async def fetch(self, query, hashes, axes_version, ttl):
+        return [
+            {'geometry_hash': area_hash, 'response': response}
+            for (area_hash, version), (response, created_at) in self.rows.items()
+            if area_hash in hashes and version == axes_version and created_at > time.time() - ttl
+        ]
+
+    async def executemany(self, query, args):
+        self.upserts.append(args)
+        for area_hash, axes_version, response in args:
+            self.rows[(area_hash, axes_version)] = (response, time.time())
+
+    @asynccontextmanager
+    async def connection(self):
+        yield self
+
+
+def area(area_hash: str) -> Area:
+    return Area(geojson={'type': 'Polygon', 'coordinates': []}, hash=area_hash, bbox=None, vertices=0, properties='')
+
+
+class InsightsCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    '''insights_cache table and insights-api are faked'''
+
+    async def asyncSetUp(self):
+        self.db = FakeInsightsCache()
+        insights_api_client._area_analytics.clear()
+        self.addCleanup(insights_api_client._area_analytics.clear)
+        self.queried = []
+
+        async def query_polygon_statistic(session, areas):
+            self.queried.append(len(areas))
+            return [{'fetched': i} for i in range(len(areas))]
+
+        for patcher in (
+            mock.patch.object(insights_api_client, 'get_db_conn', self.db.connection),
+            mock.patch.object(insights_api_client, 'query_polygon_statistic', query_polygon_statistic),
+            mock.patch.object(insights_api_client, 'get_http_session', lambda: None),
+            mock.patch.object(insights_api_client.settings, 'GEOMETRY_SIMPLIFY', False),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestInsightsCache(InsightsCacheTestCase):
+
+    async def test_stored_hit(self):
+        self.db.rows[('a', 'v1')] = ({'cached': 'a'}, time.time())
+        results = await _get_areas_analytics({'a': area('a'), 'b': area('b')}, 'v1')
+        self.assertEqual(results, {'a': {'cached': 'a'}, 'b': {'fetched': 0}})
+        # only the missing area is requested and saved
+        self.assertEqual(self.queried, [1])
+        self.assertEqual(self.db.upserts, [[('b', 'v1', {'fetched': 0})]])
+
+    async def test_expired(self):
+        self.db.rows[('a', 'v1')] = ({'cached': 'a'}, time.time() - insights_api_client.settings.INSIGHTS_CACHE_TTL - 1)
+        results = await _get_areas_analytics({'a': area('a')}, 'v1')
+        self.assertEqual(results, {'a': {'fetched': 0}})
+        # the row is refreshed in place
+        self.assertEqual(self.db.rows[('a', 'v1')][0], {'fetched': 0})
+        self.assertEqual(len(self.db.rows), 1)
+
+    async def test_other_axes_version(self):
+        self.db.rows[('a', 'v1')] = ({'cached': 'a'}, time.time())
+        results = await _get_areas_analytics({'a': area('a')}, 'v2')
+        self.assertEqual(results, {'a': {'fetched': 0}})
+        self.assertEqual(self.db.rows[('a', 'v1')][0], {'cached': 'a'})
+        self.assertEqual(self.db.rows[('a', 'v2')][0], {'fetched': 0})
+
+        # the next call is served by the table
+        await _get_areas_analytics({'a': area('a')}, 'v2')
+        self.assertEqual(self.queried, [1])
+
+    async def test_axes_changed(self):
+        # insights-api could use any of axes versions, analytics are not saved under the old one
+        with mock.patch.object(insights_api_client, 'axes_catalog', SimpleNamespace(value=SimpleNamespace(version='v2'))):
+            results = await _get_areas_analytics({'a': area('a')}, 'v1')
+        self.assertEqual(results, {'a': {'fetched': 0}})
+        self.assertEqual(self.db.rows, {})
+        self.assertIsNone(insights_api_client._area_analytics.get(('a', 'v1')))
+
+
+
+class TestPrefetch(InsightsCacheTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.simplified = []
+
+        def simplify_for_analytics(area):
+            self.simplified.append(area.hash)
+            return area.geojson
+
+        for patcher in (
+            mock.patch.object(insights_api_client, 'simplify_for_analytics', simplify_for_analytics),
+            mock.patch.object(insights_api_client, 'get_axes', mock.AsyncMock(return_value=SimpleNamespace(version='v1'))),
+            mock.patch.object(insights_api_client.world_analytics, 'get', mock.AsyncMock(return_value={})),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_waits_for_authorization(self):
+        authorized = asyncio.Event()
+        task = prefetch_analytics(area('a'), authorized)
+        await asyncio.sleep(0.01)
+        # the area is neither simplified nor requested for a request that may be rejected
+        self.assertFalse(task.done())
+        self.assertEqual((self.simplified, self.queried), ([], []))
+        authorized.set()
+        self.assertEqual(await task, {'fetched': 0})
+        self.assertEqual((self.simplified, self.queried), (['a'], [1]))
+
+    async def test_stored_before_authorization(self):
+        self.db.rows[('a', 'v1')] = ({'cached': 'a'}, time.time())
+        self.assertEqual(await prefetch_analytics(area('a'), asyncio.Event()), {'cached': 'a'})
+        self.assertEqual(self.queried, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import asyncio
+import importlib
+import unittest
+from unittest import mock
+
+import ujson as json
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+
+from tests.fixtures import make_boundary
+
+view = importlib.import_module('app.views.llm_analytics')
+
+
+def make_request(data: dict, headers=((b'authorization', b'Bearer t'),)) -> Request:
+    body = json.dumps(data).encode()
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    scope = {'type': 'http', 'method': 'POST', 'path': '/llm-analytics', 'headers': list(headers)}
+    return Request(scope, receive)
+
+
+async def get_app_data(app_id, auth_token, features_config):
+    await asyncio.sleep(0.01)
+    return {'current_user': {}, 'features_config': {}, 'features_enabled': frozenset()}
+
+
+REQUEST = {
+    'appId': 'app',
+    'features': {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [0, 0]}},
+}
+
+
+class TestPrefetch(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_when_rejected(self):
+        tasks, events = [], []
+
+        def prefetch_analytics(selected_area, authorized):
+            tasks.append(asyncio.create_task(asyncio.sleep(10)))
+            events.append(authorized)
+            return tasks[0]
+
+        with mock.patch.object(view, 'prefetch_analytics', prefetch_analytics), \
+                mock.patch.object(view, 'get_app_data', get_app_data):
+            with self.assertRaises(HTTPException) as e:
+                await view.llm_analytics(make_request(REQUEST))
+        self.assertEqual(e.exception.status_code, 403)
+        await asyncio.sleep(0)
+        self.assertTrue(tasks[0].cancelled())
+        self.assertFalse(events[0].is_set())
+
+    async def test_not_started_without_token(self):
+        prefetch_analytics = mock.Mock()
+        with mock.patch.object(view, 'prefetch_analytics', prefetch_analytics), \
+                mock.patch.object(view, 'get_app_data', get_app_data):
+            with self.assertRaises(HTTPException):
+                await view.llm_analytics(make_request(REQUEST, headers=()))
+        prefetch_analytics.assert_not_called()
+
+
+class TestIngestion(unittest.IsolatedAsyncioTestCase):
+
+    async def test_large_area(self):
+        areas = []
+
+        def prefetch_analytics(selected_area, authorized):
+            areas.append(selected_area)
+            return asyncio.create_task(asyncio.sleep(0))
+
+        data = {'appId': 'app', 'features': make_boundary(view.settings.AREA_MAX_VERTICES)}
+        lags = []
+
+        async def tick():
+            loop = asyncio.get_running_loop()
+            while True:
+                started = loop.time()
+                await asyncio.sleep(0.005)
+                lags.append(loop.time() - started - 0.005)
+
+        ticker = asyncio.create_task(tick())
+        # the body is parsed before, only the area is walked during the request
+        with mock.patch.object(view, 'read_json', mock.AsyncMock(return_value=data)), \
+                mock.patch.object(view, 'prefetch_analytics', prefetch_analytics), \
+                mock.patch.object(view, 'get_app_data', get_app_data):
+            with self.assertRaises(HTTPException):
+                await view.llm_analytics(make_request(REQUEST))
+        ticker.cancel()
+        self.assertEqual(areas[0].vertices, view.settings.AREA_MAX_VERTICES)
+        # the event loop isn't held for the ~1 s the area is walked, only for garbage collection and short C calls
+        self.assertGreater(len(lags), 10)
+        self.assertLess(max(lags), 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
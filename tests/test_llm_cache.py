@@ -0,0 +1,154 @@
+import asyncio
+import time
+import unittest
+from contextlib import asynccontextmanager
+from unittest import mock
+
+from starlette.exceptions import HTTPException
+
+from app import llm_cache
+from app.clients import openai_client
+from app.clients.openai_client import OpenAIClient
+
+
+class FakeLLMCache:
+    '''llm_cache table: (hash, model_name) -> row, NOTIFY is delivered to the listener of the worker'''
+
+    def __init__(self):
+        self.rows = {}
+        self.queries = 0
+
+    def notify(self, cache_key: str):
+        asyncio.get_running_loop().call_soon(llm_cache._on_notify, self, 0, llm_cache.LEASE_CHANNEL, cache_key)
+
+    def expired(self, row) -> bool:
+        return row['lease_expires_at'] is None or row['lease_expires_at'] < time.time()
+
+    async def fetchval(self, query, cache_key, *args):
+        self.queries += 1
+        if query.startswith('select response'):
+            llm_model, = args
+            row = self.rows.get((cache_key, llm_model))
+            return row and row['response']
+        if 'insert into llm_cache' in query:
+            request, llm_model, owner, lease_seconds = args
+            row = self.rows.get((cache_key, llm_model))
+            if row is not None and (row['response'] is not None or not self.expired(row)):
+                return None
+            self.rows[(cache_key, llm_model)] = {
+                'request': request, 'response': None,
+                'lease_owner': owner, 'lease_expires_at': time.time() + lease_seconds,
+            }
+            return owner
+        if 'with updated' in query:
+            llm_model, owner, response, channel = args
+            row = self.rows.get((cache_key, llm_model))
+            if row is None or row['lease_owner'] != owner:
+                return None
+            row.update(response=response, lease_owner=None, lease_expires_at=None)
+            self.notify(cache_key)
+            # pg_notify returns void, asyncpg decodes it as None
+            return None if 'select pg_notify' in query else cache_key
+        raise AssertionError(query)
+
+    async def execute(self, query, cache_key, llm_model, owner, *args):
+        self.queries += 1
+        row = self.rows.get((cache_key, llm_model))
+        owned = row is not None and row['lease_owner'] == owner and row['response'] is None
+        if 'with deleted' in query:
+            if owned:
+                del self.rows[(cache_key, llm_model)]
+                self.notify(cache_key)
+            return 'SELECT 1' if owned else 'SELECT 0'
+        if query.lstrip().startswith('update'):
+            lease_seconds, = args
+            if owned:
+                row['lease_expires_at'] = time.time() + lease_seconds
+            return 'UPDATE 1' if owned else 'UPDATE 0'
+        raise AssertionError(query)
+
+    async def fetchrow(self, query, cache_key, llm_model):
+        self.queries += 1
+        row = self.rows.get((cache_key, llm_model))
+        return row and {'response': row['response'], 'expired': self.expired(row)}
+
+    @asynccontextmanager
+    async def connection(self):
+        yield self
+
+
+class TestLease(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = FakeLLMCache()
+        llm_cache._l1.clear()
+        self.addCleanup(llm_cache._l1.clear)
+        patcher = mock.patch.object(llm_cache, 'get_db_conn', self.db.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loop = asyncio.get_running_loop()
+
+    def tearDown(self):
+        self.assertEqual(llm_cache._waiters, {})
+
+    async def test_contend(self):
+        self.assertTrue(await llm_cache.acquire_lease('h', 'request', 'm', 'a'))
+        # the live lease of the other worker is kept
+        self.assertFalse(await llm_cache.acquire_lease('h', 'request', 'm', 'b'))
+        self.assertEqual(self.db.rows[('h', 'm')]['lease_owner'], 'a')
+        # pending rows aren't responses
+        self.assertIsNone(await llm_cache.get_response('h', 'm'))
+        self.assertTrue(await llm_cache.extend_lease('h', 'm', 'a'))
+        self.assertFalse(await llm_cache.extend_lease('h', 'm', 'b'))
+
+    async def test_takeover(self):
+        self.assertTrue(await llm_cache.acquire_lease('h', 'request', 'm', 'a'))
+        self.db.rows[('h', 'm')]['lease_expires_at'] = time.time() - 1
+        # the waiter finds the expired lease and takes it over
+        self.assertIsNone(await llm_cache.wait_for_response('h', 'm', self.loop.time() + 1))
+        self.assertTrue(await llm_cache.acquire_lease('h', 'request', 'm', 'b'))
+        self.assertEqual(self.db.rows[('h', 'm')]['lease_owner'], 'b')
+
+        # the response of the former owner isn't saved
+        with self.assertLogs(llm_cache.LOGGER, 'WARNING'):
+            await llm_cache.complete_lease('h', 'm', 'a', 'late')
+        self.assertIsNone(self.db.rows[('h', 'm')]['response'])
+
+    async def test_release_wakes_waiters(self):
+        await llm_cache.acquire_lease('h', 'request', 'm', 'a')
+        waiter = asyncio.create_task(llm_cache.wait_for_response('h', 'm', self.loop.time() + 10))
+        await asyncio.sleep(0.01)
+        started = self.loop.time()
+        await llm_cache.release_lease('h', 'm', 'a')
+        self.assertIsNone(await waiter)
+        # woken up by the notification before the first poll at 0.1 seconds
+        self.assertLess(self.loop.time() - started, 0.05)
+        self.assertEqual(self.db.rows, {})
+
+    async def test_complete(self):
+        await llm_cache.acquire_lease('h', 'request', 'm', 'a')
+        waiter = asyncio.create_task(llm_cache.wait_for_response('h', 'm', self.loop.time() + 10))
+        await asyncio.sleep(0.01)
+        started = self.loop.time()
+        with self.assertNoLogs(llm_cache.LOGGER, 'WARNING'):
+            await llm_cache.complete_lease('h', 'm', 'a', 'response')
+        self.assertEqual(await waiter, 'response')
+        self.assertLess(self.loop.time() - started, 0.05)
+        self.assertEqual(self.db.rows[('h', 'm')]['response'], 'response')
+
+        # the saved response is served by L1
+        queries = self.db.queries
+        self.assertEqual(await llm_cache.get_response('h', 'm'), 'response')
+        self.assertEqual(self.db.queries, queries)
+        # the lease is gone
+        self.assertFalse(await llm_cache.acquire_lease('h', 'request', 'm', 'b'))
+
+    async def test_wait_timeout(self):
+        await llm_cache.acquire_lease('h', 'request', 'm', 'a')
+        with mock.patch.object(openai_client, 'get_openai_client', lambda: None):
+            client = OpenAIClient('assistant')
+        with mock.patch.object(openai_client.settings, 'LLM_CACHE_WAIT_TIMEOUT', 0.2):
+            with self.assertRaises(HTTPException) as e:
+                await client._get_cached_or_lease('request', 'h', 'm', 'b')
+        self.assertEqual(e.exception.status_code, 504)
+        self.assertEqual(self.db.rows[('h', 'm')]['lease_owner'], 'a')
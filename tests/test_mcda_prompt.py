@@ -0,0 +1,27 @@
+import unittest
+from unittest import mock
+
+from app.clients.axes_catalog import AxesCatalog
+from app.views.mcda import prompt
+from app.views.mcda.prompt import get_mcda_prompt
+from tests.fixtures import make_axes
+
+
+class TestMcdaPrompt(unittest.IsolatedAsyncioTestCase):
+
+    async def test_prefix_rendered_once_per_catalog(self):
+        catalog = AxesCatalog(make_axes(indicators=10))
+        with mock.patch.object(prompt, 'get_axis_description', wraps=prompt.get_axis_description) as render:
+            first = await get_mcda_prompt('solar farms', 'planner', catalog)
+            second = await get_mcda_prompt('cropland burn risk', None, catalog)
+        render.assert_called_once()
+        # requests differ only in the end of the prompt
+        self.assertIn('Indicator 0 to Population', first)
+        self.assertTrue(first.rstrip().endswith('The user\'s bio: "planner".'))
+        self.assertIn('The user\'s request is: """cropland burn risk"""', second)
+        prefix = prompt.get_mcda_prompt_prefix(catalog).text
+        self.assertTrue(first.startswith(prefix) and second.startswith(prefix))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+from starlette.exceptions import HTTPException
+
+from app.clients.openai_admission import BACKGROUND, INTERACTIVE, Admission, parse_duration
+
+
+class TestAdmission(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.admission = Admission('test_admission', max_concurrency=1)
+        self.order = []
+
+    async def call(self, key, priority=INTERACTIVE, tokens=0, seconds=0.01):
+        async with self.admission.admit(key, tokens, priority):
+            self.order.append(key)
+            await asyncio.sleep(seconds)
+
+    async def test_fair_between_apps(self):
+        calls = [asyncio.create_task(self.call(key)) for key in ('a', 'a', 'a', 'b', 'c')]
+        await asyncio.gather(*calls)
+        self.assertEqual(self.order, ['a', 'b', 'c', 'a', 'a'])
+
+    async def test_priority(self):
+        calls = [asyncio.create_task(self.call('warm', BACKGROUND)) for _ in range(3)]
+        await asyncio.sleep(0)
+        calls.append(asyncio.create_task(self.call('user')))
+        await asyncio.gather(*calls)
+        self.assertEqual(self.order, ['warm', 'user', 'warm', 'warm'])
+
+    def limit_tokens(self, limit: int, remaining: int):
+        # the budget is replenished in a second
+        self.admission.max_concurrency = 10
+        self.admission.tokens.window = 1.0
+        self.admission.on_headers(200, httpx.Headers({
+            'x-ratelimit-limit-tokens': str(limit),
+            'x-ratelimit-remaining-tokens': str(remaining),
+            'x-ratelimit-reset-tokens': '6m0s',
+        }))
+
+    async def admitted_at(self, tokens: list[int]) -> list[float]:
+        started = time.monotonic()
+        admitted = [None] * len(tokens)
+
+        async def call(i):
+            async with self.admission.admit(i, tokens[i]):
+                admitted[i] = time.monotonic() - started
+                await asyncio.sleep(0.3)
+
+        await asyncio.gather(*(call(i) for i in range(len(tokens))))
+        return admitted
+
+    async def test_token_budget(self):
+        self.limit_tokens(1000, 1000)
+        a, b = await self.admitted_at([800, 800])
+        # the second call waits until 600 tokens are refilled, not for the first call or the reset header
+        self.assertLess(a, 0.05)
+        self.assertTrue(0.55 <= b < 0.7)
+        self.assertAlmostEqual(self.admission.tokens.remaining, 0, delta=50)
+
+    async def test_continuous_refill(self):
+        self.limit_tokens(1000, 1000)
+        admitted = await self.admitted_at([300] * 5)
+        # 1000 tokens cover three calls, then 300 tokens are refilled every 0.3 seconds
+        expected = [0, 0, 0, 0.2, 0.5]
+        for at, expected_at in zip(admitted, expected):
+            self.assertAlmostEqual(at, expected_at, delta=0.05)
+
+    async def test_headers_of_earlier_calls(self):
+        self.limit_tokens(1000, 1000)
+        self.admission.tokens.take(900)
+        # response of a call admitted before doesn't count the 900 tokens
+        self.limit_tokens(1000, 950)
+        self.assertLess(self.admission.tokens.remaining, 150)
+        # a call larger than the limit waits for the whole budget
+        big, = await self.admitted_at([5000])
+        self.assertTrue(0.85 <= big < 1.0)
+
+    async def test_rate_limited(self):
+        self.admission.on_headers(429, httpx.Headers({'retry-after': '0.1'}))
+        started = time.monotonic()
+        await self.call('a')
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    async def test_deadline(self):
+        running = asyncio.create_task(self.call('a', seconds=0.2))
+        await asyncio.sleep(0)
+        with self.assertRaises(HTTPException) as e:
+            async with self.admission.admit('b', 0, timeout=0.05):
+                pass
+        self.assertEqual(e.exception.status_code, 503)
+        self.assertEqual(self.admission.queued, 0)
+        await running
+        self.assertEqual(self.admission.in_flight, 0)
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('6m0s'), 360)
+        self.assertEqual(parse_duration('1h2m3.5s'), 3723.5)
+        self.assertEqual(parse_duration('20ms'), 0.02)
+        self.assertEqual(parse_duration('2'), 2)
+        self.assertIsNone(parse_duration(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
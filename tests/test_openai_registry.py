@@ -0,0 +1,59 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from starlette.exceptions import HTTPException
+
+from app.clients import openai_client, openai_registry
+from app.clients.openai_client import OpenAIClient
+
+
+class FakeAssistants:
+
+    def __init__(self, items):
+        self.items = items
+        self.listed = 0
+
+    async def list(self):
+        self.listed += 1
+        for item in self.items:
+            yield item
+
+
+class TestAssistantRegistry(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.assistants = FakeAssistants([
+            SimpleNamespace(id='a0', name='other', model='m0'),
+            SimpleNamespace(id='a1', name='analytics', model='m1'),
+            SimpleNamespace(id='a2', name='analytics', model='m2'),
+            SimpleNamespace(id='a3', name='mcda', model='m3'),
+        ])
+        client = SimpleNamespace(beta=SimpleNamespace(assistants=self.assistants))
+        for patcher in (
+            mock.patch.object(openai_registry, 'get_openai_client', lambda: client),
+            mock.patch.object(openai_client, 'get_openai_client', lambda: client),
+            mock.patch.object(openai_registry.settings, 'OPENAI_ANALYTICS_ASSISTANT', 'analytics'),
+            mock.patch.object(openai_registry.settings, 'OPENAI_MCDA_ASSISTANT', 'mcda'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        openai_registry.assistants.invalidate()
+        self.addCleanup(openai_registry.assistants.invalidate)
+
+    async def test_resolved_once(self):
+        for name in ('analytics', 'mcda', 'analytics'):
+            client = OpenAIClient(assistant_name=name)
+            assistant = await client.assistant
+            self.assertEqual(assistant.name, name)
+        self.assertEqual((await OpenAIClient('analytics').model), 'm1')
+        self.assertEqual(self.assistants.listed, 1)
+
+    async def test_missing(self):
+        with self.assertRaises(HTTPException) as e:
+            await openai_registry.get_assistant('unknown')
+        self.assertEqual(e.exception.status_code, 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+import asyncio
+import unittest
+import warnings
+from types import SimpleNamespace
+from unittest import mock
+
+from openai import AsyncOpenAI
+from starlette.exceptions import HTTPException
+
+from app import metrics
+from app.clients import openai_client
+from app.clients.openai_client import ChatBackend, OpenAIClient, poll_run, split_prompt, stream_run
+from tests.fake_openai import ANSWER, FakeOpenAI
+
+
+class TestRunDriver(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        warnings.simplefilter('ignore', DeprecationWarning)
+        self.fake = FakeOpenAI(run_seconds=0.3)
+        self.client = AsyncOpenAI(base_url=await self.fake.start(), api_key='fake', max_retries=0)
+        self.thread = await self.client.beta.threads.create()
+        self.fake.requests.clear()
+        for patcher in (
+            mock.patch.object(openai_client.settings, 'OPENAI_POLL_MIN_INTERVAL', 0.05),
+            mock.patch.object(openai_client.settings, 'OPENAI_POLL_MAX_INTERVAL', 0.1),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.fake.stop()
+
+    async def test_stream(self):
+        text, run_id = await stream_run(self.client, self.thread.id, {'assistant_id': 'asst_0'})
+        self.assertEqual(text, ANSWER)
+        self.assertIn(run_id, self.fake.runs)
+        self.assertEqual(dict(self.fake.requests), {'runs.stream': 1})
+
+    async def test_stream_unavailable(self):
+        self.fake.streaming = False
+        text, run_id = await stream_run(self.client, self.thread.id, {'assistant_id': 'asst_0'})
+        self.assertEqual(text, ANSWER)
+        self.assertEqual(self.fake.requests['runs.stream'], 1)
+        # no run was created by the stream request
+        self.assertEqual(self.fake.requests['runs.list'], 1)
+        self.assertEqual(self.fake.requests['runs.create'], 1)
+        self.assertEqual(self.fake.requests['messages.list'], 1)
+
+    async def test_stream_dropped(self):
+        # the run was created, but the stream broke before it was reported
+        self.fake.drop_streams = True
+        text, run_id = await stream_run(self.client, self.thread.id, {'assistant_id': 'asst_0'})
+        self.assertEqual(text, ANSWER)
+        self.assertEqual(list(self.fake.runs), [run_id])
+        self.assertEqual(self.fake.requests['runs.list'], 1)
+        self.assertEqual(self.fake.requests['runs.create'], 0)
+
+    async def test_poll(self):
+        text, run_id = await poll_run(self.client, self.thread.id, {'assistant_id': 'asst_0'})
+        self.assertEqual(text, ANSWER)
+        # 0.05, 0.075, 0.1, 0.1 seconds intervals cover the run
+        self.assertLessEqual(self.fake.requests['runs.retrieve'], 5)
+
+    async def test_poll_timeout(self):
+        with mock.patch.object(openai_client.settings, 'OPENAI_RUN_TIMEOUT', 0.1):
+            with self.assertRaises(HTTPException) as e:
+                await poll_run(self.client, self.thread.id, {'assistant_id': 'asst_0'})
+        self.assertEqual(e.exception.status_code, 504)
+        self.assertEqual(self.fake.requests['runs.cancel'], 1)
+        self.assertTrue(all(run['cancelled'] for run in self.fake.runs.values()))
+
+
+class TestStreamCommentary(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        warnings.simplefilter('ignore', DeprecationWarning)
+        self.fake = FakeOpenAI(run_seconds=0.3)
+        client = AsyncOpenAI(base_url=await self.fake.start(), api_key='fake', max_retries=0)
+        self.addAsyncCleanup(self.fake.stop)
+        self.addAsyncCleanup(client.close)
+        self.cache = {}
+        self.released = []
+
+        async def get_response(cache_key, llm_model):
+            return self.cache.get(cache_key)
+
+        async def acquire_lease(cache_key, request, llm_model, owner):
+            return True
+
+        async def keep_lease(cache_key, llm_model, owner):
+            await asyncio.sleep(3600)
+
+        async def complete_lease(cache_key, llm_model, owner, response):
+            self.cache[cache_key] = response
+
+        async def release_lease(cache_key, llm_model, owner):
+            self.released.append(cache_key)
+
+        async def get_assistant(name):
+            return SimpleNamespace(id='asst_0', model='gpt-fake')
+
+        llm_cache = openai_client.llm_cache
+        for patcher in (
+            mock.patch.object(llm_cache, 'get_response', get_response),
+            mock.patch.object(llm_cache, 'acquire_lease', acquire_lease),
+            mock.patch.object(llm_cache, 'keep_lease', keep_lease),
+            mock.patch.object(llm_cache, 'complete_lease', complete_lease),
+            mock.patch.object(llm_cache, 'release_lease', release_lease),
+            mock.patch.object(openai_client, 'get_assistant', get_assistant),
+            mock.patch.object(openai_client, 'get_openai_client', lambda: client),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = OpenAIClient('assistant')
+
+    async def test_streamed_and_cached(self):
+        parts = [x async for x in self.client.stream_cached_llm_commentary('prompt')]
+        self.assertGreater(len(parts), 1)
+        self.assertEqual(''.join(parts), ANSWER)
+        self.assertEqual(list(self.cache.values()), [ANSWER])
+
+        # cached response is sent at once
+        parts = [x async for x in self.client.stream_cached_llm_commentary('prompt')]
+        self.assertEqual(parts, [ANSWER])
+        self.assertEqual(self.fake.requests['runs.stream'], 1)
+
+    async def test_concurrent_streams(self):
+        async def stream(delay: float) -> list[str]:
+            await asyncio.sleep(delay)
+            return [x async for x in self.client.stream_cached_llm_commentary('prompt')]
+
+        first, second = await asyncio.gather(stream(0), stream(0.1))
+        # the later request gets parts sent before it joined and the rest as they come
+        self.assertEqual(''.join(first), ANSWER)
+        self.assertEqual(''.join(second), ANSWER)
+        self.assertGreater(len(second), 1)
+        self.assertEqual(self.fake.requests['runs.stream'], 1)
+
+        # a call that isn't streamed is shared too, its response comes at once
+        task = asyncio.create_task(self.client.get_cached_llm_commentary('other prompt'))
+        await asyncio.sleep(0.05)
+        self.assertEqual([x async for x in self.client.stream_cached_llm_commentary('other prompt')], [ANSWER])
+        self.assertEqual(await task, ANSWER)
+        self.assertEqual(self.fake.requests['runs.stream'], 2)
+
+    async def test_changed_response(self):
+        async def get_llm_commentary(prompt, on_delta=None):
+            on_delta('Partial')
+            await asyncio.sleep(0.01)
+            return 'Other'
+
+        parts = []
+        with mock.patch.object(self.client, 'get_llm_commentary', get_llm_commentary):
+            with self.assertRaises(HTTPException) as e:
+                async for part in self.client.stream_cached_llm_commentary('prompt'):
+                    parts.append(part)
+        # the client is told instead of getting a truncated response
+        self.assertEqual(parts, ['Partial'])
+        self.assertEqual(e.exception.status_code, 502)
+
+    async def test_closed_early(self):
+        parts = self.client.stream_cached_llm_commentary('prompt')
+        await anext(parts)
+        await parts.aclose()
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.fake.requests['runs.cancel'], 1)
+        self.assertEqual(len(self.released), 1)
+        self.assertEqual(self.cache, {})
+
+
+class TestChatBackend(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.fake = FakeOpenAI(run_seconds=0.1)
+        self.client = AsyncOpenAI(base_url=await self.fake.start(), api_key='fake', max_retries=0)
+        self.addAsyncCleanup(self.fake.stop)
+        self.addAsyncCleanup(self.client.close)
+        self.assistant = SimpleNamespace(
+            id='asst_0', model='gpt-fake', instructions='be brief', temperature=0.5, top_p=None,
+            response_format=SimpleNamespace(model_dump=lambda **kwargs: {'type': 'json_object'}),
+        )
+
+    async def test_one_request(self):
+        prompt = 'line\n' * 10000
+        deltas = []
+        backend = ChatBackend(self.client)
+        text = await backend.complete(self.assistant, prompt, 'instructions', False, on_delta=deltas.append)
+        self.assertEqual(text, ANSWER)
+        self.assertEqual(''.join(deltas), ANSWER)
+        text = await backend.complete(self.assistant, prompt, 'instructions', True)
+        self.assertEqual(text, ANSWER)
+        self.assertEqual(self.fake.calls, 2)
+
+        appended, overridden = self.fake.completions
+        self.assertEqual(appended['messages'][0], {'role': 'system', 'content': 'be brief\ninstructions'})
+        self.assertEqual(overridden['messages'][0], {'role': 'system', 'content': 'instructions'})
+        self.assertEqual([x['content'] for x in overridden['messages'][1:]], split_prompt(prompt))
+        self.assertEqual(overridden['temperature'], 0.5)
+        self.assertNotIn('top_p', overridden)
+        self.assertEqual(overridden['response_format'], {'type': 'json_object'})
+
+    async def test_assistant_instructions(self):
+        backend = ChatBackend(self.client)
+        for instructions, override_instructions in ((None, True), ('', True), (None, False)):
+            await backend.complete(self.assistant, 'prompt', instructions, override_instructions)
+        # empty instructions keep the assistant's ones, like a run does
+        for completion in self.fake.completions:
+            self.assertEqual(completion['messages'][0], {'role': 'system', 'content': 'be brief'})
+
+    def test_abstract_backend(self):
+        with self.assertRaises(TypeError):
+            openai_client.LLMBackend(self.client)
+
+    async def test_cached_prompt_tokens(self):
+        backend = ChatBackend(self.client)
+        cached = metrics.snapshot()['counters'].get('openai.cached_prompt_tokens', 0)
+        prefix = 'line\n' * 2000
+        await backend.complete(self.assistant, prefix + 'one', None, True)
+        # usage of streamed response comes in the last chunk
+        await backend.complete(self.assistant, prefix + 'two', None, True, on_delta=lambda _: None)
+        # 2500 tokens of the prefix are cached in 128 token steps
+        self.assertEqual(metrics.snapshot()['counters']['openai.cached_prompt_tokens'] - cached, 2432)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import asyncio
+import unittest
+
+from app.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def test_coalesce(self):
+        flight = SingleFlight('test')
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        results = await asyncio.gather(*(flight.do('key', work) for _ in range(5)))
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+
+        # finished call is forgotten, the next one does the work again
+        await flight.do('key', work)
+        self.assertEqual(len(calls), 2)
+
+    async def test_error_for_every_waiter(self):
+        flight = SingleFlight('test')
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise ValueError('boom')
+
+        results = await asyncio.gather(*(flight.do('key', work) for _ in range(3)), return_exceptions=True)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+    async def test_cancelled_waiter(self):
+        flight = SingleFlight('test')
+        started = asyncio.Event()
+
+        async def work():
+            started.set()
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        first = asyncio.create_task(flight.do('key', work))
+        second = asyncio.create_task(flight.do('key', work))
+        await started.wait()
+        first.cancel()
+        # work continues for the remaining caller
+        self.assertEqual(await second, 'result')
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+    async def test_all_waiters_cancelled(self):
+        flight = SingleFlight('test')
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.create_task(flight.do('key', work))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+    async def test_caller_after_all_cancelled(self):
+        flight = SingleFlight('test')
+
+        async def work():
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        first = asyncio.create_task(flight.do('key', work))
+        await asyncio.sleep(0)
+        first.cancel()
+        # the second caller runs in the same loop iteration as cancelled first one
+        second = asyncio.create_task(flight.do('key', work))
+        self.assertEqual(await second, 'result')
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+    async def test_batch(self):
+        flight = SingleFlight('test')
+        batches = []
+
+        async def work(keys):
+            batches.append(keys)
+            await asyncio.sleep(0.01)
+            return {key: key.upper() for key in keys}
+
+        first, second = await asyncio.gather(flight.do_batch(['a', 'b'], work), flight.do_batch(['a', 'c'], work))
+        self.assertEqual(first, {'a': 'A', 'b': 'B'})
+        self.assertEqual(second, {'a': 'A', 'c': 'C'})
+        # 'a' is in flight for the second call, only 'c' is requested by it
+        self.assertEqual(batches, [['a', 'b'], ['c']])
+
+    async def test_batch_cancelled(self):
+        flight = SingleFlight('test')
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def work(keys):
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.create_task(flight.do_batch(['a', 'b'], work))
+        await started.wait()
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import asyncio
+import base64
+import time
+import unittest
+from unittest import mock
+
+import aiohttp
+import ujson as json
+from starlette.exceptions import HTTPException
+
+from app.clients import user_profile_client
+from app.clients.user_profile_client import get_app_data, token_expiry
+
+
+def make_token(exp: float) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    return f'Bearer {encode({"alg": "none"})}.{encode({"exp": exp})}.signature'
+
+
+class TestUserProfileCache(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        user_profile_client._responses.clear()
+        self.requests = []
+        self.responses = {
+            '/users/current_user': (200, {'bio': 'bio'}),
+            '/apps/app': (200, {'featuresConfig': {'reference_area': {}}}),
+            '/features?appId=app': (200, [{'name': 'llm_analytics'}]),
+        }
+
+        async def request_ups(path, auth_token):
+            self.requests.append(path)
+            await asyncio.sleep(0.01)
+            return self.responses[path]
+
+        patcher = mock.patch.object(user_profile_client, '_request_ups', request_ups)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_cached_per_token(self):
+        token = make_token(time.time() + 3600)
+        for _ in range(3):
+            app_data = await get_app_data('app', token, features_config=True)
+        self.assertEqual(app_data['current_user'], {'bio': 'bio'})
+        self.assertEqual(app_data['features_config'], {'reference_area': {}})
+        self.assertEqual(app_data['features_enabled'], frozenset(['llm_analytics']))
+        self.assertEqual(len(self.requests), 3)
+
+        # other user gets own responses
+        await get_app_data('app', make_token(time.time() + 3600), features_config=True)
+        self.assertEqual(len(self.requests), 6)
+
+    async def test_concurrent_requests(self):
+        token = make_token(time.time() + 3600)
+        await asyncio.gather(*(get_app_data('app', token) for _ in range(5)))
+        self.assertEqual(sorted(self.requests), ['/features?appId=app', '/users/current_user'])
+
+    async def test_expired_token_not_cached(self):
+        token = make_token(time.time() - 1)
+        await get_app_data('app', token)
+        await get_app_data('app', token)
+        self.assertEqual(len(self.requests), 4)
+
+    async def test_errors_cached(self):
+        self.responses['/users/current_user'] = (401, 'unauthorized')
+        for _ in range(2):
+            with self.assertRaises(HTTPException) as e:
+                await get_app_data('app', 'Bearer broken')
+            self.assertEqual(e.exception.status_code, 401)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_token_expiry(self):
+        self.assertEqual(token_expiry(make_token(1700000000)), 1700000000)
+        self.assertIsNone(token_expiry('Bearer not-a-jwt'))
+        self.assertIsNone(token_expiry(None))
+
+
+
+class TestUserProfileErrors(unittest.IsolatedAsyncioTestCase):
+
+    async def test_unreachable_ups_cached(self):
+        for error, status in ((aiohttp.ClientConnectionError(), 502), (asyncio.TimeoutError(), 504)):
+            user_profile_client._responses.clear()
+            session = mock.Mock()
+            session.get.side_effect = error
+            with mock.patch.object(user_profile_client, 'get_http_session', return_value=session), \
+                    mock.patch.object(user_profile_client.settings, 'USER_PROFILE_API_URL', 'http://ups'):
+                for _ in range(2):
+                    with self.assertRaises(HTTPException) as e:
+                        await get_app_data('app', 'Bearer token', user_data=False)
+                    self.assertEqual(e.exception.status_code, status)
+            # errors are cached like error responses
+            self.assertEqual(session.get.call_count, 1)
+        user_profile_client._responses.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from unittest import mock
+
+from app.clients import insights_api_client
+from app.clients.axes_catalog import AxesCatalog
+from app.clients.insights_api_client import get_world_calculations, invalidate_world_analytics
+
+
+def indicator(name: str, label: str, unit: str | None) -> dict:
+    return {'name': name, 'label': label, 'emoji': None, 'description': '', 'unit': {'longName': unit}}
+
+
+AXES = {'data': {'getAxes': {'axis': [
+    {'quotients': [indicator('population', 'Population', 'people'), indicator('one', '1', None)]},
+    {'quotients': [indicator('one', '1', None), indicator('one', '1', None)]},
+]}}}
+ANALYTICS = {'data': {'polygonStatistic': {'analytics': {'advancedAnalytics': [{
+    'numerator': 'population', 'denominator': 'one',
+    'numeratorLabel': 'Population', 'denominatorLabel': '1',
+    'analytics': [{'calculation': 'sum', 'value': 8e9, 'quality': 1.0}],
+}]}}}}
+
+
+class TestWorldCalculations(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        invalidate_world_analytics()
+        self.addCleanup(invalidate_world_analytics)
+        patcher = mock.patch.object(insights_api_client.world_analytics, 'get', mock.AsyncMock(return_value=ANALYTICS))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_memoized(self):
+        with mock.patch.object(
+                insights_api_client, 'flatten_analytics', wraps=insights_api_client.flatten_analytics) as flatten:
+            catalog = AxesCatalog(AXES)
+            first = await get_world_calculations(catalog)
+            second = await get_world_calculations(catalog)
+        self.assertIs(first, second)
+        flatten.assert_called_once()
+        self.assertEqual(first[('sum', 'population', 'one')].value, 8e9)
+
+
+if __name__ == '__main__':
+    unittest.main()